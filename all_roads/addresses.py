@@ -0,0 +1,115 @@
+# all_roads/addresses.py
+"""
+Resolve Google address strings to Address ids in bulk.
+
+Lookup order per chunk: in-process LRU -> optional Redis hash (shared by
+Celery workers) -> one SELECT for the rest -> bulk INSERT of the missing
+ones. Inserts use ON CONFLICT DO NOTHING and are re-read afterwards, so
+two workers inserting the same address both end up with the same row.
+An insert can also be dropped for conflicting on something else (e.g. a
+primary key behind its sequence); those are retried, and any still
+missing raise AddressResolutionError instead of vanishing.
+"""
+import logging
+from django.conf import settings
+from all_roads.caching import LRUCache, get_redis
+from all_roads.models import Address
+
+logger = logging.getLogger(__name__)
+
+REDIS_KEY = "all_roads:address_ids"
+INSERT_ATTEMPTS = 3
+
+
+class AddressResolutionError(Exception):
+    """Some addresses could not be stored; `resolved` holds the ones that were."""
+
+    def __init__(self, missing, resolved):
+        self.missing = list(missing)
+        self.resolved = resolved
+        shown = ", ".join(repr(a) for a in self.missing[:3])
+        more = f" (+{len(self.missing) - 3} more)" if len(self.missing) > 3 else ""
+        super().__init__(f"Could not create Address rows for {shown}{more}")
+
+
+class AddressResolver:
+    def __init__(self, maxsize=None):
+        if maxsize is None:
+            maxsize = getattr(settings, "ADDRESS_CACHE_SIZE", 20000)
+        self.cache = LRUCache(maxsize)
+
+    def _redis_get(self, keys):
+        client = get_redis()
+        if client is None or not keys:
+            return {}
+        try:
+            values = client.hmget(REDIS_KEY, keys)
+        except Exception as e:
+            logger.warning("Address cache read failed: %s", e)
+            return {}
+        return {k: int(v) for k, v in zip(keys, values) if v is not None}
+
+    def _redis_set(self, mapping):
+        client = get_redis()
+        if client is None or not mapping:
+            return
+        try:
+            client.hset(REDIS_KEY, mapping=mapping)
+        except Exception as e:
+            logger.warning("Address cache write failed: %s", e)
+
+    def resolve_many(self, wanted):
+        """
+        wanted: { address_str: (lat, lng) } — coordinates are only used when
+        the address has to be created.
+        Returns { address_str: address_id }.
+        """
+        found = {}
+        misses = []
+        for address_str in wanted:
+            address_id = self.cache.get(address_str)
+            if address_id is None:
+                misses.append(address_str)
+            else:
+                found[address_str] = address_id
+
+        from_redis = self._redis_get(misses)
+        found.update(from_redis)
+        misses = [a for a in misses if a not in from_redis]
+
+        fresh = {}
+        missing = []
+        if misses:
+            fresh.update(Address.objects.filter(address__in=misses).values_list("address", "id"))
+            missing = [a for a in misses if a not in fresh]
+            for _ in range(INSERT_ATTEMPTS):
+                if not missing:
+                    break
+                Address.objects.bulk_create(
+                    [Address(address=a, lat=wanted[a][0], lng=wanted[a][1]) for a in missing],
+                    ignore_conflicts=True,
+                )
+                fresh.update(Address.objects.filter(address__in=missing).values_list("address", "id"))
+                missing = [a for a in missing if a not in fresh]
+
+        for address_str, address_id in list(from_redis.items()) + list(fresh.items()):
+            self.cache.set(address_str, address_id)
+        self._redis_set(fresh)
+        found.update(fresh)
+        if missing:
+            raise AddressResolutionError(missing, found)
+        return found
+
+    def resolve(self, address_str, lat, lng):
+        return self.resolve_many({address_str: (lat, lng)})[address_str]
+
+
+_resolver = None
+
+
+def get_resolver():
+    """Per-process resolver so the LRU survives across chunks and tasks."""
+    global _resolver
+    if _resolver is None:
+        _resolver = AddressResolver()
+    return _resolver
@@ -4,4 +4,11 @@ from all_roads.models import Segment
 class SegmentSerializer(serializers.ModelSerializer):
     class Meta:
         model = Segment
-        fields = '__all__'
\ No newline at end of file
+        fields = '__all__'
+
+class FailedSegmentSerializer(serializers.ModelSerializer):
+    route = serializers.StringRelatedField()
+
+    class Meta:
+        model = Segment
+        fields = ['code', 'route', 'name', 'state', 'last_error', 'error_attempts', 'next_retry_at', 'last_refreshed_at']
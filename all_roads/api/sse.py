@@ -0,0 +1,60 @@
+# all_roads/api/sse.py
+"""
+Server-sent events for refresh task progress, served straight from the ASGI
+app (roads/asgi.py) so a long-lived stream holds no Django worker thread:
+
+    GET /api/tasks/<uuid>/events/
+
+Each event is the same JSON task_status returns. An event is only sent when
+the payload changes (state, progress, or queue wait while the task is still
+queued), and the stream closes once the task is ready.
+"""
+import asyncio
+import json
+import re
+
+from celery import states
+from django.conf import settings
+
+from all_roads.progress import task_payload
+
+TASK_EVENTS_PATH = re.compile(r"^/api/tasks/(?P<task_id>[0-9a-fA-F-]{36})/events/$")
+
+
+async def _wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def task_events(scope, receive, send, task_id):
+    interval = getattr(settings, "TASK_EVENTS_POLL_INTERVAL", 1.0)
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"text/event-stream"),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),  # don't let nginx buffer the stream
+        ],
+    })
+
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    last = None
+    try:
+        while True:
+            # Result backend calls are blocking
+            payload = await asyncio.to_thread(task_payload, task_id)
+            if payload != last:
+                body = f"event: {payload['state'].lower()}\ndata: {json.dumps(payload, default=str)}\n\n"
+                await send({"type": "http.response.body", "body": body.encode(), "more_body": True})
+                last = payload
+            if payload["state"] in states.READY_STATES:
+                break
+            await asyncio.wait({disconnected}, timeout=interval)
+            if disconnected.done():
+                return
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+    finally:
+        disconnected.cancel()
@@ -6,4 +6,8 @@ urlpatterns = [
     path('update-segments/', views.update_segment_distances, name='update_segments'),
     path('update-segments/queue/', views.queue_refresh, name='queue_refresh'),
     path('tasks/<uuid:task_id>/', views.task_status, name='task_status'),
+    path('failed-segments/', views.failed_segments, name='failed_segments'),
+    path('failed-segments/retry/', views.retry_failed, name='retry_failed'),
+    path('segments/<str:code>/history/', views.segment_history_view, name='segment_history'),
+    path('routes/<str:route>/history/', views.route_history_view, name='route_history'),
 ]
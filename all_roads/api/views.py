@@ -1,27 +1,29 @@
-import requests, time, uuid
-from django.http import JsonResponse
-from django.views.decorators.csrf import ensure_csrf_cookie
+import logging
+import uuid
+from django.urls import reverse
 from django.conf import settings
-
-from decouple import config
-from celery.result import AsyncResult
-
-from all_roads.models import Segment, Address, Route, Road
-from all_roads.tasks import refresh_segments_task
-from all_roads.utils import get_status_color
-from .serializers import SegmentSerializer
+from django.db.models import F
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+
+from all_roads.models import Segment, Route
+from all_roads.tasks import (
+    refresh_segments_task, refresh_network_task, refresh_stale_segments_task,
+    retry_failed_segments_task,
+)
+from all_roads.services import REFRESH_MODES
+from all_roads.history import segment_history, route_history
+from all_roads.inflight import get_registry
+from all_roads.progress import task_payload
+from .serializers import SegmentSerializer, FailedSegmentSerializer
 
 from rest_framework.decorators import api_view, permission_classes
 from rest_framework.response import Response
 from rest_framework.permissions import AllowAny
 from rest_framework import status
 
-
-def get_or_create_address(address_str, lat, lng):
-    return Address.objects.get_or_create(
-        address=address_str,
-        defaults={'lat': lat, 'lng': lng}
-    )[0]
+logger = logging.getLogger(__name__)
 
 @api_view(["POST"])
 def queue_update_segments(request):
@@ -39,17 +41,14 @@ def queue_update_segments(request):
 def task_status(request, task_id: uuid.UUID):
     """
     Returns Celery task status (and result/error if available).
+    Running refreshes report state PROGRESS with
+    {"processed", "updated", "failed", "total", "eta_seconds"}. Until it
+    finishes, "queue" gives {"queue", "queue_depth", "wait_seconds"}. Under ASGI the
+    same updates are pushed from tasks/<uuid>/events/ (see api/sse.py).
     Handles UUID vs str issues and avoids 500 HTML pages.
     """
     try:
-        tid = str(task_id)  # ensure string for Celery
-        res = AsyncResult(tid)
-        payload = {"task_id": tid, "state": res.state}
-        if res.successful():
-            payload["result"] = res.result
-        elif res.failed():
-            payload["error"] = str(res.result)
-        return Response(payload)
+        return Response(task_payload(str(task_id)))  # ensure string for Celery
     except Exception as e:
         return Response(
             {"task_id": str(task_id), "state": "UNKNOWN", "error": str(e)},
@@ -60,10 +59,20 @@ def task_status(request, task_id: uuid.UUID):
 @permission_classes([AllowAny])  # tighten as you like
 def queue_refresh(request):
     """
-    Body (JSON): { "codes": ["F100LAS1", "F102RIV2", ...] } (optional)
-    Returns:     { "task_id": "..." }
+    Body (JSON): { "codes": ["F100LAS1", "F102RIV2", ...], "mode": "async", "incremental": true } (all optional)
+    Returns:     { "task_id": "..." }, plus "coalesced": true when an already
+                 queued/running refresh covers the request (its task_id is returned)
+    "incremental" ignores codes and refreshes only stale segments, oldest first.
     """
     codes = request.data.get("codes", None)
+    mode = request.data.get("mode", "serial")
+    incremental = bool(request.data.get("incremental", False))
+
+    if mode not in REFRESH_MODES:
+        return Response(
+            {"detail": f"mode must be one of {', '.join(REFRESH_MODES)}"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
 
     # Validate if provided
     if codes is not None:
@@ -73,76 +82,166 @@ def queue_refresh(request):
                 status=status.HTTP_400_BAD_REQUEST
             )
 
-    # Enqueue
-    async_result = refresh_segments_task.delay(codes=codes)
-    # or: refresh_segments_task.apply_async(kwargs={"codes": codes})
-    
-    # async_result = refresh_segments_task.apply_async(kwargs={"codes": codes})
-    return Response({"task_id": async_result.id}, status=status.HTTP_200_OK)
-
-def update_segment_distances(request):
-    api_key = config('GOOGLE_ROUTES_API_KEY')
-    segments = Segment.objects.all()
+    if incremental:
+        async_result = refresh_stale_segments_task.delay(mode=mode)
+        return Response({"task_id": async_result.id}, status=status.HTTP_200_OK)
+    return Response(_enqueue_coalesced(codes or None, mode), status=status.HTTP_200_OK)
 
-    updated, failed = 0, 0
+def _enqueue_coalesced(codes, mode):
+    """
+    Enqueue a refresh unless queued/running work already covers it. Returns
+    {"task_id": <covering task>, "coalesced": true} in that case; otherwise
+    only the uncovered codes are enqueued, with "coalesced_with" naming the
+    task that already has the rest. Full sweeps, and code lists longer than
+    REFRESH_SHARD_SIZE, fan out over the workers; shorter lists run as one
+    task.
+    """
+    try:
+        registry = get_registry()
+        with registry.queue_lock():
+            covering, remaining = registry.plan(codes)
+            if covering and not remaining:
+                return {"task_id": covering, "coalesced": True}
+            task_id = str(uuid.uuid4())
+            registry.register(task_id, remaining)
+    except Exception as e:
+        logger.warning("In-flight registry unavailable, enqueueing without coalescing: %s", e)
+        return {"task_id": _enqueue_refresh(codes, mode).id}
+    try:
+        _enqueue_refresh(remaining, mode, task_id)
+    except Exception:
+        # Never queued: don't let later requests coalesce onto it
+        registry.release(task_id)
+        raise
+
+    payload = {"task_id": task_id}
+    if codes and len(remaining) < len(set(codes)):
+        payload["coalesced_with"] = covering
+        payload["queued_codes"] = len(remaining)
+    return payload
+
+def _enqueue_refresh(codes, mode, task_id=None):
+    # A list longer than one shard is run as a (checkpointed) sweep of it
+    if codes and len(codes) <= settings.REFRESH_SHARD_SIZE:
+        return refresh_segments_task.apply_async(kwargs={"codes": codes, "mode": mode}, task_id=task_id)
+    return refresh_network_task.apply_async(kwargs={"codes": codes, "mode": mode}, task_id=task_id)
 
-    for segment in segments:
-        time.sleep(1.0)
-        try:
-            origin = f"{segment.start_lat},{segment.start_lon}"
-            destination = f"{segment.end_lat},{segment.end_lon}"
+@api_view(["GET"])
+@permission_classes([AllowAny])  # tighten later
+def failed_segments(request):
+    """
+    Segments whose last refresh failed, with reason, attempt count and the
+    time of the next automatic retry. ?code=F100 filters by code prefix.
+    """
+    qs = (
+        Segment.objects.filter(error_processing=True)
+        .select_related("route")
+        .order_by(F("next_retry_at").asc(nulls_first=True), "code")
+    )
+    prefix = request.query_params.get("code")
+    if prefix:
+        qs = qs.filter(code__startswith=prefix.upper())
+    return Response({
+        "count": qs.count(),
+        "max_attempts": settings.REFRESH_RETRY_MAX_ATTEMPTS,
+        "segments": FailedSegmentSerializer(qs[:1000], many=True).data,
+    })
 
-            url = (
-                "https://maps.googleapis.com/maps/api/distancematrix/json"
-                f"?origins={origin}&destinations={destination}"
-                f"&mode=driving&units=metric&key={api_key}"
+@api_view(["POST"])
+@permission_classes([AllowAny])  # tighten as you like
+def retry_failed(request):
+    """
+    Body (JSON): { "codes": [...], "force": true } (both optional)
+    Queues a retry of failed segments only. Without force, segments still
+    backing off are skipped; segments at the max attempt count never run.
+    Returns: { "task_id": "..." }
+    """
+    codes = request.data.get("codes", None)
+    if codes is not None:
+        if not isinstance(codes, list) or not all(isinstance(c, str) for c in codes):
+            return Response(
+                {"detail": "codes must be a list of strings"},
+                status=status.HTTP_400_BAD_REQUEST
             )
+    force = bool(request.data.get("force", False))
+    async_result = retry_failed_segments_task.delay(codes=codes, force=force)
+    return Response({"task_id": async_result.id}, status=status.HTTP_200_OK)
+
+def _history_params(request):
+    """(resolution, since, until) from the query string, or a 400 Response."""
+    resolution = request.query_params.get("resolution", "h")
+    if resolution not in ("raw", "h", "d"):
+        return Response({"detail": "resolution must be one of raw, h, d"}, status=status.HTTP_400_BAD_REQUEST)
+    bounds = []
+    for name in ("since", "until"):
+        value = request.query_params.get(name)
+        parsed = parse_datetime(value) if value else None
+        if value and parsed is None:
+            return Response({"detail": f"{name} must be an ISO 8601 datetime"}, status=status.HTTP_400_BAD_REQUEST)
+        if parsed is not None and timezone.is_naive(parsed):
+            parsed = timezone.make_aware(parsed)
+        bounds.append(parsed)
+    return resolution, bounds[0], bounds[1]
+
+@api_view(["GET"])
+@permission_classes([AllowAny])  # tighten later
+def segment_history_view(request, code):
+    """
+    Traffic history for one segment, oldest first (max 5000 points).
+    ?resolution=raw|h|d (default h), ?since=/?until= ISO datetimes (default last 7 days).
+    """
+    params = _history_params(request)
+    if isinstance(params, Response):
+        return params
+    segment = Segment.objects.filter(code=code.upper()).first()
+    if segment is None:
+        return Response({"detail": "Unknown segment"}, status=status.HTTP_404_NOT_FOUND)
+    resolution, since, until = params
+    return Response({
+        "segment": segment.code,
+        "resolution": resolution,
+        "points": segment_history(segment, resolution, since, until),
+    })
 
-            response = requests.get(url, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-
-            if data['status'] != 'OK':
-                raise ValueError(f"Bad API status: {data['status']}")
-
-            element = data['rows'][0]['elements'][0]
-            if element['status'] != 'OK':
-                raise ValueError(f"Element status not OK: {element['status']}")
-
-            # Extract values
-            distance_km = round(element['distance']['value'] / 1000, 2)
-            duration_sec = element['duration']['value']
-            speed = (distance_km / (duration_sec / 3600)) if duration_sec > 0 else 0.0
-
-            # Update Segment
-            segment.distance = distance_km
-            segment.travel_time = duration_sec
-            segment.avg_speed = round(speed, 1)
-            segment.status = get_status_color(speed)
-            segment.error_processing = False
-
-            # Update Address references
-            origin_address_str = data['origin_addresses'][0]
-            destination_address_str = data['destination_addresses'][0]
-
-            segment.start_point = get_or_create_address(origin_address_str, segment.start_lat, segment.start_lon)
-            segment.end_point = get_or_create_address(destination_address_str, segment.end_lat, segment.end_lon)
-
-            segment.save()
-            updated += 1
-
-        except (requests.RequestException, KeyError, IndexError, ValueError) as e:
-            segment.error_processing = True
-            segment.save(update_fields=['error_processing'])
-            failed += 1
-            print(f"[ERROR] Segment {segment.code}: {e}")
-
-    return JsonResponse({
-        'updated': updated,
-        'failed': failed,
-        'total': segments.count()
+@api_view(["GET"])
+@permission_classes([AllowAny])  # tighten later
+def route_history_view(request, route):
+    """
+    Route traffic history from the hourly/daily rollups: per bucket, the
+    summed segment travel time and mean segment speed. Same query params
+    as segment history, without raw.
+    """
+    params = _history_params(request)
+    if isinstance(params, Response):
+        return params
+    resolution, since, until = params
+    if resolution == "raw":
+        return Response({"detail": "route history is only kept as h or d rollups"}, status=status.HTTP_400_BAD_REQUEST)
+    route_obj = Route.objects.filter(route=route.upper()).first()
+    if route_obj is None:
+        return Response({"detail": "Unknown route"}, status=status.HTTP_404_NOT_FOUND)
+    return Response({
+        "route": route_obj.route,
+        "resolution": resolution,
+        "points": route_history(route_obj, resolution, since, until),
     })
 
+@api_view(["POST"])
+@permission_classes([AllowAny])  # tighten later
+def update_segment_distances(request):
+    """
+    Queue a full network refresh on the Celery workers and return at once.
+    Goes through the in-flight registry like queue_refresh, so while a sweep
+    is queued or running its task_id comes back (with "coalesced": true)
+    instead of a second sweep fighting over the same shard checkpoints.
+    Follow it via task_status (or its events/ stream under ASGI).
+    Returns 202: { "task_id": "...", "status_url": "...", "events_url": "..." }
+    """
+    payload = _enqueue_coalesced(None, "async")
+    status_url = reverse("task_status", kwargs={"task_id": payload["task_id"]})
+    payload.update(status_url=status_url, events_url=f"{status_url}events/")
+    return Response(payload, status=status.HTTP_202_ACCEPTED)
+
 @api_view(['GET'])
 def all_segments_view(request):
     segments = Segment.objects.all()
@@ -0,0 +1,231 @@
+# all_roads/benchmark.py
+"""
+Refresh throughput benchmark against the offline fake Distance Matrix
+(all_roads/fake_distance_matrix.py). Seeds synthetic segments under their
+own road/route, refreshes them once per mode and reports segments/sec,
+per-segment API latency (p50/p99), DB queries and API calls per segment.
+Run it through `python manage.py benchmark_refresh`, which by default runs
+it in a throwaway test database.
+
+While it runs, the shared Redis caches, metrics and in-flight registry are
+swapped for process-local ones, so fake responses, addresses and timings
+never reach the Redis that production workers read.
+"""
+import contextlib
+import random
+import time
+from urllib.parse import urlparse, parse_qs
+
+from django.db import connection, transaction
+from django.test.utils import override_settings
+
+from all_roads import addresses, distance_matrix, http_client, inflight, metrics
+from all_roads.addresses import get_resolver
+from all_roads.distance_matrix import get_response_cache
+from all_roads.fake_distance_matrix import start_in_thread, address_for
+from all_roads.models import Address, Road, Route, Segment
+from all_roads.services import REFRESH_MODES, refresh_segments_from_google
+
+ROAD = "BM"
+ROUTE = "BM000"
+CODE_PREFIX = "BM"
+SEGMENTS_PER_ROUTE_LEG = 25  # contiguous segments before jumping elsewhere
+
+
+def percentile(values, q):
+    """Nearest-rank percentile (q in 0..100) of a list of numbers."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, int(round(q / 100.0 * len(ordered))))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def seed_segments(n, seed=0):
+    """
+    Create `n` benchmark segments as contiguous legs (each segment starts
+    where the previous one ended), like real routes. Returns the queryset.
+    """
+    clear_segments()
+    rng = random.Random(seed)
+    placeholder = _placeholder_address()
+    road = Road.objects.create(road=ROAD)
+    route = Route.objects.create(road=road, route=ROUTE)
+
+    segments = []
+    lat = lng = None
+    for i in range(n):
+        if i % SEGMENTS_PER_ROUTE_LEG == 0:
+            lat, lng = rng.uniform(6.0, 12.5), rng.uniform(3.0, 13.5)
+        end_lat = lat + rng.uniform(-0.03, 0.03)
+        end_lng = lng + rng.uniform(-0.03, 0.03)
+        segments.append(Segment(
+            route=route, code=f"{CODE_PREFIX}{i:07d}",
+            start_lat=round(lat, 5), start_lon=round(lng, 5),
+            end_lat=round(end_lat, 5), end_lon=round(end_lng, 5),
+            start_point_id=placeholder, end_point_id=placeholder,
+        ))
+        lat, lng = end_lat, end_lng
+    Segment.objects.bulk_create(segments, batch_size=1000)
+    return benchmark_segments()
+
+
+def _placeholder_address():
+    """
+    Id of the "unknown" Address unrefreshed segments point at. Created
+    without an explicit id so the table's sequence stays ahead of it.
+    """
+    address, _ = Address.objects.get_or_create(address="unknown")
+    return address.pk
+
+
+def benchmark_segments():
+    return Segment.objects.filter(route__route=ROUTE)
+
+
+def clear_segments():
+    """Remove everything seed_segments and the runs created."""
+    with transaction.atomic():
+        benchmark_segments().delete()
+        Route.objects.filter(route=ROUTE).delete()
+        Road.objects.filter(road=ROAD).delete()
+        Address.objects.filter(address__startswith=address_for("")).delete()
+    get_resolver().cache.clear()
+    get_response_cache().local.clear()
+
+
+def _reset_results():
+    """Put the benchmark segments back to never-refreshed, with cold caches."""
+    placeholder = _placeholder_address()
+    benchmark_segments().update(
+        start_point_id=placeholder, end_point_id=placeholder, last_refreshed_at=None, next_refresh_at=None,
+        error_processing=False, last_error="", error_attempts=0, next_retry_at=None,
+    )
+    Address.objects.filter(address__startswith=address_for("")).delete()
+    get_resolver().cache.clear()
+    get_response_cache().local.clear()
+
+
+@contextlib.contextmanager
+def _count_queries():
+    counter = {"queries": 0}
+
+    def wrapper(execute, sql, params, many, context):
+        counter["queries"] += 1
+        return execute(sql, params, many, context)
+
+    with connection.execute_wrapper(wrapper):
+        yield counter
+
+
+@contextlib.contextmanager
+def _time_api_calls(pairs):
+    """
+    Record (seconds, segments answered) for every Distance Matrix call;
+    `pairs` is the set of (origin, destination) strings of the segments.
+    """
+    calls = []
+    original = http_client.get
+
+    def timed_get(url, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return original(url, *args, **kwargs)
+        finally:
+            params = parse_qs(urlparse(url).query)
+            origins = params.get("origins", [""])[0].split("|")
+            destinations = params.get("destinations", [""])[0].split("|")
+            answered = sum((o, d) in pairs for o in origins for d in destinations)
+            calls.append((time.perf_counter() - started, answered))
+
+    http_client.get = timed_get
+    try:
+        yield calls
+    finally:
+        http_client.get = original
+
+
+@contextlib.contextmanager
+def _isolated(**overrides):
+    """
+    Settings overrides with the process-wide caches rebuilt under them: no
+    shared Redis for caches or metrics, an unshared in-flight registry, and
+    a response cache / address resolver that see the overridden settings.
+    The originals are put back afterwards.
+    """
+    overrides.setdefault("REFRESH_CACHE_REDIS_URL", "")
+    overrides.setdefault("METRICS_REDIS_URL", "")
+    saved = (distance_matrix._response_cache, addresses._resolver, inflight._registry)
+    with override_settings(**overrides):
+        distance_matrix._response_cache = None
+        addresses._resolver = None
+        inflight._registry = inflight.InflightRegistry(inflight.InMemoryRedis(), shared=False)
+        try:
+            yield
+        finally:
+            distance_matrix._response_cache, addresses._resolver, inflight._registry = saved
+            metrics._pending.drain()  # never push benchmark timings later
+
+
+def run_mode(mode, rate_limit=None, concurrency=None):
+    """Refresh every benchmark segment once in `mode` and measure it (response cache off)."""
+    overrides = {"RESPONSE_CACHE_TTL": 0}
+    if rate_limit is not None:
+        overrides["REFRESH_RATE_LIMIT"] = rate_limit
+    if concurrency is not None:
+        overrides["REFRESH_CONCURRENCY"] = concurrency
+
+    pairs = {
+        (f"{s.start_lat},{s.start_lon}", f"{s.end_lat},{s.end_lon}")
+        for s in benchmark_segments().only("start_lat", "start_lon", "end_lat", "end_lon")
+    }
+    with _isolated(**overrides):
+        _reset_results()
+        with _count_queries() as queries, _time_api_calls(pairs) as calls:
+            started = time.perf_counter()
+            summary = refresh_segments_from_google(benchmark_segments(), mode=mode)
+            elapsed = time.perf_counter() - started
+
+    segments = summary["total"] or 1
+    # A segment's API latency is that of the call that answered it
+    per_segment = [seconds for seconds, answered in calls for _ in range(answered)]
+    return {
+        "mode": mode,
+        "segments": summary["total"],
+        "updated": summary["updated"],
+        "failed": summary["failed"],
+        "deferred": summary.get("deferred", 0),
+        "seconds": round(elapsed, 3),
+        "segments_per_sec": round(summary["total"] / elapsed, 1) if elapsed else None,
+        "latency_p50_ms": _ms(percentile(per_segment, 50)),
+        "latency_p99_ms": _ms(percentile(per_segment, 99)),
+        "db_queries_per_segment": round(queries["queries"] / segments, 3),
+        "api_calls_per_segment": round(len(calls) / segments, 3),
+        "circuit_trips": summary.get("circuit_trips", 0),
+    }
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 1) if seconds is not None else None
+
+
+def run_benchmark(n, modes=REFRESH_MODES, seed=0, keep=False, rate_limit=None, concurrency=None,
+                  **server_options):
+    """
+    Seed `n` segments, start a fake server with `server_options` (latency,
+    jitter, error_rate, throttle_rate, qps) and benchmark each mode.
+    Returns a list of per-mode result dicts.
+    """
+    server = start_in_thread(seed=seed, **server_options)
+    try:
+        with _isolated(DISTANCE_MATRIX_URL=server.url):
+            try:
+                seed_segments(n, seed=seed)
+                results = [run_mode(mode, rate_limit=rate_limit, concurrency=concurrency) for mode in modes]
+            finally:
+                if not keep:
+                    clear_segments()
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
@@ -0,0 +1,74 @@
+# all_roads/caching.py
+"""
+Small in-process caches and the optional shared Redis connection used by
+the refresh pipeline.
+"""
+import threading
+import time
+from collections import OrderedDict
+from django.conf import settings
+
+try:
+    import redis  # optional: shares caches between Celery workers
+except Exception:
+    redis = None
+
+_MISSING = object()
+_redis_client = None
+_redis_lock = threading.Lock()
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used map with a fixed number of entries.
+    With `ttl` (seconds) set, entries also expire that long after being set.
+    """
+
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at | None, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def get_redis():
+    """
+    Shared Redis client when REFRESH_CACHE_REDIS_URL is set and redis-py is
+    installed; otherwise None and callers fall back to in-process caching.
+    """
+    global _redis_client
+    url = getattr(settings, "REFRESH_CACHE_REDIS_URL", "")
+    if not url or redis is None:
+        return None
+    if _redis_client is None:
+        with _redis_lock:
+            if _redis_client is None:
+                _redis_client = redis.Redis.from_url(url, decode_responses=True)
+    return _redis_client
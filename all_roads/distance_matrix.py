@@ -0,0 +1,296 @@
+# all_roads/distance_matrix.py
+"""
+Google Distance Matrix helpers: plan multi-origin/multi-destination requests
+for a group of Segments, fetch them, and map the elements back per segment.
+"""
+import json
+import logging
+import re
+from decimal import Decimal
+import requests
+from django.conf import settings
+from all_roads import http_client, metrics
+from all_roads.caching import LRUCache, get_redis
+from all_roads.utils import get_status_color
+
+logger = logging.getLogger(__name__)
+
+DISTANCE_MATRIX_URL = "https://maps.googleapis.com/maps/api/distancematrix/json"
+
+# Google limits for a single (non-premium) request
+MAX_ORIGINS = 25
+MAX_DESTINATIONS = 25
+MAX_ELEMENTS = 100
+
+# Top-level statuses that mean "slow down / try later", not "bad segment"
+THROTTLE_STATUSES = {"OVER_QUERY_LIMIT", "OVER_DAILY_LIMIT", "RESOURCE_EXHAUSTED", "UNKNOWN_ERROR"}
+
+# Query strings of URLs quoted in error text (they carry the API key)
+_URL_QUERY = re.compile(r"(https?://[^\s?'\"]*)\?[^\s'\")]*")
+
+
+class ThrottledError(Exception):
+    """Google throttled or failed the request; the segment should be retried later."""
+
+
+class CircuitOpenError(ThrottledError):
+    """The request was not sent because the circuit breaker is open."""
+
+
+def redact(text):
+    """Error text with the query string cut from any URL in it."""
+    return _URL_QUERY.sub(r"\1?<redacted>", str(text))
+
+
+def results_for(batch, value):
+    """Same result (usually an exception) for every segment in the batch."""
+    return {segment.pk: value for segment, _, _ in batch.cells}
+
+
+def _coord(lat, lon):
+    return f"{lat},{lon}"
+
+
+class Batch:
+    """
+    One Distance Matrix request: distinct origins/destinations plus, for each
+    segment, the (row, column) of the element that answers it.
+    """
+
+    def __init__(self):
+        self.origins = []
+        self.destinations = []
+        self._origin_idx = {}
+        self._dest_idx = {}
+        self.cells = []  # [(segment, origin_i, dest_i), ...]
+
+    def fits(self, origin, destination, max_elements):
+        n_o = len(self.origins) + (origin not in self._origin_idx)
+        n_d = len(self.destinations) + (destination not in self._dest_idx)
+        return n_o <= MAX_ORIGINS and n_d <= MAX_DESTINATIONS and n_o * n_d <= max_elements
+
+    def add(self, segment, origin, destination):
+        if origin not in self._origin_idx:
+            self._origin_idx[origin] = len(self.origins)
+            self.origins.append(origin)
+        if destination not in self._dest_idx:
+            self._dest_idx[destination] = len(self.destinations)
+            self.destinations.append(destination)
+        self.cells.append((segment, self._origin_idx[origin], self._dest_idx[destination]))
+
+    @property
+    def elements(self):
+        return len(self.origins) * len(self.destinations)
+
+    def __len__(self):
+        return len(self.cells)
+
+
+def _line_batches(items, max_elements):
+    """Pack (origin, destination, segment) items sharing one endpoint into requests."""
+    batches = []
+    current = Batch()
+    for origin, destination, segment in items:
+        if current.cells and not current.fits(origin, destination, max_elements):
+            batches.append(current)
+            current = Batch()
+        current.add(segment, origin, destination)
+    if current.cells:
+        batches.append(current)
+    return batches
+
+
+def plan_batches(segments, max_elements=None):
+    """
+    Group segments into requests that bill one element per segment.
+
+    Google bills every origin x destination cell of a request, so a request
+    only ever holds segments sharing an origin (1 x N) or sharing a
+    destination (N x 1); mixing unrelated segments into an N x N grid would
+    pay for N*N cells and use only N of them. Segments with neither endpoint
+    in common with another go one per request. Contiguous segments of a
+    route (end of one == start of the next) share neither, so they do not
+    combine. DISTANCE_MATRIX_MAX_ELEMENTS caps the segments per request.
+    """
+    if max_elements is None:
+        max_elements = getattr(settings, "DISTANCE_MATRIX_MAX_ELEMENTS", MAX_ELEMENTS)
+    max_elements = max(1, min(int(max_elements), MAX_ELEMENTS))
+
+    keyed = sorted(
+        ((_coord(s.start_lat, s.start_lon), _coord(s.end_lat, s.end_lon), s) for s in segments),
+        key=lambda t: (t[0], t[1], t[2].pk or 0),
+    )
+
+    # Rows: origins with several destinations
+    by_origin = {}
+    for item in keyed:
+        by_origin.setdefault(item[0], []).append(item)
+    batches, rest = [], []
+    for items in by_origin.values():
+        if len({destination for _, destination, _ in items}) > 1:
+            batches += _line_batches(items, max_elements)
+        else:
+            rest += items
+
+    # Columns: what's left, by destination (a lone segment is a 1 x 1 column)
+    by_destination = {}
+    for item in rest:
+        by_destination.setdefault(item[1], []).append(item)
+    for items in by_destination.values():
+        batches += _line_batches(items, max_elements)
+    return batches
+
+
+def build_url(origins, destinations, api_key):
+    # DISTANCE_MATRIX_URL can point at all_roads/fake_distance_matrix.py offline
+    base = getattr(settings, "DISTANCE_MATRIX_URL", "") or DISTANCE_MATRIX_URL
+    return (
+        f"{base}"
+        f"?origins={'|'.join(origins)}&destinations={'|'.join(destinations)}"
+        f"&mode=driving&units=metric&key={api_key}"
+    )
+
+
+def parse_element(el, origin_addr, dest_addr):
+    """
+    Turn one OK matrix element into the values stored on a Segment.
+    Raises ValueError for non-OK elements.
+    """
+    if el.get("status") != "OK":
+        raise ValueError(f"Element status: {el.get('status')}")
+
+    dist_km = round(el["distance"]["value"] / 1000, 2)
+    dur_s = int(el["duration"]["value"])
+    speed = round(dist_km / (dur_s / 3600), 1) if dur_s > 0 else 0.0
+
+    return {
+        "distance": Decimal(str(dist_km)),
+        "travel_time": dur_s,
+        "avg_speed": Decimal(str(speed)),
+        "status": get_status_color(speed),
+        "origin_address": origin_addr,
+        "destination_address": dest_addr,
+    }
+
+
+def map_response(batch, data):
+    """
+    Map a decoded Distance Matrix response back to the batch's segments.
+    Returns { segment.pk: result_dict | Exception }.
+    """
+    if data.get("status") in THROTTLE_STATUSES:
+        return results_for(batch, ThrottledError(f"API status: {data.get('status')}"))
+    if data.get("status") != "OK":
+        return results_for(batch, ValueError(f"Bad API status: {data.get('status')}"))
+
+    out = {}
+    for segment, oi, di in batch.cells:
+        try:
+            el = data["rows"][oi]["elements"][di]
+            out[segment.pk] = parse_element(
+                el, data["origin_addresses"][oi], data["destination_addresses"][di]
+            )
+        except Exception as e:
+            out[segment.pk] = e
+    return out
+
+
+def fetch_batch(batch, api_key, timeout=10):
+    """
+    Run one batch against the API. Transport/HTTP errors fail every segment
+    in the batch; element errors only fail their own segment. Throttling
+    (429, 5xx after retries, connection failures, quota statuses) comes back
+    as ThrottledError so callers can back off and retry instead.
+
+    Error messages never include the request URL, which carries the key:
+    HTTP errors are reported by status code and transport errors redacted.
+    """
+    try:
+        with metrics.timed("http_fetch", len(batch)):
+            r = http_client.get(build_url(batch.origins, batch.destinations, api_key), timeout=timeout)
+        if r.status_code == 429 or r.status_code >= 500:
+            return results_for(batch, ThrottledError(f"HTTP {r.status_code}"))
+        if r.status_code >= 400:
+            return results_for(batch, ValueError(f"HTTP {r.status_code}"))
+        with metrics.timed("json_decode", len(batch)):
+            data = r.json()
+    except (requests.ConnectionError, requests.Timeout) as e:
+        return results_for(batch, ThrottledError(redact(e)))
+    except requests.RequestException as e:
+        return results_for(batch, type(e)(redact(e)))
+    except ValueError as e:
+        return results_for(batch, e)
+    return map_response(batch, data)
+
+
+def coord_key(segment):
+    """Normalised (start_lat, start_lon, end_lat, end_lon) cache key."""
+    return "dm:" + ",".join(
+        f"{float(v):.5f}" for v in (segment.start_lat, segment.start_lon, segment.end_lat, segment.end_lon)
+    )
+
+
+class ResponseCache:
+    """
+    TTL cache of parsed per-segment results keyed by coordinate pair, so
+    segments with identical endpoints (or refreshed a few minutes ago) skip
+    the API. In-process LRU first, then Redis when configured.
+    """
+
+    def __init__(self, ttl=None, maxsize=None):
+        if ttl is None:
+            ttl = getattr(settings, "RESPONSE_CACHE_TTL", 300)
+        if maxsize is None:
+            maxsize = getattr(settings, "RESPONSE_CACHE_SIZE", 20000)
+        self.ttl = int(ttl)
+        self.local = LRUCache(maxsize, ttl=self.ttl)
+
+    @property
+    def enabled(self):
+        return self.ttl > 0
+
+    def get(self, segment):
+        if not self.enabled:
+            return None
+        key = coord_key(segment)
+        result = self.local.get(key)
+        if result is not None:
+            return result
+        client = get_redis()
+        if client is None:
+            return None
+        try:
+            raw = client.get(key)
+        except Exception as e:
+            logger.warning("Response cache read failed: %s", e)
+            return None
+        if raw is None:
+            return None
+        result = json.loads(raw)
+        result["distance"] = Decimal(result["distance"])
+        result["avg_speed"] = Decimal(result["avg_speed"])
+        self.local.set(key, result)
+        return result
+
+    def set(self, segment, result):
+        if not self.enabled:
+            return
+        key = coord_key(segment)
+        self.local.set(key, result)
+        client = get_redis()
+        if client is None:
+            return
+        try:
+            client.setex(key, self.ttl, json.dumps(result, default=str))
+        except Exception as e:
+            logger.warning("Response cache write failed: %s", e)
+
+
+_response_cache = None
+
+
+def get_response_cache():
+    global _response_cache
+    if _response_cache is None:
+        _response_cache = ResponseCache()
+    return _response_cache
@@ -0,0 +1,158 @@
+# all_roads/fake_distance_matrix.py
+"""
+Offline stand-in for the Google Distance Matrix API, for benchmarks and
+local runs without a key or quota. Point DISTANCE_MATRIX_URL at it:
+
+    python manage.py fake_distance_matrix --port 8765 --latency 0.15 --error-rate 0.02
+    DISTANCE_MATRIX_URL=http://127.0.0.1:8765/maps/api/distancematrix/json
+
+Answers are deterministic per coordinate pair: haversine distance times a
+road factor, and a speed derived from the coordinates. Latency, element
+errors and throttling (HTTP 429 / OVER_QUERY_LIMIT, or a QPS ceiling) are
+configurable.
+"""
+import json
+import math
+import random
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from all_roads.throttle import TokenBucket
+
+PATH = "/maps/api/distancematrix/json"
+ROAD_FACTOR = 1.3
+
+
+def _parse_coord(value):
+    lat, lng = value.split(",")
+    return float(lat), float(lng)
+
+
+def _haversine_m(a, b):
+    lat1, lon1, lat2, lon2 = map(math.radians, (a[0], a[1], b[0], b[1]))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return 2 * 6371000 * math.asin(math.sqrt(h))
+
+
+def element_for(origin, destination):
+    """OK element for one origin/destination pair ("lat,lng" strings)."""
+    meters = max(1, int(_haversine_m(_parse_coord(origin), _parse_coord(destination)) * ROAD_FACTOR))
+    speed_kmh = 15 + zlib.crc32(f"{origin}|{destination}".encode()) % 76  # 15..90
+    return {
+        "status": "OK",
+        "distance": {"value": meters, "text": f"{meters / 1000:.1f} km"},
+        "duration": {"value": max(1, int(meters / (speed_kmh / 3.6))), "text": ""},
+    }
+
+
+def address_for(coord):
+    return f"Fake stop {coord}"
+
+
+class FakeDistanceMatrix:
+    """Behaviour knobs and counters shared by the request handler threads."""
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, throttle_rate=0.0, qps=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.bucket = TokenBucket(qps) if qps else None
+        self.random = random.Random(seed)
+        self.stats = {"requests": 0, "elements": 0, "throttled": 0, "element_errors": 0}
+        self._lock = threading.Lock()
+
+    def _count(self, **deltas):
+        with self._lock:
+            for key, n in deltas.items():
+                self.stats[key] += n
+
+    def _roll(self, rate):
+        with self._lock:
+            return rate > 0 and self.random.random() < rate
+
+    def respond(self, query):
+        """(http_status, payload) for one request's parsed query string."""
+        self._count(requests=1)
+        delay = self.latency + (self.random.uniform(-self.jitter, self.jitter) if self.jitter else 0.0)
+        if delay > 0:
+            time.sleep(delay)
+
+        if self.bucket is not None and self.bucket.reserve() > 0:
+            self._count(throttled=1)
+            return 429, {"status": "OVER_QUERY_LIMIT", "rows": []}
+        if self._roll(self.throttle_rate):
+            self._count(throttled=1)
+            return 200, {"status": "OVER_QUERY_LIMIT", "rows": []}
+
+        try:
+            origins = query["origins"][0].split("|")
+            destinations = query["destinations"][0].split("|")
+            rows = []
+            for o in origins:
+                elements = []
+                for d in destinations:
+                    if self._roll(self.error_rate):
+                        self._count(element_errors=1)
+                        elements.append({"status": "ZERO_RESULTS"})
+                    else:
+                        elements.append(element_for(o, d))
+                rows.append({"elements": elements})
+        except (KeyError, ValueError):
+            return 200, {"status": "INVALID_REQUEST", "rows": []}
+
+        self._count(elements=len(origins) * len(destinations))
+        return 200, {
+            "status": "OK",
+            "origin_addresses": [address_for(o) for o in origins],
+            "destination_addresses": [address_for(d) for d in destinations],
+            "rows": rows,
+        }
+
+
+def _handler_for(fake):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, like the real API
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != PATH:
+                code, payload = 404, {"status": "NOT_FOUND"}
+            else:
+                code, payload = fake.respond(parse_qs(url.query))
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def make_server(host="127.0.0.1", port=0, **options):
+    """
+    Build (not start) a threaded fake server; port=0 picks a free port.
+    The FakeDistanceMatrix is available as server.fake, and server.url is
+    the value to use for DISTANCE_MATRIX_URL.
+    """
+    fake = FakeDistanceMatrix(**options)
+    server = ThreadingHTTPServer((host, port), _handler_for(fake))
+    server.daemon_threads = True
+    server.fake = fake
+    server.url = f"http://{server.server_address[0]}:{server.server_address[1]}{PATH}"
+    return server
+
+
+def start_in_thread(host="127.0.0.1", port=0, **options):
+    """Start a fake server on a daemon thread; stop it with server.shutdown()."""
+    server = make_server(host, port, **options)
+    threading.Thread(target=server.serve_forever, name="fake-distance-matrix", daemon=True).start()
+    return server
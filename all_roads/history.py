@@ -0,0 +1,252 @@
+# all_roads/history.py
+"""
+Traffic history: SegmentObservation rows appended by every refresh, rolled
+up into hourly and daily SegmentTrafficRollup rows, and pruned per period:
+
+    raw observations  OBSERVATION_RETENTION_DAYS       (only once rolled up)
+    hourly rollups    OBSERVATION_HOURLY_RETENTION_DAYS
+    daily rollups     OBSERVATION_DAILY_RETENTION_DAYS
+
+Rollups are recomputed for whole buckets (delete + insert in one
+transaction), so re-running a window is safe.
+"""
+from datetime import timedelta
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Avg, Count, Max, Min, Sum, F
+from django.db.models.functions import TruncDay, TruncHour
+from django.utils import timezone
+
+from all_roads.models import SegmentObservation, SegmentTrafficRollup
+from all_roads.utils import chunked
+
+HOUR = SegmentTrafficRollup.HOUR
+DAY = SegmentTrafficRollup.DAY
+STEPS = {HOUR: timedelta(hours=1), DAY: timedelta(days=1)}
+
+
+def record_observations(segments):
+    """Append one observation per freshly refreshed segment (one INSERT per 1000)."""
+    if not getattr(settings, "REFRESH_RECORD_OBSERVATIONS", True):
+        return 0
+    rows = [
+        SegmentObservation(
+            segment_id=s.pk,
+            observed_at=s.last_refreshed_at,
+            travel_time=s.travel_time,
+            avg_speed_tenths=min(int(Decimal(s.avg_speed) * 10), 32767),
+            status=s.status,
+        )
+        for s in segments
+    ]
+    SegmentObservation.objects.bulk_create(rows, batch_size=1000)
+    return len(rows)
+
+
+def _bucket_start(period, when):
+    """Start of the (local time) hour/day containing `when`."""
+    when = timezone.localtime(when)
+    if period == DAY:
+        return when.replace(hour=0, minute=0, second=0, microsecond=0)
+    return when.replace(minute=0, second=0, microsecond=0)
+
+
+def _last_bucket(period):
+    return (
+        SegmentTrafficRollup.objects.filter(period=period)
+        .order_by("-bucket_start").values_list("bucket_start", flat=True).first()
+    )
+
+
+def _next_window(period, max_buckets):
+    """[start, end) of complete buckets not rolled up yet, or None."""
+    step = STEPS[period]
+    end = _bucket_start(period, timezone.now())
+    if period == DAY:
+        # Only days whose hours have all been rolled up
+        last_hour = _last_bucket(HOUR)
+        if last_hour is None:
+            return None
+        end = min(end, _bucket_start(DAY, last_hour + STEPS[HOUR]))
+
+    # Start at the first source row after the last rollup, skipping gaps
+    if period == HOUR:
+        source, field = SegmentObservation.objects.all(), "observed_at"
+    else:
+        source, field = SegmentTrafficRollup.objects.filter(period=HOUR), "bucket_start"
+    last = _last_bucket(period)
+    if last is not None:
+        source = source.filter(**{f"{field}__gte": last + step})
+    first = source.order_by(field).values_list(field, flat=True).first()
+    if first is None:
+        return None
+    start = _bucket_start(period, first)
+    end = min(end, start + step * max_buckets)
+    return (start, end) if start < end else None
+
+
+def _hourly_rows(start, end):
+    return (
+        SegmentObservation.objects
+        .filter(observed_at__gte=start, observed_at__lt=end)
+        .annotate(bucket=TruncHour("observed_at"))
+        .values("segment_id", "bucket")
+        .annotate(
+            n=Count("id"),
+            avg_tt=Avg("travel_time"), min_tt=Min("travel_time"), max_tt=Max("travel_time"),
+            avg_sp=Avg("avg_speed_tenths"), min_sp=Min("avg_speed_tenths"),
+        )
+    )
+
+
+def _daily_rows(start, end):
+    # Weighted by samples so a busy hour counts for more than a quiet one
+    return (
+        SegmentTrafficRollup.objects
+        .filter(period=HOUR, bucket_start__gte=start, bucket_start__lt=end)
+        .annotate(bucket=TruncDay("bucket_start"))
+        .values("segment_id", "bucket")
+        .annotate(
+            n=Sum("samples"),
+            tt_total=Sum(F("avg_travel_time") * F("samples")),
+            min_tt=Min("min_travel_time"), max_tt=Max("max_travel_time"),
+            sp_total=Sum(F("avg_speed") * F("samples")),
+            min_sp=Min("min_speed"),
+        )
+    )
+
+
+def _rollup_from(period, row):
+    if period == HOUR:
+        avg_tt, avg_sp = row["avg_tt"], Decimal(row["avg_sp"]) / 10
+        min_sp = Decimal(row["min_sp"]) / 10
+    else:
+        avg_tt = row["tt_total"] / row["n"]
+        avg_sp, min_sp = Decimal(row["sp_total"]) / row["n"], row["min_sp"]
+    return SegmentTrafficRollup(
+        segment_id=row["segment_id"], period=period, bucket_start=row["bucket"],
+        samples=row["n"], avg_travel_time=round(avg_tt),
+        min_travel_time=row["min_tt"], max_travel_time=row["max_tt"],
+        avg_speed=round(Decimal(avg_sp), 1), min_speed=round(Decimal(min_sp), 1),
+    )
+
+
+def rollup(period, max_buckets=48):
+    """
+    Aggregate the next complete, not yet rolled up buckets of `period`
+    ("h" from observations, "d" from hourly rollups), at most `max_buckets`
+    per call. Returns {"period", "start", "end", "rows"}.
+    """
+    window = _next_window(period, max_buckets)
+    if window is None:
+        return {"period": period, "rows": 0}
+    start, end = window
+    rows = _hourly_rows(start, end) if period == HOUR else _daily_rows(start, end)
+    written = 0
+    with transaction.atomic():
+        SegmentTrafficRollup.objects.filter(
+            period=period, bucket_start__gte=start, bucket_start__lt=end,
+        ).delete()
+        for part in chunked(rows.iterator(), 1000):
+            SegmentTrafficRollup.objects.bulk_create([_rollup_from(period, r) for r in part])
+            written += len(part)
+    return {"period": period, "start": start.isoformat(), "end": end.isoformat(), "rows": written}
+
+
+def rollup_observations():
+    """Hourly rollups first, then the daily ones built from them."""
+    return {"hourly": rollup(HOUR), "daily": rollup(DAY)}
+
+
+def _delete_in_batches(qs, batch_size=10000):
+    deleted = 0
+    while True:
+        ids = list(qs.values_list("pk", flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += qs.model.objects.filter(pk__in=ids).delete()[0]
+
+
+def prune_history(now=None):
+    """
+    Drop history past its retention. Raw observations are only dropped up to
+    the last hourly rollup, so nothing is lost before it is aggregated.
+    Deletes in batches to keep transactions (and locks) short.
+    """
+    now = now or timezone.now()
+    raw_cutoff = now - timedelta(days=getattr(settings, "OBSERVATION_RETENTION_DAYS", 14))
+    last_hour = _last_bucket(HOUR)
+    rolled_until = last_hour + timedelta(hours=1) if last_hour else None
+    raw_cutoff = min(raw_cutoff, rolled_until) if rolled_until else None
+
+    hourly_cutoff = now - timedelta(days=getattr(settings, "OBSERVATION_HOURLY_RETENTION_DAYS", 90))
+    daily_cutoff = now - timedelta(days=getattr(settings, "OBSERVATION_DAILY_RETENTION_DAYS", 730))
+    return {
+        "observations": _delete_in_batches(
+            SegmentObservation.objects.filter(observed_at__lt=raw_cutoff)
+        ) if raw_cutoff else 0,
+        "hourly": _delete_in_batches(
+            SegmentTrafficRollup.objects.filter(period=HOUR, bucket_start__lt=hourly_cutoff)
+        ),
+        "daily": _delete_in_batches(
+            SegmentTrafficRollup.objects.filter(period=DAY, bucket_start__lt=daily_cutoff)
+        ),
+    }
+
+
+HISTORY_LIMIT = 5000
+
+
+def segment_history(segment, resolution=HOUR, since=None, until=None):
+    """
+    Time series for one segment, oldest first: raw observations
+    (resolution="raw") or hourly/daily rollups. Defaults to the last 7 days.
+    """
+    until = until or timezone.now()
+    since = since or until - timedelta(days=7)
+    if resolution == "raw":
+        rows = (
+            SegmentObservation.objects
+            .filter(segment=segment, observed_at__gte=since, observed_at__lt=until)
+            .order_by("observed_at")
+            .values("observed_at", "travel_time", "avg_speed_tenths", "status")[:HISTORY_LIMIT]
+        )
+        return [
+            {
+                "at": r["observed_at"], "travel_time": r["travel_time"],
+                "avg_speed": Decimal(r["avg_speed_tenths"]) / 10, "status": r["status"],
+            }
+            for r in rows
+        ]
+    return list(
+        SegmentTrafficRollup.objects
+        .filter(segment=segment, period=resolution, bucket_start__gte=since, bucket_start__lt=until)
+        .order_by("bucket_start")
+        .values(
+            "bucket_start", "samples", "avg_travel_time", "min_travel_time", "max_travel_time",
+            "avg_speed", "min_speed",
+        )[:HISTORY_LIMIT]
+    )
+
+
+def route_history(route, resolution=HOUR, since=None, until=None):
+    """
+    Route-level series from the rollups: summed segment travel times and
+    the mean segment speed per bucket. Defaults to the last 7 days.
+    """
+    until = until or timezone.now()
+    since = since or until - timedelta(days=7)
+    return list(
+        SegmentTrafficRollup.objects
+        .filter(segment__route=route, period=resolution, bucket_start__gte=since, bucket_start__lt=until)
+        .values("bucket_start")
+        .annotate(
+            segments=Count("segment_id"),
+            travel_time=Sum("avg_travel_time"),
+            avg_speed=Avg("avg_speed"),
+            min_speed=Min("min_speed"),
+        )
+        .order_by("bucket_start")[:HISTORY_LIMIT]
+    )
@@ -0,0 +1,65 @@
+# all_roads/http_client.py
+"""
+Shared HTTP client for Google calls: one keep-alive session per worker
+process, a bounded connection pool, retries with backoff for 5xx and
+connection resets. Call timing is recorded by the caller (metrics'
+http_fetch stage) and logged here at DEBUG.
+"""
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_session = None
+_session_pid = None
+
+
+def _build_session():
+    pool_size = getattr(settings, "HTTP_POOL_SIZE", 16)
+    retry = Retry(
+        total=getattr(settings, "HTTP_MAX_RETRIES", 3),
+        connect=getattr(settings, "HTTP_MAX_RETRIES", 3),
+        read=getattr(settings, "HTTP_MAX_RETRIES", 3),
+        status=getattr(settings, "HTTP_MAX_RETRIES", 3),
+        backoff_factor=getattr(settings, "HTTP_BACKOFF_FACTOR", 0.5),
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(["GET"]),
+        raise_on_status=False,  # the caller decides from status_code
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session():
+    """
+    Return this process's pooled session. Celery prefork children get their
+    own session instead of sharing sockets inherited from the parent.
+    """
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is None or _session_pid != pid:
+        with _lock:
+            if _session is None or _session_pid != pid:
+                _session = _build_session()
+                _session_pid = pid
+    return _session
+
+
+def get(url, timeout=10, **kwargs):
+    """Timed GET through the pooled session."""
+    started = time.perf_counter()
+    try:
+        return get_session().get(url, timeout=timeout, **kwargs)
+    finally:
+        logger.debug("GET %s took %.3fs", url.split("?", 1)[0], time.perf_counter() - started)
@@ -0,0 +1,269 @@
+# all_roads/inflight.py
+"""
+Registry of refresh work that is queued or running, kept in Redis so every
+web and Celery process sees the same picture:
+
+- inflight:task:<id>   set of segment codes a queued/running task covers
+                       ("*" = the whole network), expires after REFRESH_INFLIGHT_TTL
+- inflight:tasks       set of those task ids
+- inflight:seg:<pk>    per-segment lock held by the refresh run writing it
+
+queue_refresh uses it to hand back an existing task id when the requested
+codes are already covered and to enqueue only the uncovered remainder.
+Registrations whose Celery result is ready (finished, failed, or a chord
+whose callback never ran) are dropped the next time the registry is read.
+
+Without Redis (or redis-py) an in-process InMemoryRedis stands in. Workers
+can't see it, so such a registry is not `shared`: plan() never coalesces
+and queue timing is not recorded.
+"""
+import logging
+import threading
+import time
+import uuid
+
+from celery.result import AsyncResult
+from django.conf import settings
+
+try:
+    import redis
+except Exception:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+ALL = "*"
+TASKS_KEY = "inflight:tasks"
+QUEUE_LOCK_KEY = "inflight:queue-lock"
+
+
+def _task_key(task_id):
+    return f"inflight:task:{task_id}"
+
+
+def _segment_key(pk):
+    return f"inflight:seg:{pk}"
+
+
+class InMemoryRedis:
+    """The handful of Redis commands the registry needs, in one process."""
+
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+        self._lock = threading.RLock()
+
+    def _alive(self, key):
+        exp = self._expires.get(key)
+        if exp is not None and exp <= time.monotonic():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    def set(self, key, value, nx=False, ex=None):
+        with self._lock:
+            if nx and self._alive(key):
+                return None
+            self._data[key] = value
+            if ex:
+                self._expires[key] = time.monotonic() + ex
+            else:
+                self._expires.pop(key, None)
+            return True
+
+    def get(self, key):
+        with self._lock:
+            return self._data.get(key) if self._alive(key) else None
+
+    def delete(self, *keys):
+        with self._lock:
+            n = 0
+            for key in keys:
+                if self._alive(key):
+                    n += 1
+                self._data.pop(key, None)
+                self._expires.pop(key, None)
+            return n
+
+    def exists(self, key):
+        with self._lock:
+            return int(self._alive(key))
+
+    def expire(self, key, seconds):
+        with self._lock:
+            if not self._alive(key):
+                return False
+            self._expires[key] = time.monotonic() + seconds
+            return True
+
+    def sadd(self, key, *members):
+        with self._lock:
+            current = self._data.get(key) if self._alive(key) else None
+            if current is None:
+                current = self._data[key] = set()
+            before = len(current)
+            current.update(members)
+            return len(current) - before
+
+    def srem(self, key, *members):
+        with self._lock:
+            current = self._data.get(key) if self._alive(key) else set()
+            before = len(current)
+            current.difference_update(members)
+            return before - len(current)
+
+    def smembers(self, key):
+        with self._lock:
+            return set(self._data.get(key, ())) if self._alive(key) else set()
+
+    def pipeline(self, transaction=False):
+        return _InMemoryPipeline(self)
+
+
+class _InMemoryPipeline:
+    def __init__(self, client):
+        self._client = client
+        self._calls = []
+
+    def __getattr__(self, name):
+        def queue(*args, **kwargs):
+            self._calls.append((name, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return [getattr(self._client, name)(*args, **kwargs) for name, args, kwargs in calls]
+
+
+class InflightRegistry:
+    def __init__(self, client, ttl=None, lock_ttl=None, shared=True):
+        self.client = client
+        self.shared = shared
+        self.ttl = int(ttl if ttl is not None else getattr(settings, "REFRESH_INFLIGHT_TTL", 3600))
+        self.lock_ttl = int(lock_ttl if lock_ttl is not None else getattr(settings, "REFRESH_SEGMENT_LOCK_TTL", 600))
+
+    # --- task coalescing -------------------------------------------------
+
+    def _active(self):
+        """{task_id: set(codes)} for registrations of tasks still queued or running."""
+        active = {}
+        for task_id in self.client.smembers(TASKS_KEY):
+            codes = self.client.smembers(_task_key(task_id))
+            if codes and not _task_finished(task_id):
+                active[task_id] = codes
+            else:
+                self.release(task_id)
+        return active
+
+    def plan(self, codes=None):
+        """
+        Decide what a new request for `codes` (None = whole network) needs.
+        Returns (task_id, remaining_codes): remaining_codes lists what still
+        has to be enqueued (None for a whole-network request, [] when nothing
+        is left); task_id is a queued/running task that already covers the
+        rest of the request, if any.
+        """
+        if not self.shared:
+            return None, (None if codes is None else sorted(set(codes)))
+        active = self._active()
+        for task_id, covered in active.items():
+            if ALL in covered:
+                return task_id, []
+        if codes is None:
+            return None, None
+        remaining = set(codes)
+        contributor = None
+        for task_id, covered in active.items():
+            if remaining & covered:
+                contributor = task_id
+                remaining -= covered
+            if not remaining:
+                return contributor, []
+        return contributor, sorted(remaining)
+
+    def register(self, task_id, codes=None):
+        key = _task_key(task_id)
+        pipe = self.client.pipeline()
+        pipe.sadd(key, *(codes or [ALL]))
+        pipe.expire(key, self.ttl)
+        pipe.sadd(TASKS_KEY, task_id)
+        pipe.execute()
+
+    def release(self, task_id):
+        pipe = self.client.pipeline()
+        pipe.delete(_task_key(task_id))
+        pipe.srem(TASKS_KEY, task_id)
+        pipe.execute()
+
+    def queue_lock(self, timeout=5.0):
+        """Short mutex so two requests can't both plan the same work."""
+        return _RedisMutex(self.client, QUEUE_LOCK_KEY, timeout)
+
+    # --- per-segment locks -----------------------------------------------
+
+    def lock_segments(self, pks, owner):
+        """Try to lock each segment for `owner`; return the pks acquired."""
+        pks = list(pks)
+        pipe = self.client.pipeline()
+        for pk in pks:
+            pipe.set(_segment_key(pk), owner, nx=True, ex=self.lock_ttl)
+        return [pk for pk, ok in zip(pks, pipe.execute()) if ok]
+
+    def unlock_segments(self, pks, owner):
+        pks = list(pks)
+        if not pks:
+            return
+        pipe = self.client.pipeline()
+        for pk in pks:
+            pipe.get(_segment_key(pk))
+        mine = [pk for pk, value in zip(pks, pipe.execute()) if value == owner]
+        if mine:
+            self.client.delete(*(_segment_key(pk) for pk in mine))
+
+
+def _task_finished(task_id):
+    """True once Celery has a final state for the task (unknown ids count as running)."""
+    try:
+        return AsyncResult(task_id).ready()
+    except Exception as e:
+        logger.debug("Could not read state of %s: %s", task_id, e)
+        return False
+
+
+class _RedisMutex:
+    def __init__(self, client, key, timeout):
+        self.client = client
+        self.key = key
+        self.timeout = timeout
+        self.token = uuid.uuid4().hex
+
+    def __enter__(self):
+        deadline = time.monotonic() + self.timeout
+        while not self.client.set(self.key, self.token, nx=True, ex=max(1, int(self.timeout))):
+            if time.monotonic() >= deadline:
+                break  # proceed without the lock rather than fail the request
+            time.sleep(0.05)
+        return self
+
+    def __exit__(self, *exc):
+        if self.client.get(self.key) == self.token:
+            self.client.delete(self.key)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+
+def get_registry():
+    """Process-wide registry on REFRESH_INFLIGHT_REDIS_URL, or an unshared in-memory one."""
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                url = getattr(settings, "REFRESH_INFLIGHT_REDIS_URL", "")
+                if url.startswith(("redis://", "rediss://", "unix://")) and redis is not None:
+                    _registry = InflightRegistry(redis.Redis.from_url(url, decode_responses=True))
+                else:
+                    _registry = InflightRegistry(InMemoryRedis(), shared=False)
+    return _registry
@@ -0,0 +1,80 @@
+# all_roads/management/commands/benchmark_refresh.py
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from all_roads.benchmark import run_benchmark
+from all_roads.services import REFRESH_MODES
+
+COLUMNS = (
+    ("mode", "mode"),
+    ("segments", "segs"),
+    ("updated", "ok"),
+    ("failed", "fail"),
+    ("deferred", "defer"),
+    ("seconds", "secs"),
+    ("segments_per_sec", "segs/s"),
+    ("latency_p50_ms", "p50 ms"),
+    ("latency_p99_ms", "p99 ms"),
+    ("db_queries_per_segment", "q/seg"),
+    ("api_calls_per_segment", "calls/seg"),
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed N synthetic segments, refresh them against an in-process fake "
+        "Distance Matrix in each mode, and report throughput and cost per segment. "
+        "Runs in a throwaway test database (created and dropped like `manage.py test` "
+        "does) unless --use-configured-db is given."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--segments", type=int, default=1000)
+        parser.add_argument("--modes", default=",".join(REFRESH_MODES), help="Comma separated.")
+        parser.add_argument("--latency", type=float, default=0.1, help="Fake API seconds per request.")
+        parser.add_argument("--jitter", type=float, default=0.02)
+        parser.add_argument("--error-rate", type=float, default=0.0)
+        parser.add_argument("--throttle-rate", type=float, default=0.0)
+        parser.add_argument("--qps", type=float, default=0.0, help="Fake API 429s above this rate (0 = no cap).")
+        parser.add_argument("--rate-limit", type=float, default=None, help="Override REFRESH_RATE_LIMIT.")
+        parser.add_argument("--concurrency", type=int, default=None, help="Override REFRESH_CONCURRENCY.")
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--use-configured-db", action="store_true",
+            help="Write benchmark rows to the configured database instead of a throwaway one.",
+        )
+        parser.add_argument("--keep", action="store_true", help="Leave the benchmark segments in place (with --use-configured-db).")
+        parser.add_argument("--json", action="store_true", help="Print results as JSON.")
+
+    def handle(self, *args, **opts):
+        modes = [m.strip() for m in opts["modes"].split(",") if m.strip()]
+        unknown = set(modes) - set(REFRESH_MODES)
+        if unknown:
+            raise CommandError(f"Unknown mode(s): {', '.join(sorted(unknown))}")
+        if opts["segments"] < 1:
+            raise CommandError("--segments must be at least 1")
+
+        throwaway = not opts["use_configured_db"]
+        if throwaway:
+            old_name = connection.settings_dict["NAME"]
+            connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        try:
+            results = run_benchmark(
+                opts["segments"], modes=modes, seed=opts["seed"], keep=opts["keep"],
+                rate_limit=opts["rate_limit"], concurrency=opts["concurrency"],
+                latency=opts["latency"], jitter=opts["jitter"], error_rate=opts["error_rate"],
+                throttle_rate=opts["throttle_rate"], qps=opts["qps"],
+            )
+        finally:
+            if throwaway:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        if opts["json"]:
+            self.stdout.write(json.dumps(results, indent=2))
+            return
+        widths = [max(len(title), *(len(str(r[key])) for r in results)) for key, title in COLUMNS]
+        self.stdout.write("  ".join(title.rjust(w) for (_, title), w in zip(COLUMNS, widths)))
+        for r in results:
+            self.stdout.write("  ".join(str(r[key]).rjust(w) for (key, _), w in zip(COLUMNS, widths)))
@@ -0,0 +1,34 @@
+# all_roads/management/commands/fake_distance_matrix.py
+from django.core.management.base import BaseCommand
+
+from all_roads.fake_distance_matrix import make_server
+
+
+class Command(BaseCommand):
+    help = "Serve an offline fake Google Distance Matrix API (see all_roads/fake_distance_matrix.py)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=8765)
+        parser.add_argument("--latency", type=float, default=0.1, help="Seconds per request.")
+        parser.add_argument("--jitter", type=float, default=0.0, help="+/- seconds around --latency.")
+        parser.add_argument("--error-rate", type=float, default=0.0, help="Share of elements returned as ZERO_RESULTS.")
+        parser.add_argument("--throttle-rate", type=float, default=0.0, help="Share of requests answered OVER_QUERY_LIMIT.")
+        parser.add_argument("--qps", type=float, default=0.0, help="Answer HTTP 429 above this many requests/sec (0 = no cap).")
+        parser.add_argument("--seed", type=int, default=None)
+
+    def handle(self, *args, **opts):
+        server = make_server(
+            opts["host"], opts["port"], latency=opts["latency"], jitter=opts["jitter"],
+            error_rate=opts["error_rate"], throttle_rate=opts["throttle_rate"],
+            qps=opts["qps"], seed=opts["seed"],
+        )
+        self.stdout.write(f"Fake Distance Matrix on {server.url}")
+        self.stdout.write(f"Set DISTANCE_MATRIX_URL={server.url} to use it. Ctrl-C to stop.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.stdout.write(f"Served: {server.fake.stats}")
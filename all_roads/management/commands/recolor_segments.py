@@ -0,0 +1,22 @@
+# all_roads/management/commands/recolor_segments.py
+from django.core.management.base import BaseCommand
+
+from all_roads.services import recolor_segments
+from all_roads.utils import status_thresholds
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute Segment.status from the stored average speeds with the current "
+        "SPEED_STATUS_THRESHOLDS in a single UPDATE (no Google calls)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dry-run", action="store_true", help="Only count the segments that would change.")
+
+    def handle(self, *args, **opts):
+        for bound, color in status_thresholds():
+            self.stdout.write(f"  < {bound:g} km/h -> {color}")
+        changed = recolor_segments(dry_run=opts["dry_run"])
+        verb = "would change" if opts["dry_run"] else "changed"
+        self.stdout.write(self.style.SUCCESS(f"{changed} segment(s) {verb}."))
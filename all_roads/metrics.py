@@ -0,0 +1,276 @@
+# all_roads/metrics.py
+"""
+Timing histograms for the refresh hot path.
+
+Stages are recorded per segment: a batch's HTTP fetch or a chunk's DB write
+is observed once with weight = segments it covered, so every histogram's
+count is segments and its sum is seconds spent in that stage.
+
+- http_fetch          Distance Matrix request, incl. pool wait and retries
+- json_decode         response.json()
+- address_resolution  AddressResolver.resolve_many for the chunk
+- db_write            bulk_update (+ checkpoint) transaction for the chunk
+
+Observations go to the process-wide recorder (exported from /metrics; with
+METRICS_REDIS_URL set, workers push their deltas to Redis after every chunk
+so the web process can export all of them) and to the recorder of the
+current refresh run, if any, whose snapshot ends up in the task result.
+"""
+import contextlib
+import contextvars
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+from django.conf import settings
+
+try:
+    import redis
+except Exception:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("http_fetch", "json_decode", "address_resolution", "db_write")
+BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+REDIS_KEY = "metrics:refresh"
+METRIC = "roads_refresh_segment_stage_seconds"
+COUNTER = "roads_refresh_segments_total"
+
+
+class Histogram:
+    """Fixed-bucket histogram; counts[i] holds values <= BUCKETS[i] (last = +Inf)."""
+
+    def __init__(self, counts=None, total=0.0):
+        self.counts = list(counts) if counts else [0] * (len(BUCKETS) + 1)
+        self.sum = float(total)
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def observe(self, value, weight=1):
+        self.counts[bisect_left(BUCKETS, value)] += weight
+        self.sum += value * weight
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        self.sum += other.sum
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th (0..1) observation."""
+        n = self.count
+        if not n:
+            return None
+        rank, seen = q * n, 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank and c:
+                return BUCKETS[i] if i < len(BUCKETS) else float("inf")
+        return float("inf")
+
+    def snapshot(self):
+        n = self.count
+        return {
+            "count": n,
+            "sum": round(self.sum, 6),
+            "mean_ms": round(self.sum / n * 1000, 3) if n else None,
+            "p50_ms": _ms(self.quantile(0.5)),
+            "p99_ms": _ms(self.quantile(0.99)),
+            "buckets": list(self.counts),
+        }
+
+    @classmethod
+    def from_snapshot(cls, snap):
+        return cls(snap.get("buckets"), snap.get("sum", 0.0))
+
+
+def _ms(seconds):
+    if seconds is None:
+        return None
+    return "+Inf" if seconds == float("inf") else round(seconds * 1000, 3)
+
+
+class MetricsRecorder:
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds, weight=1):
+        with self._lock:
+            self.histograms.setdefault(stage, Histogram()).observe(seconds, weight)
+
+    def inc(self, name, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def drain(self):
+        """Return (histograms, counters) and start over."""
+        with self._lock:
+            histograms, counters = self.histograms, self.counters
+            self.histograms, self.counters = {}, {}
+        return histograms, counters
+
+    def snapshot(self):
+        """JSON-able per-stage summary, plus wall time since the recorder started."""
+        with self._lock:
+            stages = {name: h.snapshot() for name, h in self.histograms.items()}
+        return {"wall_seconds": round(time.monotonic() - self.started, 3), "stages": stages}
+
+
+_process = MetricsRecorder()   # lifetime totals for /metrics
+_pending = MetricsRecorder()   # not yet pushed to Redis
+_current_run = contextvars.ContextVar("refresh_metrics_run", default=None)
+
+
+def observe(stage, seconds, weight=1):
+    """Record `seconds` spent in `stage` for `weight` segments (seconds / weight each)."""
+    if weight <= 0:
+        return
+    per_segment = seconds / weight
+    for recorder in (_process, _pending, _current_run.get()):
+        if recorder is not None:
+            recorder.observe(stage, per_segment, weight)
+
+
+def inc(name, n=1):
+    if not n:
+        return
+    for recorder in (_process, _pending, _current_run.get()):
+        if recorder is not None:
+            recorder.inc(name, n)
+
+
+@contextlib.contextmanager
+def timed(stage, weight=1):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - started, weight)
+
+
+@contextlib.contextmanager
+def run_metrics():
+    """
+    Collect the observations made inside the block (including in threads
+    started through asyncio.to_thread, which copy the context) separately.
+    """
+    recorder = MetricsRecorder()
+    token = _current_run.set(recorder)
+    try:
+        yield recorder
+    finally:
+        _current_run.reset(token)
+
+
+def merge_snapshots(snapshots):
+    """Combine run snapshots (e.g. from chord shards) into one."""
+    merged, wall = {}, 0.0
+    for snap in snapshots:
+        if not snap:
+            continue
+        wall = max(wall, snap.get("wall_seconds", 0.0))
+        for stage, data in snap.get("stages", {}).items():
+            merged.setdefault(stage, Histogram()).merge(Histogram.from_snapshot(data))
+    return {"wall_seconds": wall, "stages": {k: h.snapshot() for k, h in merged.items()}}
+
+
+# --- export -------------------------------------------------------------
+
+_redis_client = None
+
+
+def _get_redis():
+    global _redis_client
+    url = getattr(settings, "METRICS_REDIS_URL", "")
+    if not url or redis is None:
+        return None
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(url, decode_responses=True)
+    return _redis_client
+
+
+def flush():
+    """Push this process's observations since the last flush to Redis."""
+    client = _get_redis()
+    if client is None:
+        return
+    histograms, counters = _pending.drain()
+    if not histograms and not counters:
+        return
+    try:
+        pipe = client.pipeline(transaction=False)
+        for stage, h in histograms.items():
+            for i, c in enumerate(h.counts):
+                if c:
+                    pipe.hincrby(REDIS_KEY, f"{stage}|{i}", c)
+            pipe.hincrbyfloat(REDIS_KEY, f"{stage}|sum", h.sum)
+        for name, n in counters.items():
+            pipe.hincrby(REDIS_KEY, f"counter|{name}", n)
+        pipe.execute()
+    except Exception as e:
+        logger.warning("Could not push refresh metrics: %s", e)
+
+
+def _process_totals():
+    with _process._lock:
+        return (
+            {k: Histogram(h.counts, h.sum) for k, h in _process.histograms.items()},
+            dict(_process.counters),
+        )
+
+
+def _collected():
+    """(histograms, counters) across workers from Redis, else this process."""
+    client = _get_redis()
+    if client is None:
+        return _process_totals()
+    try:
+        fields = client.hgetall(REDIS_KEY)
+    except Exception as e:
+        logger.warning("Could not read refresh metrics, exporting this process only: %s", e)
+        return _process_totals()
+    histograms, counters = {}, {}
+    for field, value in fields.items():
+        name, part = field.rsplit("|", 1)
+        if name == "counter":
+            counters[part] = int(value)
+            continue
+        h = histograms.setdefault(name, Histogram())
+        if part == "sum":
+            h.sum = float(value)
+        else:
+            h.counts[int(part)] = int(value)
+    return histograms, counters
+
+
+def render_prometheus():
+    """Prometheus text exposition of the refresh metrics."""
+    histograms, counters = _collected()
+    lines = [
+        f"# HELP {METRIC} Seconds per segment spent in each refresh stage.",
+        f"# TYPE {METRIC} histogram",
+    ]
+    for stage in sorted(histograms):
+        h = histograms[stage]
+        cumulative = 0
+        for i, c in enumerate(h.counts):
+            cumulative += c
+            le = f"{BUCKETS[i]:g}" if i < len(BUCKETS) else "+Inf"
+            lines.append(f'{METRIC}_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+        lines.append(f'{METRIC}_sum{{stage="{stage}"}} {h.sum:.6f}')
+        lines.append(f'{METRIC}_count{{stage="{stage}"}} {cumulative}')
+    lines += [
+        f"# HELP {COUNTER} Segments processed by refresh runs, by outcome.",
+        f"# TYPE {COUNTER} counter",
+    ]
+    for outcome in sorted(counters):
+        lines.append(f'{COUNTER}{{outcome="{outcome}"}} {counters[outcome]}')
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,25 @@
+# Generated by Django 4.0.5 on 2026-10-18 04:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('all_roads', '0008_alter_address_lat_alter_address_lng'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RefreshCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=128, unique=True)),
+                ('last_pk', models.BigIntegerField(default=0)),
+                ('summary', models.JSONField(blank=True, default=dict)),
+                ('finished', models.BooleanField(default=False)),
+                ('started_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.5 on 2026-10-18 04:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('all_roads', '0009_refreshcheckpoint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='segment',
+            name='last_refreshed_at',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='When distance/travel time were last updated from Google', null=True),
+        ),
+    ]
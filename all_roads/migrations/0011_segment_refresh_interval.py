@@ -0,0 +1,23 @@
+# Generated by Django 4.0.5 on 2026-10-18 04:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('all_roads', '0010_segment_last_refreshed_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='segment',
+            name='next_refresh_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='segment',
+            name='refresh_interval',
+            field=models.PositiveIntegerField(default=3600, help_text='Seconds between adaptive refreshes; shrinks when traffic changes, grows when stable'),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.0.5 on 2026-10-18 04:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('all_roads', '0011_segment_refresh_interval'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='segment',
+            name='error_attempts',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='segment',
+            name='last_error',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='segment',
+            name='next_retry_at',
+            field=models.DateTimeField(blank=True, db_index=True, null=True),
+        ),
+    ]
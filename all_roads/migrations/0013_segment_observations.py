@@ -0,0 +1,57 @@
+# Generated by Django 4.0.5 on 2026-10-18 04:30
+
+import django.contrib.postgres.indexes
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('all_roads', '0012_segment_retry_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SegmentTrafficRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period', models.CharField(choices=[('h', 'Hourly'), ('d', 'Daily')], max_length=1)),
+                ('bucket_start', models.DateTimeField()),
+                ('samples', models.PositiveIntegerField()),
+                ('avg_travel_time', models.IntegerField()),
+                ('min_travel_time', models.IntegerField()),
+                ('max_travel_time', models.IntegerField()),
+                ('avg_speed', models.DecimalField(decimal_places=1, max_digits=4)),
+                ('min_speed', models.DecimalField(decimal_places=1, max_digits=4)),
+                ('segment', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='traffic_rollups', to='all_roads.segment')),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SegmentObservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('observed_at', models.DateTimeField()),
+                ('travel_time', models.IntegerField()),
+                ('avg_speed_tenths', models.PositiveSmallIntegerField(help_text='Average speed in 0.1 km/h')),
+                ('status', models.CharField(choices=[('666699', 'No response'), ('FF0000', 'Werser (<40 km/h)'), ('FF5050', 'Bad (<50 km/h)'), ('FF9966', 'Poor (<60 km/h)'), ('FFFFCC', 'Manageable (<70 km/h)'), ('00CC00', 'OK (<80 km/h)'), ('339933', 'Good (<90 km/h)'), ('006600', 'Better (>=90 km/h)')], max_length=6)),
+                ('segment', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='observations', to='all_roads.segment')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='segmenttrafficrollup',
+            index=django.contrib.postgres.indexes.BrinIndex(fields=['bucket_start'], name='rollup_bucket_brin'),
+        ),
+        migrations.AddConstraint(
+            model_name='segmenttrafficrollup',
+            constraint=models.UniqueConstraint(fields=('segment', 'period', 'bucket_start'), name='rollup_segment_bucket_uniq'),
+        ),
+        migrations.AddIndex(
+            model_name='segmentobservation',
+            index=django.contrib.postgres.indexes.BrinIndex(fields=['observed_at'], name='segobs_observed_brin'),
+        ),
+        migrations.AddIndex(
+            model_name='segmentobservation',
+            index=models.Index(fields=['segment', 'observed_at'], name='segobs_segment_time_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.0.5 on 2026-10-18 04:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('all_roads', '0013_segment_observations'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='segment',
+            name='fingerprint',
+            field=models.CharField(blank=True, help_text='Hash of the uploaded route/name/state/coordinates (utils.segment_fingerprint)', max_length=32),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.0.5 on 2026-10-18 04:38
+
+from django.db import migrations, models
+
+
+def backfill_position(apps, schema_editor):
+    """position = the numeric value of the existing index ("07" -> 7), else 0."""
+    Segment = apps.get_model('all_roads', 'Segment')
+    batch = []
+    for seg in Segment.objects.exclude(index='').only('id', 'index').iterator(chunk_size=2000):
+        if seg.index.strip().isdigit():
+            seg.position = int(seg.index)
+            batch.append(seg)
+        if len(batch) >= 2000:
+            Segment.objects.bulk_update(batch, ['position'])
+            batch = []
+    if batch:
+        Segment.objects.bulk_update(batch, ['position'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('all_roads', '0014_segment_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='segment',
+            name='position',
+            field=models.PositiveIntegerField(default=0, help_text='Order within the route; auto-indexed uploads allocate max + 1 per route'),
+        ),
+        migrations.AlterField(
+            model_name='segment',
+            name='index',
+            field=models.CharField(blank=True, max_length=6),
+        ),
+        migrations.AddIndex(
+            model_name='segment',
+            index=models.Index(fields=['route', 'position'], name='segment_route_position_idx'),
+        ),
+        migrations.RunPython(backfill_position, migrations.RunPython.noop),
+    ]
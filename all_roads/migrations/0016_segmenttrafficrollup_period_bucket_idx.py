@@ -0,0 +1,17 @@
+# Generated by Django 4.0.5 on 2026-10-18 04:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('all_roads', '0015_segment_position'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='segmenttrafficrollup',
+            index=models.Index(fields=['period', 'bucket_start'], name='rollup_period_bucket_idx'),
+        ),
+    ]
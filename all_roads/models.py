@@ -1,3 +1,5 @@
+from decimal import Decimal
+from django.contrib.postgres.indexes import BrinIndex
 from django.db import models
 
 class Road(models.Model):
@@ -43,7 +45,9 @@ class Segment(models.Model):
     ]
 
     route = models.ForeignKey(Route, db_column='route', on_delete=models.PROTECT, default=1)
-    index = models.CharField(max_length=2, blank=True)
+    index = models.CharField(max_length=6, blank=True)
+    position = models.PositiveIntegerField(default=0,
+        help_text="Order within the route; auto-indexed uploads allocate max + 1 per route")
     name = models.CharField(max_length=64, blank=True)
     state = models.CharField(max_length=30, blank=True)
     code = models.CharField(max_length=10, unique=True)
@@ -59,8 +63,109 @@ class Segment(models.Model):
     avg_speed = models.DecimalField(max_digits=4, decimal_places=1, default=0.0)
     # direction
     error_processing = models.BooleanField(default=False)
+    last_error = models.CharField(max_length=255, blank=True)
+    error_attempts = models.PositiveSmallIntegerField(default=0)
+    next_retry_at = models.DateTimeField(null=True, blank=True, db_index=True)
     status = models.CharField(max_length=6, choices=STATUS_CHOICES, default='666699',
         help_text="Traffic color code based on average speed")
+    last_refreshed_at = models.DateTimeField(null=True, blank=True, db_index=True,
+        help_text="When distance/travel time were last updated from Google")
+    refresh_interval = models.PositiveIntegerField(default=3600,
+        help_text="Seconds between adaptive refreshes; shrinks when traffic changes, grows when stable")
+    next_refresh_at = models.DateTimeField(null=True, blank=True, db_index=True)
+    fingerprint = models.CharField(max_length=32, blank=True,
+        help_text="Hash of the uploaded route/name/state/coordinates (utils.segment_fingerprint)")
+
+    class Meta:
+        indexes = [
+            # Per-route Max(position) for auto-indexing reads only this index
+            models.Index(fields=["route", "position"], name="segment_route_position_idx"),
+        ]
+
+    def __str__(self):
+        return self.code
+
+    def save(self, *args, **kwargs):
+        # Edited outside an upload: forget the fingerprint so the next
+        # upload rewrites this row instead of treating it as unchanged
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None:
+            self.fingerprint = ""
+        super().save(*args, **kwargs)
+
+class RefreshCheckpoint(models.Model):
+    """
+    Cursor for a resumable refresh sweep: segments with pk <= last_pk are
+    done. `summary` keeps the running counters so a resumed sweep reports
+    totals for the whole run.
+    """
+    key = models.CharField(max_length=128, unique=True)
+    last_pk = models.BigIntegerField(default=0)
+    summary = models.JSONField(default=dict, blank=True)
+    finished = models.BooleanField(default=False)
+    started_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.key} @ {self.last_pk}"
+
+
+class SegmentObservation(models.Model):
+    """
+    Append-only history of refresh results, one row per segment per refresh.
+    Rows are narrow (speed stored in tenths of km/h as a smallint) and only
+    inserted in observed_at order, so a BRIN index on observed_at stays tiny
+    and time-range scans/pruning are cheap; per-segment history uses the
+    (segment, observed_at) btree. Old rows are rolled up into
+    SegmentTrafficRollup and pruned (all_roads/history.py).
+    """
+    segment = models.ForeignKey(Segment, on_delete=models.CASCADE, db_index=False,
+        related_name="observations")
+    observed_at = models.DateTimeField()
+    travel_time = models.IntegerField()
+    avg_speed_tenths = models.PositiveSmallIntegerField(help_text="Average speed in 0.1 km/h")
+    status = models.CharField(max_length=6, choices=Segment.STATUS_CHOICES)
+
+    class Meta:
+        indexes = [
+            BrinIndex(fields=["observed_at"], name="segobs_observed_brin"),
+            models.Index(fields=["segment", "observed_at"], name="segobs_segment_time_idx"),
+        ]
+
+    @property
+    def avg_speed(self):
+        return Decimal(self.avg_speed_tenths) / 10
+
+    def __str__(self):
+        return f"{self.segment_id} @ {self.observed_at:%Y-%m-%d %H:%M}"
+
+
+class SegmentTrafficRollup(models.Model):
+    """Hourly/daily aggregate of SegmentObservation rows for one segment."""
+    HOUR = "h"
+    DAY = "d"
+    PERIOD_CHOICES = [(HOUR, "Hourly"), (DAY, "Daily")]
+
+    segment = models.ForeignKey(Segment, on_delete=models.CASCADE, db_index=False,
+        related_name="traffic_rollups")
+    period = models.CharField(max_length=1, choices=PERIOD_CHOICES)
+    bucket_start = models.DateTimeField()
+    samples = models.PositiveIntegerField()
+    avg_travel_time = models.IntegerField()
+    min_travel_time = models.IntegerField()
+    max_travel_time = models.IntegerField()
+    avg_speed = models.DecimalField(max_digits=4, decimal_places=1)
+    min_speed = models.DecimalField(max_digits=4, decimal_places=1)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["segment", "period", "bucket_start"], name="rollup_segment_bucket_uniq"),
+        ]
+        indexes = [
+            BrinIndex(fields=["bucket_start"], name="rollup_bucket_brin"),
+            # Network-wide reads filter on period and a bucket_start range
+            models.Index(fields=["period", "bucket_start"], name="rollup_period_bucket_idx"),
+        ]
 
     def __str__(self):
-        return self.code
\ No newline at end of file
+        return f"{self.segment_id} {self.period} {self.bucket_start:%Y-%m-%d %H:%M}"
@@ -0,0 +1,121 @@
+# all_roads/progress.py
+"""
+Task progress as clients see it (task_status and the SSE stream), plus
+whole-sweep progress for chord sweeps.
+
+refresh_network_task replaces itself with a chord, so the id handed to the
+client belongs to the chord callback and would stay PENDING until the end.
+Each shard therefore also records its latest counters in the Redis hash
+progress:sweep:<sweep id> and republishes the combined figures as PROGRESS
+under the sweep's id. That needs the shared in-flight registry Redis;
+without it only the shards' own ids report progress.
+"""
+import json
+import time
+
+from celery import states
+from celery.result import AsyncResult
+from django.conf import settings
+
+from all_roads.inflight import get_registry
+from all_roads.queues import queue_info
+
+PROGRESS = "PROGRESS"
+COUNTERS = ("processed", "updated", "failed", "deferred")
+
+
+def _sweep_key(sweep_id):
+    return f"progress:sweep:{sweep_id}"
+
+
+def _shared_client():
+    registry = get_registry()
+    return registry.client if registry.shared else None
+
+
+def _reporter(task):
+    """Publish chunk-level progress as the task's PROGRESS state meta."""
+    if not task.request.id:  # called directly, not through a worker
+        return None
+    def report(meta):
+        task.update_state(state=PROGRESS, meta=meta)
+    return report
+
+
+def start_sweep(task, total, shards):
+    """Called by the sweep before it fans out: planned totals, and a first PROGRESS."""
+    meta = combine_progress([], total, shards, time.time())
+    client = _shared_client()
+    if client is not None and task.request.id:
+        key = _sweep_key(task.request.id)
+        client.hset(key, mapping={"_plan": json.dumps({"total": total, "shards": shards, "started": time.time()})})
+        client.expire(key, settings.CELERY_RESULT_EXPIRES)
+    if task.request.id:
+        task.update_state(state=PROGRESS, meta=meta)
+
+
+def end_sweep(sweep_id):
+    client = _shared_client()
+    if client is not None and sweep_id:
+        client.delete(_sweep_key(sweep_id))
+
+
+def combine_progress(shard_metas, total, shards, started):
+    """One progress dict for a sweep from its shards' latest progress dicts."""
+    combined = {name: sum(m.get(name, 0) for m in shard_metas) for name in COUNTERS}
+    processed = combined["processed"]
+    elapsed = time.time() - started
+    rate = processed / elapsed if processed and elapsed > 0 else None
+    combined.update(
+        total=total,
+        shards=shards,
+        shards_done=sum(1 for m in shard_metas if m.get("total") and m.get("processed", 0) >= m["total"]),
+        eta_seconds=round(max(total - processed, 0) / rate, 1) if rate else None,
+    )
+    return combined
+
+
+def reporter(task, sweep_id=None):
+    """
+    Progress callback for a refresh run. Inside a sweep (sweep_id set) the
+    run's progress is also folded into the sweep's combined PROGRESS.
+    """
+    own = _reporter(task)
+    client = _shared_client()
+    if own is None or not sweep_id or client is None:
+        return own
+    key = _sweep_key(sweep_id)
+
+    def report(meta):
+        own(meta)
+        client.hset(key, task.request.id, json.dumps(meta))
+        fields = client.hgetall(key)
+        plan = json.loads(fields.pop("_plan", "{}"))
+        shard_metas = [json.loads(v) for v in fields.values()]
+        task.update_state(task_id=sweep_id, state=PROGRESS, meta=combine_progress(
+            shard_metas,
+            plan.get("total", sum(m.get("total", 0) for m in shard_metas)),
+            plan.get("shards", len(shard_metas)),
+            plan.get("started", time.time()),
+        ))
+    return report
+
+
+def task_payload(task_id):
+    """
+    What task_status and the events stream report for a task: its state,
+    plus progress / result / error, plus queue wait info until it starts.
+    """
+    res = AsyncResult(task_id)
+    payload = {"task_id": task_id, "state": res.state}
+    if res.state == PROGRESS and isinstance(res.info, dict):
+        payload["progress"] = res.info
+    elif res.successful():
+        payload["result"] = res.result
+    elif res.failed():
+        payload["error"] = str(res.result)
+    if res.state in (states.PENDING, states.STARTED, PROGRESS):
+        queued = queue_info(task_id)
+        if queued:
+            payload["queue"] = queued
+    return payload
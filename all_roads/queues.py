@@ -0,0 +1,153 @@
+# all_roads/queues.py
+"""
+Queue routing for refresh work. Small code-list refreshes (the dashboard's
+on-demand clicks) go to REFRESH_INTERACTIVE_QUEUE; full, sharded and
+scheduled sweeps go to REFRESH_BULK_QUEUE, so one never waits behind the
+other as long as each queue has its own workers (see roads/celery.py).
+Both settings default to the default queue, which keeps a single worker
+consuming everything until separate workers are set up.
+
+Publish and start times are kept per task id in the in-flight registry's
+Redis so task_status can report how long a task waited and how deep its
+queue is. Without a shared registry (see all_roads/inflight.py) they are not
+recorded, since the web process could never see when a worker started.
+"""
+import json
+import logging
+import time
+
+from celery import current_app
+from celery.signals import before_task_publish, task_prerun
+from django.conf import settings
+
+from all_roads.caching import LRUCache
+from all_roads.inflight import get_registry
+
+logger = logging.getLogger(__name__)
+
+BULK_TASKS = {
+    "all_roads.tasks.refresh_network_task",
+    "all_roads.tasks.refresh_shard_task",
+    "all_roads.tasks.refresh_stale_segments_task",
+    "all_roads.tasks.schedule_adaptive_refresh_task",
+    "all_roads.tasks.retry_failed_segments_task",
+    "all_roads.tasks.aggregate_refresh_results",
+    "all_roads.tasks.rollup_observations_task",
+    "all_roads.tasks.prune_history_task",
+    "all_roads.tasks.recolor_segments_task",
+    "website.tasks.import_segments_task",
+}
+
+
+def route_task(name, args, kwargs, options, task=None, **kw):
+    """
+    CELERY_TASK_ROUTES router. An explicit queue= on the call still wins.
+    refresh_segments_task goes to the interactive queue only for a first
+    attempt at no more than REFRESH_INTERACTIVE_MAX_CODES codes.
+    """
+    if name in BULK_TASKS:
+        return {"queue": settings.REFRESH_BULK_QUEUE}
+    if name == "all_roads.tasks.refresh_segments_task":
+        kwargs = kwargs or {}
+        codes = kwargs.get("codes", args[0] if args else None)
+        if codes and len(codes) <= settings.REFRESH_INTERACTIVE_MAX_CODES and not kwargs.get("requeue_attempt"):
+            return {"queue": settings.REFRESH_INTERACTIVE_QUEUE}
+        return {"queue": settings.REFRESH_BULK_QUEUE}
+    return None
+
+
+def _timing_key(task_id):
+    return f"queue:task:{task_id}"
+
+
+def _timing_client():
+    registry = get_registry()
+    return registry.client if registry.shared else None
+
+
+def _read_timing(task_id):
+    client = _timing_client()
+    if client is None:
+        return None
+    raw = client.get(_timing_key(task_id))
+    return json.loads(raw) if raw else None
+
+
+def _write_timing(task_id, timing):
+    client = _timing_client()
+    if client is None:
+        return
+    client.set(
+        _timing_key(task_id), json.dumps(timing), ex=settings.CELERY_RESULT_EXPIRES,
+    )
+
+
+@before_task_publish.connect
+def _record_published(sender=None, headers=None, routing_key=None, **kwargs):
+    task_id = (headers or {}).get("id")
+    if not task_id:
+        return
+    try:
+        _write_timing(task_id, {"queue": routing_key, "enqueued_at": time.time()})
+    except Exception as e:
+        logger.debug("Could not record publish time for %s: %s", task_id, e)
+
+
+@task_prerun.connect
+def _record_started(task_id=None, **kwargs):
+    try:
+        timing = _read_timing(task_id)
+        if timing and "started_at" not in timing:
+            timing["started_at"] = time.time()
+            _write_timing(task_id, timing)
+    except Exception as e:
+        logger.debug("Could not record start time for %s: %s", task_id, e)
+
+
+_depths = None
+
+
+def queue_depth(queue):
+    """
+    Messages waiting in `queue` on the broker, or None if it can't be asked.
+    Answers are reused for REFRESH_QUEUE_DEPTH_CACHE seconds, so polling
+    clients don't each open a broker connection per request.
+    """
+    global _depths
+    ttl = getattr(settings, "REFRESH_QUEUE_DEPTH_CACHE", 5)
+    if _depths is None or _depths.ttl != ttl:
+        _depths = LRUCache(64, ttl=ttl)
+    cached = _depths.get(queue) if ttl > 0 else None
+    if cached is not None:
+        return cached[0]
+    try:
+        with current_app.connection_for_read() as conn:
+            with conn.channel() as channel:
+                depth = channel.queue_declare(queue=queue, passive=True).message_count
+    except Exception:
+        depth = None
+    if ttl > 0:
+        _depths.set(queue, (depth,))
+    return depth
+
+
+def queue_info(task_id):
+    """
+    {"queue", "queue_depth", "wait_seconds"} for a task published from this
+    deployment, or None when nothing was recorded. wait_seconds counts up
+    while the task is still queued and is fixed once a worker picks it up.
+    """
+    try:
+        timing = _read_timing(task_id)
+    except Exception:
+        return None
+    if not timing:
+        return None
+    waited_until = timing.get("started_at") or time.time()
+    info = {
+        "queue": timing.get("queue"),
+        "wait_seconds": round(max(waited_until - timing["enqueued_at"], 0.0), 2),
+    }
+    if timing.get("queue"):
+        info["queue_depth"] = queue_depth(timing["queue"])
+    return info
@@ -0,0 +1,41 @@
+# all_roads/refresh_async.py
+"""
+asyncio refresh engine: overlaps Distance Matrix requests for a chunk of
+batches with bounded concurrency and a shared TokenBucket. Only the HTTP
+calls run here; database work stays synchronous in services.py.
+"""
+import asyncio
+from all_roads.distance_matrix import fetch_batch, results_for, ThrottledError, CircuitOpenError
+
+
+async def _fetch_one(batch, api_key, controller, semaphore):
+    async with semaphore:
+        if not await controller.wait_for_slot():
+            return results_for(batch, CircuitOpenError("circuit open"))
+        await controller.bucket.acquire()
+        # requests is blocking; run it on the default thread pool
+        results = await asyncio.to_thread(fetch_batch, batch, api_key)
+        controller.record(any(isinstance(r, ThrottledError) for r in results.values()))
+        return results
+
+
+async def _fetch_all(batches, api_key, controller, concurrency):
+    semaphore = asyncio.Semaphore(max(1, int(concurrency)))
+    results = await asyncio.gather(
+        *(_fetch_one(b, api_key, controller, semaphore) for b in batches)
+    )
+    merged = {}
+    for r in results:
+        merged.update(r)
+    return merged
+
+
+def fetch_batches_concurrently(batches, api_key, controller, concurrency):
+    """
+    Fetch all batches concurrently, paced by the controller's token bucket,
+    and return one merged { segment.pk: result_dict | Exception } map.
+    Batches reached while the circuit is open are not sent.
+    """
+    if not batches:
+        return {}
+    return asyncio.run(_fetch_all(batches, api_key, controller, concurrency))
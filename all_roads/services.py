@@ -1,17 +1,42 @@
 # all_roads/services.py
-from decimal import Decimal
-import requests
+import logging
+import time
+import uuid
+from datetime import timedelta
 from decouple import config
-from all_roads.models import Segment, Address
-from all_roads.utils import get_status_color
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q, Case, When, Value, CharField
+from django.utils import timezone
+from all_roads.models import Segment, RefreshCheckpoint
+from all_roads import metrics
+from all_roads.addresses import AddressResolutionError, get_resolver
+from all_roads.history import record_observations
+from all_roads.inflight import get_registry
+from all_roads.distance_matrix import (
+    plan_batches, fetch_batch, get_response_cache, redact, results_for,
+    ThrottledError, CircuitOpenError,
+)
+from all_roads.refresh_async import fetch_batches_concurrently
+from all_roads.throttle import TokenBucket, SharedTokenBucket, AdaptiveRateController
+from all_roads.utils import chunked, status_thresholds, NO_RESPONSE
 
-def get_or_create_address(address_str, lat, lng):
-    return Address.objects.get_or_create(
-        address=address_str,
-        defaults={"lat": lat, "lng": lng}
-    )[0]
+logger = logging.getLogger(__name__)
 
-def refresh_segments(codes=None, sleep_between=0.0):
+REFRESH_MODES = ("serial", "async")
+
+# Columns written for a successfully refreshed segment
+REFRESH_FIELDS = [
+    "distance", "travel_time", "avg_speed", "status",
+    "error_processing", "start_point", "end_point", "last_refreshed_at",
+    "refresh_interval", "next_refresh_at",
+    "last_error", "error_attempts", "next_retry_at",
+]
+
+# Columns written for a segment that failed
+FAILURE_FIELDS = ["error_processing", "last_error", "error_attempts", "next_retry_at"]
+
+def refresh_segments(codes=None, sleep_between=0.0, mode="serial"):
     """
     Wrapper used by Celery: optionally restrict to a list of codes,
     then call the core updater.
@@ -19,60 +44,458 @@ def refresh_segments(codes=None, sleep_between=0.0):
     qs = Segment.objects.all()
     if codes:
         qs = qs.filter(code__in=codes)
-    return refresh_segments_from_google(qs, sleep_between=sleep_between)
+    return refresh_segments_from_google(qs, sleep_between=sleep_between, mode=mode)
 
-def refresh_segments_from_google(queryset, sleep_between=0.0):
+def _oldest_first(condition, ordering, limit):
     """
-    Core updater: iterates queryset of Segment, calls Google Distance Matrix,
-    updates distance/travel_time/avg_speed/status/start_point/end_point.
-    Returns summary dict.
+    Up to `limit` segments matching `condition`, in `ordering` (then pk).
+    Failed segments still backing off, or past REFRESH_RETRY_MAX_ATTEMPTS,
+    are left out.
     """
-    api_key = config("GOOGLE_ROUTES_API_KEY")
-    updated, failed = 0, 0
+    now = timezone.now()
+    order = (ordering, "pk")
+    ids = list(
+        Segment.objects
+        .filter(condition)
+        .exclude(error_processing=True, next_retry_at__gt=now)
+        .exclude(
+            error_processing=True,
+            error_attempts__gte=getattr(settings, "REFRESH_RETRY_MAX_ATTEMPTS", 6),
+        )
+        .order_by(*order)
+        .values_list("pk", flat=True)[:limit]
+    )
+    # The pk__in re-query keeps the slice out of the queryset (so it can be
+    # filtered further) but needs the ordering again
+    return Segment.objects.filter(pk__in=ids).order_by(*order)
+
+def stale_segments(max_age=None, limit=None):
+    """
+    Segments never refreshed or refreshed more than `max_age` seconds ago,
+    oldest first, capped at `limit` rows. Failed segments still backing off
+    or out of retries are skipped.
+    """
+    if max_age is None:
+        max_age = getattr(settings, "REFRESH_STALE_AFTER", 3600)
+    if limit is None:
+        limit = getattr(settings, "REFRESH_STALE_LIMIT", 2000)
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+    return _oldest_first(
+        Q(last_refreshed_at__isnull=True) | Q(last_refreshed_at__lt=cutoff),
+        F("last_refreshed_at").asc(nulls_first=True),
+        limit,
+    )
+
+def refresh_stale_segments(max_age=None, limit=None, sleep_between=0.0, mode="serial", progress=None):
+    """Incremental refresh: only segments older than `max_age` seconds."""
+    qs = stale_segments(max_age=max_age, limit=limit)
+    return refresh_segments_from_google(qs, sleep_between=sleep_between, mode=mode, progress=progress)
+
+def due_segments(limit):
+    """
+    Segments whose adaptive next_refresh_at has passed, most overdue first.
+    Failed segments still backing off are left to the retry queue, and
+    those out of retries are left alone.
+    """
+    now = timezone.now()
+    return _oldest_first(
+        Q(next_refresh_at__isnull=True) | Q(next_refresh_at__lte=now),
+        F("next_refresh_at").asc(nulls_first=True),
+        limit,
+    )
+
+def due_limit(tick_seconds=None):
+    """This tick's share of REFRESH_BUDGET_PER_HOUR segment lookups."""
+    if tick_seconds is None:
+        tick_seconds = getattr(settings, "REFRESH_SCHEDULER_TICK", 300)
+    budget = getattr(settings, "REFRESH_BUDGET_PER_HOUR", 6000)
+    return max(1, int(budget * tick_seconds / 3600))
+
+def refresh_due_segments(tick_seconds=None, limit=None, sleep_between=0.0, mode="serial", progress=None):
+    """
+    One adaptive scheduler tick: refresh due segments, spending at most this
+    tick's share of REFRESH_BUDGET_PER_HOUR segment lookups (or `limit`).
+    """
+    if limit is None:
+        limit = due_limit(tick_seconds)
+    return refresh_segments_from_google(
+        due_segments(limit), sleep_between=sleep_between, mode=mode, progress=progress
+    )
+
+def retryable_segments(codes=None, limit=None, force=False):
+    """
+    Failed segments under REFRESH_RETRY_MAX_ATTEMPTS whose backoff has
+    elapsed (or all of them with force=True), earliest retry first.
+    """
+    if limit is None:
+        limit = getattr(settings, "REFRESH_RETRY_LIMIT", 500)
+    qs = Segment.objects.filter(
+        error_processing=True,
+        error_attempts__lt=getattr(settings, "REFRESH_RETRY_MAX_ATTEMPTS", 6),
+    )
+    if codes:
+        qs = qs.filter(code__in=codes)
+    if not force:
+        qs = qs.filter(Q(next_retry_at__isnull=True) | Q(next_retry_at__lte=timezone.now()))
+    order = (F("next_retry_at").asc(nulls_first=True), "pk")
+    ids = list(qs.order_by(*order).values_list("pk", flat=True)[:limit])
+    return Segment.objects.filter(pk__in=ids).order_by(*order)
+
+def retry_failed_segments(codes=None, limit=None, force=False, sleep_between=0.0, mode="serial", progress=None):
+    """Re-process only failed segments that are due for another attempt."""
+    qs = retryable_segments(codes=codes, limit=limit, force=force)
+    return refresh_segments_from_google(qs, sleep_between=sleep_between, mode=mode, progress=progress)
+
+def plan_code_shards(shard_size=None):
+    """
+    Split the network into contiguous, inclusive (first_code, last_code)
+    ranges of at most `shard_size` segments, for fan-out across workers.
+    """
+    if shard_size is None:
+        shard_size = getattr(settings, "REFRESH_SHARD_SIZE", 500)
+    codes = Segment.objects.order_by("code").values_list("code", flat=True)
+    return [(chunk[0], chunk[-1]) for chunk in chunked(codes.iterator(), shard_size)]
+
+def merge_summaries(summaries):
+    """Add up per-shard refresh summaries into one."""
+    total = {}
+    for summary in summaries:
+        for key, value in (summary or {}).items():
+            if isinstance(value, (int, float)):
+                total[key] = total.get(key, 0) + value
+    total.setdefault("updated", 0)
+    total.setdefault("failed", 0)
+    total.setdefault("total", 0)
+    total["shards"] = len(summaries)
+    total["metrics"] = metrics.merge_snapshots([(s or {}).get("metrics") for s in summaries])
+    return total
+
+def next_refresh_interval(segment, result):
+    """
+    Adaptive interval: halve it when the segment's status or speed moved
+    noticeably since the last refresh, otherwise grow it by half, clamped to
+    [REFRESH_INTERVAL_MIN, REFRESH_INTERVAL_MAX]. Busy urban segments settle
+    near the minimum and quiet rural ones near the maximum.
+    """
+    lo = getattr(settings, "REFRESH_INTERVAL_MIN", 15 * 60)
+    hi = getattr(settings, "REFRESH_INTERVAL_MAX", 24 * 3600)
+    interval = segment.refresh_interval or lo
+    if segment.last_refreshed_at is None:
+        return min(max(interval, lo), hi)
+
+    delta = abs(float(result["avg_speed"]) - float(segment.avg_speed))
+    volatile = (
+        result["status"] != segment.status
+        or delta >= getattr(settings, "REFRESH_VOLATILITY_SPEED_DELTA", 5.0)
+    )
+    interval = interval // 2 if volatile else int(interval * 1.5)
+    return min(max(interval, lo), hi)
+
+def _apply_result(segment, result, address_ids, refreshed_at):
+    """Copy a Distance Matrix result onto the (unsaved) segment."""
+    segment.refresh_interval = next_refresh_interval(segment, result)
+    segment.next_refresh_at = refreshed_at + timedelta(seconds=segment.refresh_interval)
+    segment.last_refreshed_at = refreshed_at
+    segment.distance = result["distance"]
+    segment.travel_time = result["travel_time"]
+    segment.avg_speed = result["avg_speed"]
+    segment.status = result["status"]
+    segment.error_processing = False
+    segment.last_error = ""
+    segment.error_attempts = 0
+    segment.next_retry_at = None
+    try:
+        segment.start_point_id = address_ids[result["origin_address"]]
+        segment.end_point_id   = address_ids[result["destination_address"]]
+    except KeyError as e:
+        raise AddressResolutionError([e.args[0]], address_ids) from None
 
-    for segment in queryset.iterator(chunk_size=200):
+def retry_delay(attempts):
+    """Exponential backoff before failed segment retry number `attempts`."""
+    base = getattr(settings, "REFRESH_RETRY_BASE_DELAY", 300)
+    cap = getattr(settings, "REFRESH_RETRY_MAX_DELAY", 6 * 3600)
+    return min(base * 2 ** max(attempts - 1, 0), cap)
+
+def _mark_failed(segment, reason, now):
+    segment.error_processing = True
+    segment.last_error = (reason or "Unknown error")[:255]
+    segment.error_attempts = min(segment.error_attempts + 1, 32767)
+    segment.next_retry_at = now + timedelta(seconds=retry_delay(segment.error_attempts))
+
+def _resolve_chunk_addresses(chunk, results):
+    """One resolver call for every address string seen in the chunk."""
+    wanted = {}
+    for segment in chunk:
+        result = results.get(segment.pk)
+        if isinstance(result, dict):
+            wanted.setdefault(result["origin_address"], (segment.start_lat, segment.start_lon))
+            wanted.setdefault(result["destination_address"], (segment.end_lat, segment.end_lon))
+    with metrics.timed("address_resolution", len(chunk)):
         try:
-            origin = f"{segment.start_lat},{segment.start_lon}"
-            destination = f"{segment.end_lat},{segment.end_lon}"
-            url = (
-                "https://maps.googleapis.com/maps/api/distancematrix/json"
-                f"?origins={origin}&destinations={destination}"
-                f"&mode=driving&units=metric&key={api_key}"
-            )
+            return get_resolver().resolve_many(wanted)
+        except AddressResolutionError as e:
+            # Segments needing the missing ones fail with this error; the rest go on
+            logger.error("%s", e)
+            return e.resolved
+
+def _flush_chunk(ok_segments, failed_segments, checkpoint=None, last_pk=None, counters=None):
+    """
+    Write one chunk's results: a bulk UPDATE per outcome plus the history
+    rows for the refreshed segments, one transaction.
+    The checkpoint cursor moves in the same transaction, so it never gets
+    ahead of (or behind) the rows actually written.
+    """
+    with metrics.timed("db_write", len(ok_segments) + len(failed_segments)), transaction.atomic():
+        if ok_segments:
+            Segment.objects.bulk_update(ok_segments, REFRESH_FIELDS)
+            record_observations(ok_segments)
+        if failed_segments:
+            Segment.objects.bulk_update(failed_segments, FAILURE_FIELDS)
+        if checkpoint is not None:
+            checkpoint.last_pk = last_pk
+            checkpoint.summary = dict(counters)
+            checkpoint.save(update_fields=["last_pk", "summary", "updated_at"])
+
+def status_case():
+    """SQL CASE equivalent of utils.get_status_color over Segment.avg_speed."""
+    whens, default = [], NO_RESPONSE
+    for bound, color in sorted(status_thresholds(), key=lambda p: p[0]):
+        if bound == float("inf"):
+            default = color
+            break
+        whens.append(When(avg_speed__lt=bound, then=Value(color)))
+    return Case(*whens, default=Value(default), output_field=CharField())
+
+def recolor_segments(dry_run=False):
+    """
+    Recompute Segment.status from the stored avg_speed with the current
+    thresholds: one UPDATE ... SET status = CASE ... over the rows whose
+    color changes. No API calls. Returns the number of rows (to be) changed.
+    """
+    case = status_case()
+    changed = Segment.objects.exclude(status=case)
+    if dry_run:
+        return changed.count()
+    return changed.update(status=case)
 
-            r = requests.get(url, timeout=10)
-            r.raise_for_status()
-            data = r.json()
+def get_checkpoint(key):
+    """
+    Return the checkpoint for `key`, resuming it if a previous run stopped
+    part-way recently, otherwise reset to the start of the sweep.
+    """
+    max_age = timedelta(seconds=getattr(settings, "REFRESH_CHECKPOINT_MAX_AGE", 6 * 3600))
+    cutoff = timezone.now() - max_age
+    # Finished runs delete theirs; this clears those left by runs that died
+    RefreshCheckpoint.objects.filter(updated_at__lt=cutoff).exclude(key=key).delete()
+    checkpoint, created = RefreshCheckpoint.objects.get_or_create(key=key)
+    if not created and (checkpoint.finished or checkpoint.updated_at < cutoff):
+        checkpoint.last_pk = 0
+        checkpoint.summary = {}
+        checkpoint.finished = False
+        checkpoint.started_at = timezone.now()
+        checkpoint.save()
+    return checkpoint
 
-            if data.get("status") != "OK":
-                raise ValueError(f"Bad API status: {data.get('status')}")
+def _fetch_serial(batches, api_key, controller):
+    results = {}
+    for batch in batches:
+        if not controller.wait_for_slot_sync():
+            results.update(results_for(batch, CircuitOpenError("circuit open")))
+            continue
+        controller.bucket.acquire_sync()
+        fetched = fetch_batch(batch, api_key)
+        controller.record(any(isinstance(r, ThrottledError) for r in fetched.values()))
+        results.update(fetched)
+    return results
 
-            el = data["rows"][0]["elements"][0]
-            if el.get("status") != "OK":
-                raise ValueError(f"Element status: {el.get('status')}")
+def _lock_segments(chunk, owner):
+    """
+    Take the per-segment in-flight locks for a chunk. Returns the set of pks
+    held, or None when the registry is unreachable (then nothing is skipped).
+    """
+    try:
+        return set(get_registry().lock_segments([s.pk for s in chunk], owner))
+    except Exception as e:
+        logger.warning("Segment locks unavailable, refreshing without them: %s", e)
+        return None
 
-            dist_km = round(el["distance"]["value"] / 1000, 2)
-            dur_s = int(el["duration"]["value"])
-            speed = round(dist_km / (dur_s / 3600), 1) if dur_s > 0 else 0.0
+def _unlock_segments(held, owner):
+    if not held:
+        return
+    try:
+        get_registry().unlock_segments(held, owner)
+    except Exception as e:
+        logger.warning("Could not release segment locks: %s", e)
 
-            segment.distance = Decimal(str(dist_km))
-            segment.travel_time = dur_s
-            segment.avg_speed = Decimal(str(speed))
-            segment.status = get_status_color(speed)
-            segment.error_processing = False
+def _build_controller(sleep_between):
+    rate = getattr(settings, "REFRESH_RATE_LIMIT", 10.0)
+    registry = get_registry()
+    if registry.shared:
+        # One budget for every run and shard on the API key
+        bucket = SharedTokenBucket(registry.client, rate, min_interval=sleep_between)
+    else:
+        bucket = TokenBucket(rate=rate, min_interval=sleep_between)
+    return AdaptiveRateController(
+        bucket,
+        min_rate=getattr(settings, "REFRESH_RATE_MIN", 0.5),
+        increase=getattr(settings, "REFRESH_RATE_INCREASE", 0.5),
+        decrease=getattr(settings, "REFRESH_RATE_DECREASE", 0.5),
+        threshold=getattr(settings, "REFRESH_CIRCUIT_THRESHOLD", 5),
+        cooldown=getattr(settings, "REFRESH_CIRCUIT_COOLDOWN", 60),
+        max_wait=getattr(settings, "REFRESH_CIRCUIT_MAX_WAIT", 120),
+    )
 
-            origin_addr = data["origin_addresses"][0]
-            dest_addr = data["destination_addresses"][0]
-            segment.start_point = get_or_create_address(origin_addr, segment.start_lat, segment.start_lon)
-            segment.end_point   = get_or_create_address(dest_addr, segment.end_lat, segment.end_lon)
+def refresh_segments_from_google(queryset, sleep_between=0.0, mode="serial", checkpoint=None, progress=None):
+    """
+    Core updater: iterates queryset of Segment in chunks, packs each chunk into
+    as few Distance Matrix requests as the element limits allow, and
+    updates distance/travel_time/avg_speed/status/start_point/end_point.
 
-            segment.save()
-            updated += 1
+    mode="serial" sends one request at a time; mode="async" overlaps up to
+    REFRESH_CONCURRENCY requests. Both share a token bucket capped at
+    REFRESH_RATE_LIMIT requests/sec (across all runs, when the in-flight
+    registry Redis is shared), and `sleep_between` is the minimum gap
+    between request starts. Throttling responses lower the rate (AIMD) and
+    repeated ones open a circuit breaker that pauses requests; throttled
+    segments, and those still blocked once REFRESH_CIRCUIT_MAX_WAIT is used
+    up, are not failed but returned in "deferred_codes" for a later retry.
 
-        except Exception as e:
-            segment.error_processing = True
-            segment.save(update_fields=["error_processing"])
-            failed += 1
+    Results are cached per coordinate pair for RESPONSE_CACHE_TTL seconds;
+    cached segments are not sent to Google.
+
+    Each chunk takes per-segment in-flight locks first; segments locked by
+    another run are skipped and counted in "skipped_locked".
+
+    With a RefreshCheckpoint, segments are walked in pk order starting after
+    checkpoint.last_pk and the cursor is saved after every chunk.
+
+    `progress`, if given, is called after every chunk with
+    {"processed", "updated", "failed", "deferred", "total", "rate_limit", "eta_seconds"}.
+    Returns summary dict; its "metrics" holds per-stage timing histograms
+    for this run (see all_roads/metrics.py).
+    """
+    if mode not in REFRESH_MODES:
+        raise ValueError(f"Unknown refresh mode: {mode!r}")
+
+    with metrics.run_metrics() as recorder:
+        summary = _refresh_segments(queryset, sleep_between, mode, checkpoint, progress)
+    summary["metrics"] = recorder.snapshot()
+    return summary
+
+def _refresh_segments(queryset, sleep_between, mode, checkpoint, progress):
+    api_key = config("GOOGLE_ROUTES_API_KEY")
+    controller = _build_controller(sleep_between)
+    concurrency = getattr(settings, "REFRESH_CONCURRENCY", 8)
+    cache = get_response_cache()
+    total = queryset.count()
+    counters = {
+        "updated": 0, "failed": 0, "deferred": 0,
+        "cache_hits": 0, "cache_misses": 0, "deferred_codes": [],
+    }
+    if checkpoint is not None:
+        counters.update(checkpoint.summary)
+        queryset = queryset.filter(pk__gt=checkpoint.last_pk).order_by("pk")
+    started = time.monotonic()
+    resumed_at = (
+        counters["updated"] + counters["failed"] + counters["deferred"]
+        + counters.get("skipped_locked", 0)
+    )
+    counters.setdefault("skipped_locked", 0)
+    lock_owner = uuid.uuid4().hex
+
+    for chunk in chunked(queryset.iterator(chunk_size=200), 200):
+        last_pk = chunk[-1].pk
+        # Segments another run is refreshing right now are left to it
+        held = _lock_segments(chunk, lock_owner)
+        if held is not None:
+            counters["skipped_locked"] += len(chunk) - len(held)
+            chunk = [segment for segment in chunk if segment.pk in held]
+        try:
+            results, to_fetch = {}, []
+            for segment in chunk:
+                cached = cache.get(segment)
+                if cached is None:
+                    to_fetch.append(segment)
+                else:
+                    results[segment.pk] = cached
+            counters["cache_hits"] += len(chunk) - len(to_fetch)
+            counters["cache_misses"] += len(to_fetch)
+
+            batches = plan_batches(to_fetch)
+            if mode == "async":
+                fetched = fetch_batches_concurrently(batches, api_key, controller, concurrency)
+            else:
+                fetched = _fetch_serial(batches, api_key, controller)
+            for segment in to_fetch:
+                if isinstance(fetched.get(segment.pk), dict):
+                    cache.set(segment, fetched[segment.pk])
+            results.update(fetched)
+
+            address_ids = _resolve_chunk_addresses(chunk, results)
+            refreshed_at = timezone.now()
+
+            ok_segments, failed_segments = [], []
+            first_error = None
+            for segment in chunk:
+                result = results.get(segment.pk)
+                if isinstance(result, ThrottledError):
+                    counters["deferred"] += 1
+                    counters["deferred_codes"].append(segment.code)
+                    continue
+                try:
+                    if result is None:
+                        raise ValueError("No result for segment")
+                    if isinstance(result, Exception):
+                        raise result
+                    _apply_result(segment, result, address_ids, refreshed_at)
+                    ok_segments.append(segment)
+                except Exception as e:
+                    _mark_failed(segment, f"{type(e).__name__}: {redact(e)}", refreshed_at)
+                    failed_segments.append(segment)
+                    first_error = first_error or e
+
+            counters["updated"] += len(ok_segments)
+            counters["failed"] += len(failed_segments)
+            _flush_chunk(ok_segments, failed_segments, checkpoint, last_pk, counters)
+            if failed_segments:
+                logger.warning(
+                    "%d of %d segments failed (e.g. %s: %s: %s)", len(failed_segments), len(chunk),
+                    failed_segments[0].code, type(first_error).__name__, redact(first_error),
+                )
+            metrics.inc("updated", len(ok_segments))
+            metrics.inc("failed", len(failed_segments))
+            metrics.inc("deferred", sum(isinstance(results.get(s.pk), ThrottledError) for s in chunk))
+        finally:
+            _unlock_segments(held, lock_owner)
+            metrics.flush()
+
+        if progress is not None:
+            processed = (
+                counters["updated"] + counters["failed"] + counters["deferred"] + counters["skipped_locked"]
+            )
+            rate = (processed - resumed_at) / max(time.monotonic() - started, 1e-6)
+            progress({
+                "processed": processed,
+                "updated": counters["updated"],
+                "failed": counters["failed"],
+                "deferred": counters["deferred"],
+                "total": total,
+                "rate_limit": round(controller.rate, 2),
+                "eta_seconds": round(max(total - processed, 0) / rate, 1) if rate else None,
+            })
 
-    return {"updated": updated, "failed": failed, "total": queryset.count()}
+    if checkpoint is not None:
+        checkpoint.finished = True
+        checkpoint.save(update_fields=["finished", "updated_at"])
 
+    return {
+        "updated": counters["updated"],
+        "failed": counters["failed"],
+        "total": total,
+        "cache_hits": counters["cache_hits"],
+        "cache_misses": counters["cache_misses"],
+        "deferred": counters["deferred"],
+        "deferred_codes": counters["deferred_codes"],
+        "circuit_trips": controller.trips,
+        "skipped_locked": counters["skipped_locked"],
+    }
@@ -1,14 +1,238 @@
 # all_roads/tasks.py
-from celery import shared_task
+import hashlib
+from celery import shared_task, chord
+from celery.exceptions import SoftTimeLimitExceeded, Ignore, Retry
+from django.conf import settings
 from all_roads.models import Segment
-from .services import refresh_segments_from_google
+from all_roads.inflight import get_registry
+from all_roads import queues  # noqa: F401  (routing + queue timing signals)
+from .services import (
+    refresh_segments_from_google, refresh_stale_segments, refresh_due_segments,
+    retry_failed_segments, recolor_segments, due_limit,
+    plan_code_shards, merge_summaries, get_checkpoint,
+)
+from .history import rollup_observations, prune_history
+from .progress import PROGRESS, reporter, start_sweep, end_sweep  # noqa: F401  (PROGRESS re-exported)
+from .utils import chunked
 
-@shared_task(name="all_roads.tasks.refresh_segments_task")
-def refresh_segments_task(codes=None, sleep_between=0.0):
+def _release_inflight(task_id):
+    """Drop the task's in-flight registration so new requests enqueue again."""
+    if not task_id:
+        return
+    try:
+        get_registry().release(task_id)
+    except Exception:
+        pass  # registrations expire after REFRESH_INFLIGHT_TTL anyway
+
+def _requeue_deferred(summary, sleep_between, mode, attempt=0):
+    """
+    Segments deferred by throttling or an open circuit go back on the queue
+    as their own refresh after an exponentially growing cooldown; after
+    REFRESH_REQUEUE_MAX attempts they are marked error_processing instead.
+    """
+    codes = summary.pop("deferred_codes", [])
+    if not codes:
+        return summary
+    if attempt >= settings.REFRESH_REQUEUE_MAX:
+        Segment.objects.filter(code__in=codes).update(
+            error_processing=True, last_error="ThrottledError: re-queue attempts exhausted",
+        )
+        summary["abandoned"] = len(codes)
+        return summary
+    async_result = refresh_segments_task.apply_async(
+        kwargs={"codes": codes, "sleep_between": sleep_between, "mode": mode, "requeue_attempt": attempt + 1},
+        countdown=settings.REFRESH_CIRCUIT_COOLDOWN * (2 ** attempt),
+    )
+    summary["requeued_task_id"] = async_result.id
+    return summary
+
+def _run_checkpointed(task, key, qs, sleep_between, mode, requeue_attempt=0, sweep_id=None):
+    """
+    Run a sweep against a persisted cursor. On the soft time limit the cursor
+    is already saved (every chunk commits it), so replace the task with a
+    fresh copy of itself that resumes from there; the task id, and any chord
+    it belongs to, carry over to the continuation.
+    """
+    checkpoint = get_checkpoint(key)
+    try:
+        summary = refresh_segments_from_google(
+            qs, sleep_between=sleep_between, mode=mode, checkpoint=checkpoint,
+            progress=reporter(task, sweep_id),
+        )
+    except SoftTimeLimitExceeded:
+        raise task.replace(task.s(*task.request.args, **task.request.kwargs))
+    # Done: the next run of this sweep starts from the beginning
+    checkpoint.delete()
+    return _requeue_deferred(summary, sleep_between, mode, requeue_attempt)
+
+@shared_task(bind=True, name="all_roads.tasks.refresh_segments_task")
+def refresh_segments_task(self, codes=None, sleep_between=0.0, mode="serial", requeue_attempt=0, sweep_id=None):
+    """
+    mode: "serial" (one request at a time) or "async" (concurrent, rate limited).
+    requeue_attempt counts how often these codes were re-queued after throttling.
+    sweep_id: the refresh_network_task this runs a shard of, if any.
+
+    Only sweeps and their shards are checkpointed. An ad-hoc code list (at
+    most REFRESH_SHARD_SIZE codes; longer ones go through
+    refresh_network_task) runs start to finish.
+    """
     qs = Segment.objects.all()
+    try:
+        if codes and not sweep_id:
+            summary = _requeue_deferred(
+                refresh_segments_from_google(
+                    qs.filter(code__in=codes), sleep_between=sleep_between, mode=mode,
+                    progress=reporter(self),
+                ),
+                sleep_between, mode, requeue_attempt,
+            )
+        else:
+            if codes:
+                qs = qs.filter(code__in=codes)
+                key = "codes:" + hashlib.sha1("|".join(sorted(set(codes))).encode()).hexdigest()
+            else:
+                key = "all"
+            summary = _run_checkpointed(self, key, qs, sleep_between, mode, requeue_attempt, sweep_id)
+    except (Ignore, Retry):
+        raise  # replaced by its continuation, which keeps the task id
+    except Exception:
+        _release_inflight(self.request.id)
+        raise
+    _release_inflight(self.request.id)
+    return summary
+
+@shared_task(bind=True, name="all_roads.tasks.refresh_shard_task")
+def refresh_shard_task(self, code_from, code_to, sleep_between=0.0, mode="serial", sweep_id=None):
+    """Refresh one inclusive code range of the network."""
+    qs = Segment.objects.filter(code__gte=code_from, code__lte=code_to)
+    return _run_checkpointed(
+        self, f"shard:{code_from}:{code_to}", qs, sleep_between, mode, sweep_id=sweep_id,
+    )
+
+def _run_selection(task, refresh, limit, **kwargs):
+    """
+    Run a refresh of up to `limit` segments picked by a selection query
+    (stale, due, failed). On the soft time limit, replace the task with a
+    copy that selects again with `limit` less what this run got through:
+    segments it refreshed or failed no longer qualify, and the ones it
+    never reached (or deferred) still do. A run that got nowhere re-raises.
+    """
+    own = reporter(task)
+    done = {"processed": 0}
+
+    def progress(meta):
+        done["processed"] = meta["processed"]
+        if own is not None:
+            own(meta)
+
+    try:
+        return refresh(limit=limit, progress=progress, **kwargs)
+    except SoftTimeLimitExceeded:
+        remaining = limit - done["processed"]
+        if not done["processed"]:
+            raise
+        if remaining <= 0:
+            return {"processed": done["processed"], "stopped": "soft time limit"}
+        raise task.replace(task.s(limit=remaining, **kwargs))
+
+@shared_task(bind=True, name="all_roads.tasks.refresh_stale_segments_task")
+def refresh_stale_segments_task(self, max_age=None, limit=None, sleep_between=0.0, mode="serial"):
+    """
+    Incremental refresh: up to `limit` segments not refreshed in `max_age`
+    seconds (defaults: REFRESH_STALE_LIMIT / REFRESH_STALE_AFTER), oldest first.
+    Continues in a fresh task if it reaches the soft time limit.
+    """
+    if limit is None:
+        limit = getattr(settings, "REFRESH_STALE_LIMIT", 2000)
+    summary = _run_selection(
+        self, refresh_stale_segments, limit,
+        max_age=max_age, sleep_between=sleep_between, mode=mode,
+    )
+    return _requeue_deferred(summary, sleep_between, mode)
+
+@shared_task(bind=True, name="all_roads.tasks.schedule_adaptive_refresh_task")
+def schedule_adaptive_refresh_task(self, mode="async", limit=None):
+    """
+    Run by Celery beat every REFRESH_SCHEDULER_TICK seconds: refresh the
+    segments whose adaptive interval has elapsed, within the hourly budget.
+    """
+    if limit is None:
+        limit = due_limit()
+    summary = _run_selection(self, refresh_due_segments, limit, mode=mode)
+    # Deferred segments stay due, so the next tick picks them up again
+    summary.pop("deferred_codes", None)
+    return summary
+
+@shared_task(bind=True, name="all_roads.tasks.retry_failed_segments_task")
+def retry_failed_segments_task(self, codes=None, force=False, mode="serial", limit=None):
+    """
+    Re-process failed segments whose backoff has elapsed (all failed ones
+    with force=True), skipping any at REFRESH_RETRY_MAX_ATTEMPTS. Runs from
+    beat every REFRESH_RETRY_TICK seconds and from the failed-segments API.
+    """
+    if limit is None:
+        limit = getattr(settings, "REFRESH_RETRY_LIMIT", 500)
+    summary = _run_selection(
+        self, retry_failed_segments, limit, codes=codes, force=force, mode=mode,
+    )
+    return _requeue_deferred(summary, 0.0, mode)
+
+@shared_task(name="all_roads.tasks.recolor_segments_task")
+def recolor_segments_task():
+    """Re-derive every segment's status from its speed after a threshold change."""
+    return {"recolored": recolor_segments()}
+
+@shared_task(name="all_roads.tasks.rollup_observations_task")
+def rollup_observations_task():
+    """Hourly (beat): roll finished hours/days of traffic history into aggregates."""
+    return rollup_observations()
+
+@shared_task(name="all_roads.tasks.prune_history_task")
+def prune_history_task():
+    """Daily (beat): drop observations and rollups past their retention."""
+    return prune_history()
+
+@shared_task(bind=True, name="all_roads.tasks.aggregate_refresh_results")
+def aggregate_refresh_results(self, results):
+    """
+    Chord callback: one summary for all shards. It runs under the id of the
+    refresh_network_task it replaced, so that registration (and the sweep's
+    combined progress) is released here.
+    """
+    _release_inflight(self.request.id)
+    end_sweep(self.request.id)
+    return merge_summaries(results)
+
+@shared_task(bind=True, name="all_roads.tasks.refresh_network_task")
+def refresh_network_task(self, codes=None, sleep_between=0.0, mode="serial"):
+    """
+    Fan a refresh out over the workers: split the segment set into shards
+    (code ranges, or slices of `codes`), run them as a chord and replace this
+    task with it, so AsyncResult(<this task id>) ends up holding the
+    aggregated {"updated", "failed", "total", ...} summary. Meanwhile the
+    shards publish their combined progress under this id (all_roads/progress.py).
+    """
+    sweep_id = self.request.id
     if codes:
-        qs = qs.filter(code__in=codes)
-    return refresh_segments_from_google(qs, sleep_between=sleep_between)
+        codes = sorted(set(codes))
+        total = Segment.objects.filter(code__in=codes).count()
+        header = [
+            refresh_segments_task.s(codes=part, sleep_between=sleep_between, mode=mode, sweep_id=sweep_id)
+            .set(queue=settings.REFRESH_BULK_QUEUE)
+            for part in chunked(codes, settings.REFRESH_SHARD_SIZE)
+        ]
+    else:
+        total = Segment.objects.count()
+        header = [
+            refresh_shard_task.s(lo, hi, sleep_between=sleep_between, mode=mode, sweep_id=sweep_id)
+            for lo, hi in plan_code_shards()
+        ]
+
+    if not header:
+        _release_inflight(sweep_id)
+        return merge_summaries([])
+    start_sweep(self, total, len(header))
+    raise self.replace(chord(header, aggregate_refresh_results.s()))
 
 """
 curl -X POST https://cpmsferma.com/api/update-segments/queue/ \
@@ -1,3 +1,779 @@
-from django.test import TestCase
+import json
+import time
+from datetime import timedelta
+from decimal import Decimal
+from io import StringIO
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import requests
+from celery.exceptions import Ignore, SoftTimeLimitExceeded
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+
+from all_roads import benchmark, history, inflight, metrics, queues, tasks
+from all_roads.addresses import AddressResolutionError, AddressResolver
+from all_roads.api.views import _enqueue_coalesced
+from all_roads.distance_matrix import ResponseCache, coord_key, plan_batches
+from all_roads.fake_distance_matrix import FakeDistanceMatrix, start_in_thread
+from all_roads.models import (
+    Address, RefreshCheckpoint, Road, Route, Segment, SegmentObservation, SegmentTrafficRollup,
+)
+from all_roads.services import (
+    due_segments, get_checkpoint, recolor_segments, refresh_segments_from_google,
+    refresh_stale_segments, retryable_segments, stale_segments,
+)
+from all_roads.throttle import AdaptiveRateController, SharedTokenBucket, TokenBucket
+from all_roads.utils import get_status_color, segment_fingerprint
+
+
+class FakeApiMixin:
+    """Refresh against an in-process fake Distance Matrix, with no shared Redis."""
+
+    def setUp(self):
+        super().setUp()
+        server = start_in_thread()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        self.fake = server.fake
+        self.enterContext(benchmark._isolated(
+            DISTANCE_MATRIX_URL=server.url, RESPONSE_CACHE_TTL=0, REFRESH_RATE_LIMIT=0,
+        ))
+        self.enterContext(mock.patch("all_roads.services.config", return_value="test-key"))
+
+
+def _make_segments(codes):
+    Address.objects.get_or_create(id=1, defaults={"address": "unknown"})
+    route = Route.objects.create(route="F1", road=Road.objects.create(road="F"))
+    return [
+        Segment.objects.create(route=route, code=code, start_lat=i, start_lon=i, end_lat=i + 0.1, end_lon=i)
+        for i, code in enumerate(codes)
+    ]
+
+
+def _segment(pk, start, end):
+    return SimpleNamespace(pk=pk, start_lat=start[0], start_lon=start[1], end_lat=end[0], end_lon=end[1])
+
+
+class PlanBatchesTests(SimpleTestCase):
+    def assertOneElementPerSegment(self, segments, batches):
+        self.assertEqual(sum(len(b) for b in batches), len(segments))
+        self.assertEqual(sum(b.elements for b in batches), len(segments))
+        for b in batches:
+            self.assertTrue(len(b.origins) == 1 or len(b.destinations) == 1)
+
+    def test_contiguous_route_bills_one_element_per_segment(self):
+        segments = [_segment(i, (i, 0), (i + 1, 0)) for i in range(200)]
+        batches = plan_batches(segments, max_elements=100)
+        self.assertOneElementPerSegment(segments, batches)
+        self.assertEqual(len(batches), 200)
+
+    def test_shared_origin_packs_into_rows(self):
+        segments = [_segment(i, (0, 0), (i + 1, 0)) for i in range(60)]
+        batches = plan_batches(segments, max_elements=100)
+        self.assertOneElementPerSegment(segments, batches)
+        # 25 destinations per request at most
+        self.assertEqual([len(b) for b in batches], [25, 25, 10])
+
+    def test_shared_destination_packs_into_columns(self):
+        segments = [_segment(i, (i + 1, 0), (9, 9)) for i in range(30)]
+        batches = plan_batches(segments, max_elements=10)
+        self.assertOneElementPerSegment(segments, batches)
+        self.assertEqual([len(b) for b in batches], [10, 10, 10])
+
+    def test_mixed_segments(self):
+        segments = (
+            [_segment(i, (0, 0), (i + 1, 0)) for i in range(5)]
+            + [_segment(100 + i, (i + 50, 1), (9, 9)) for i in range(5)]
+            + [_segment(200 + i, (i + 70, 2), (i + 80, 2)) for i in range(5)]
+        )
+        batches = plan_batches(segments, max_elements=100)
+        self.assertOneElementPerSegment(segments, batches)
+        self.assertEqual(len(batches), 7)
+
+    def test_identical_segments_share_a_cell(self):
+        segments = [_segment(1, (0, 0), (1, 1)), _segment(2, (0, 0), (1, 1))]
+        batches = plan_batches(segments)
+        self.assertEqual(len(batches), 1)
+        self.assertEqual(batches[0].elements, 1)
+        self.assertEqual(len(batches[0]), 2)
+
+
+class AdaptiveRateControllerTests(SimpleTestCase):
+    def _controller(self, **kwargs):
+        options = dict(min_rate=1.0, increase=1.0, decrease=0.5, threshold=3, cooldown=60.0, max_wait=0.0)
+        options.update(kwargs)
+        return AdaptiveRateController(TokenBucket(rate=8.0), **options)
+
+    def test_throttling_halves_rate_down_to_floor(self):
+        controller = self._controller(threshold=100)
+        controller.record(throttled=True)
+        self.assertEqual(controller.rate, 4.0)
+        for _ in range(5):
+            controller.record(throttled=True)
+        self.assertEqual(controller.rate, 1.0)
+
+    def test_clean_batches_add_back_up_to_ceiling(self):
+        controller = self._controller()
+        controller.record(throttled=True)
+        controller.record(throttled=True)
+        self.assertEqual(controller.rate, 2.0)
+        for _ in range(10):
+            controller.record(throttled=False)
+        self.assertEqual(controller.rate, 8.0)
+
+    def test_circuit_opens_after_threshold(self):
+        controller = self._controller()
+        for _ in range(2):
+            controller.record(throttled=True)
+        self.assertTrue(controller.allow())
+        controller.record(throttled=True)
+        self.assertFalse(controller.allow())
+        self.assertEqual(controller.trips, 1)
+        self.assertFalse(controller.wait_for_slot_sync())  # max_wait=0: give up at once
+
+    def test_half_open_probe_closes_circuit(self):
+        controller = self._controller(threshold=1, cooldown=0.01)
+        controller.record(throttled=True)
+        self.assertFalse(controller.allow())
+        time.sleep(0.02)
+        self.assertTrue(controller.allow())   # the probe
+        self.assertFalse(controller.allow())  # nobody else while it is out
+        controller.record(throttled=False)
+        self.assertTrue(controller.allow())
+
+
+class _DictRedis:
+    """Just enough of a Redis client for SharedTokenBucket."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, ex=None):
+        self.data[key] = value
+
+    def setex(self, key, seconds, value):
+        self.data[key] = value
+
+    def incr(self, key):
+        self.data[key] = int(self.data.get(key, 0)) + 1
+        return self.data[key]
+
+    def expire(self, key, seconds):
+        pass
+
+
+class SharedTokenBucketTests(SimpleTestCase):
+    def test_buckets_on_one_client_split_the_rate(self):
+        client = _DictRedis()
+        buckets = [SharedTokenBucket(client, rate=2.0), SharedTokenBucket(client, rate=2.0)]
+        with mock.patch("all_roads.throttle.time.time", return_value=1000.25):
+            delays = [b.reserve() for b in buckets for _ in range(2)]
+        self.assertEqual(sum(1 for d in delays if d <= 0.01), 2)
+        for d in sorted(delays)[2:]:
+            self.assertAlmostEqual(d, 0.75, delta=0.05)
+
+    def test_rate_changes_are_shared(self):
+        client = _DictRedis()
+        one = SharedTokenBucket(client, rate=8.0, refresh=0)
+        other = SharedTokenBucket(client, rate=8.0, refresh=0)
+        AdaptiveRateController(one, decrease=0.5).record(throttled=True)
+        other.reserve()
+        self.assertEqual(other.rate, 4.0)
+        # the ceiling stays the configured limit, not the lowered shared rate
+        self.assertEqual(AdaptiveRateController(other).max_rate, 8.0)
+
+    def test_falls_back_to_local_limit(self):
+        client = mock.Mock(**{"get.side_effect": ConnectionError, "incr.side_effect": ConnectionError})
+        bucket = SharedTokenBucket(client, rate=1.0)
+        with self.assertLogs("all_roads.throttle", "WARNING"):
+            self.assertEqual(bucket.reserve(), 0)
+            self.assertGreater(bucket.reserve(), 0.9)
+
+
+class InflightRegistryTests(SimpleTestCase):
+    def setUp(self):
+        self.registry = inflight.InflightRegistry(inflight.InMemoryRedis(), ttl=60, lock_ttl=60)
+        patcher = mock.patch("all_roads.inflight._task_finished", return_value=False)
+        self.finished = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_nothing_registered(self):
+        self.assertEqual(self.registry.plan(["A", "B"]), (None, ["A", "B"]))
+        self.assertEqual(self.registry.plan(None), (None, None))
+
+    def test_covered_request_coalesces(self):
+        self.registry.register("t1", ["A", "B"])
+        self.assertEqual(self.registry.plan(["B", "A"]), ("t1", []))
+
+    def test_partial_overlap_names_contributor(self):
+        self.registry.register("t1", ["A", "B"])
+        self.assertEqual(self.registry.plan(["B", "C"]), ("t1", ["C"]))
+
+    def test_whole_network_registration_covers_everything(self):
+        self.registry.register("sweep", None)
+        self.assertEqual(self.registry.plan(["X"]), ("sweep", []))
+        self.assertEqual(self.registry.plan(None), ("sweep", []))
+
+    def test_release(self):
+        self.registry.register("t1", ["A"])
+        self.registry.release("t1")
+        self.assertEqual(self.registry.plan(["A"]), (None, ["A"]))
+
+    def test_finished_tasks_are_dropped(self):
+        self.registry.register("t1", ["A"])
+        self.finished.return_value = True
+        self.assertEqual(self.registry.plan(["A"]), (None, ["A"]))
+        self.assertEqual(self.registry.client.smembers(inflight.TASKS_KEY), set())
+
+    def test_unshared_registry_never_coalesces(self):
+        registry = inflight.InflightRegistry(inflight.InMemoryRedis(), shared=False)
+        registry.register("t1", None)
+        self.assertEqual(registry.plan(["B", "A", "A"]), (None, ["A", "B"]))
+
+    def test_segment_locks(self):
+        self.assertEqual(self.registry.lock_segments([1, 2], "run-1"), [1, 2])
+        self.assertEqual(self.registry.lock_segments([2, 3], "run-2"), [3])
+        self.registry.unlock_segments([1, 2, 3], "run-1")  # 3 is not run-1's
+        self.assertEqual(self.registry.lock_segments([1, 2, 3], "run-3"), [1, 2])
+
+
+class EnqueueCoalescedTests(SimpleTestCase):
+    def setUp(self):
+        registry = inflight.InflightRegistry(inflight.InMemoryRedis(), ttl=60, lock_ttl=60)
+        for patcher in (
+            mock.patch.object(inflight, "_registry", registry),
+            mock.patch("all_roads.inflight._task_finished", return_value=False),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.registry = registry
+
+    def test_failed_enqueue_releases_registration(self):
+        with mock.patch("all_roads.api.views.refresh_segments_task.apply_async", side_effect=OSError("broker down")):
+            with self.assertRaises(OSError):
+                _enqueue_coalesced(["A", "B"], "serial")
+        self.assertEqual(self.registry.plan(["A"]), (None, ["A"]))
+
+        with mock.patch("all_roads.api.views.refresh_segments_task.apply_async") as apply_async:
+            payload = _enqueue_coalesced(["A", "B"], "serial")
+        apply_async.assert_called_once()
+        self.assertEqual(self.registry.plan(["A"]), (payload["task_id"], []))
+
+    @override_settings(REFRESH_SHARD_SIZE=2)
+    def test_lists_longer_than_a_shard_run_as_a_sweep(self):
+        with mock.patch("all_roads.api.views.refresh_network_task.apply_async") as sweep:
+            _enqueue_coalesced(["A", "B", "C"], "serial")
+        self.assertEqual(sweep.call_args.kwargs["kwargs"]["codes"], ["A", "B", "C"])
+
+
+class SegmentFingerprintTests(SimpleTestCase):
+    def test_same_content_same_fingerprint(self):
+        a = segment_fingerprint("F1", "Name", "Lagos", "6.5", "3.3", 6.6, "3.40000")
+        b = segment_fingerprint("F1", "Name", "Lagos", "6.50000", "3.300000", "6.6", "3.4")
+        self.assertEqual(a, b)
+        self.assertEqual(len(a), 32)
+
+    def test_rounds_like_the_database(self):
+        self.assertEqual(
+            segment_fingerprint("F1", "", "", "6.123455", 0, 0, 0),
+            segment_fingerprint("F1", "", "", "6.12346", 0, 0, 0),
+        )
+
+    def test_any_field_changes_it(self):
+        base = ("F1", "Name", "Lagos", "6.5", "3.3", "6.6", "3.4")
+        fingerprint = segment_fingerprint(*base)
+        for i, changed in enumerate(["F2", "Other", "Ogun", "6.6", "3.4", "6.7", "3.5"]):
+            values = list(base)
+            values[i] = changed
+            self.assertNotEqual(segment_fingerprint(*values), fingerprint)
+
+
+class AddressResolverTests(TestCase):
+    def setUp(self):
+        patcher = mock.patch("all_roads.addresses.get_redis", return_value=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_creates_missing_and_reuses_existing(self):
+        existing = Address.objects.create(address="A", lat=1, lng=1)
+        ids = AddressResolver().resolve_many({"A": (0, 0), "B": (2, 2)})
+        self.assertEqual(ids["A"], existing.pk)
+        self.assertEqual(ids["B"], Address.objects.get(address="B").pk)
+
+    def test_dropped_inserts_are_retried(self):
+        create = Address.objects.bulk_create
+        calls = []
+
+        def drop_first_attempt(objs, **kwargs):
+            calls.append([o.address for o in objs])
+            return create(objs[1:] if len(calls) == 1 else objs, **kwargs)
+
+        with mock.patch.object(Address.objects, "bulk_create", side_effect=drop_first_attempt):
+            ids = AddressResolver().resolve_many({"A": (0, 0), "B": (0, 0)})
+        self.assertEqual(set(ids), {"A", "B"})
+        self.assertEqual(calls, [["A", "B"], ["A"]])
+
+    def test_unresolvable_addresses_raise(self):
+        create = Address.objects.bulk_create
+
+        def never_store_a(objs, **kwargs):
+            return create([o for o in objs if o.address != "A"], **kwargs)
+
+        with mock.patch.object(Address.objects, "bulk_create", side_effect=never_store_a):
+            with self.assertRaises(AddressResolutionError) as ctx:
+                AddressResolver().resolve_many({"A": (0, 0), "B": (0, 0)})
+        self.assertEqual(ctx.exception.missing, ["A"])
+        self.assertEqual(set(ctx.exception.resolved), {"B"})
+
+
+class StaleSelectionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Address.objects.create(id=1, address="unknown")
+        route = Route.objects.create(route="F1", road=Road.objects.create(road="F"))
+        now = timezone.now()
+        # created out of age order, so pk order would be wrong
+        for code, hours in [("B", 5), ("NEW", 0), ("C", 2), ("NEVER", None), ("A", 9)]:
+            refreshed = None if hours is None else now - timedelta(hours=hours)
+            Segment.objects.create(
+                route=route, code=code, last_refreshed_at=refreshed,
+                next_refresh_at=refreshed and refreshed + timedelta(hours=1),
+            )
+
+    def codes(self, qs):
+        return [s.code for s in qs]
+
+    def test_stale_segments_oldest_first(self):
+        self.assertEqual(self.codes(stale_segments(max_age=3600, limit=10)), ["NEVER", "A", "B", "C"])
+        self.assertEqual(self.codes(stale_segments(max_age=3600, limit=2)), ["NEVER", "A"])
+        self.assertEqual(self.codes(stale_segments(max_age=6 * 3600, limit=10)), ["NEVER", "A"])
+
+    def test_due_segments_most_overdue_first(self):
+        self.assertEqual(self.codes(due_segments(10)), ["NEVER", "A", "B", "C"])
+
+    def test_refresh_stamps_last_refreshed_at(self):
+        server = start_in_thread()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        with benchmark._isolated(DISTANCE_MATRIX_URL=server.url, RESPONSE_CACHE_TTL=0, REFRESH_RATE_LIMIT=0), \
+                mock.patch("all_roads.services.config", return_value="test-key"):
+            summary = refresh_stale_segments(max_age=3600, limit=10)
+        self.assertEqual(summary["updated"], 4)
+        self.assertEqual(self.codes(stale_segments(max_age=3600, limit=10)), [])
+
+
+@override_settings(REFRESH_RETRY_MAX_ATTEMPTS=3)
+class RefreshSelectionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Address.objects.create(id=1, address="unknown")
+        route = Route.objects.create(route="F1", road=Road.objects.create(road="F"))
+        now = timezone.now()
+
+        def ago(hours):
+            return now - timedelta(hours=hours)
+
+        for code, refreshed, extra in [
+            ("OLD", ago(5), {}),
+            ("NEVER", None, {}),
+            ("OLDER", ago(9), {}),
+            ("FRESH", now, {}),
+            ("BACKOFF", ago(8), {"error_processing": True, "error_attempts": 1, "next_retry_at": now + timedelta(hours=1)}),
+            ("GAVE_UP", ago(7), {"error_processing": True, "error_attempts": 3, "next_retry_at": ago(1)}),
+            ("RETRY", ago(6), {"error_processing": True, "error_attempts": 2, "next_retry_at": ago(1)}),
+        ]:
+            Segment.objects.create(
+                route=route, code=code, last_refreshed_at=refreshed,
+                next_refresh_at=refreshed and refreshed + timedelta(hours=1), **extra,
+            )
+
+    def codes(self, qs):
+        return {s.code for s in qs}
+
+    def test_failed_segments_backing_off_or_out_of_retries_are_skipped(self):
+        self.assertEqual(self.codes(stale_segments(max_age=3600, limit=10)), {"NEVER", "OLDER", "RETRY", "OLD"})
+        self.assertEqual(self.codes(due_segments(10)), {"NEVER", "OLDER", "RETRY", "OLD"})
+
+    def test_retryable_segments_earliest_retry_first(self):
+        Segment.objects.filter(code="OLD").update(
+            error_processing=True, error_attempts=1, next_retry_at=timezone.now() - timedelta(hours=2),
+        )
+        self.assertEqual([s.code for s in retryable_segments()], ["OLD", "RETRY"])
+        self.assertEqual(
+            [s.code for s in retryable_segments(force=True)], ["OLD", "RETRY", "BACKOFF"],
+        )
+
+
+class MetricsExportTests(SimpleTestCase):
+    def test_redis_failure_falls_back_to_process_totals(self):
+        client = mock.Mock(**{"hgetall.side_effect": ConnectionError("down")})
+        with mock.patch.object(metrics, "_get_redis", return_value=client), \
+                mock.patch.object(metrics, "_process", metrics.MetricsRecorder()):
+            metrics._process.observe("db_write", 0.002, 3)
+            with self.assertLogs("all_roads.metrics", "WARNING"):
+                text = metrics.render_prometheus()
+        self.assertIn('roads_refresh_segment_stage_seconds_count{stage="db_write"} 3', text)
+
+
+class FailureReasonTests(TestCase):
+    """The API key in request URLs never reaches last_error, the API or the logs."""
+
+    KEY = "AIzaSECRET"
+
+    @classmethod
+    def setUpTestData(cls):
+        Address.objects.create(id=1, address="unknown")
+        route = Route.objects.create(route="F1", road=Road.objects.create(road="F"))
+        # BROKEN first, so it is the example the failure summary logs
+        Segment.objects.create(route=route, code="BROKEN", start_lat=5, start_lon=5, end_lat=6, end_lon=6)
+        Segment.objects.create(route=route, code="BAD", start_lat=1, start_lon=1, end_lat=2, end_lon=2)
+
+    def setUp(self):
+        self.enterContext(benchmark._isolated(RESPONSE_CACHE_TTL=0, REFRESH_RATE_LIMIT=0))
+        self.enterContext(mock.patch("all_roads.services.config", return_value=self.KEY))
+
+    def fake_get(self, url, **kwargs):
+        self.assertIn(self.KEY, url)
+        if "origins=1" in url:
+            return mock.Mock(status_code=400)
+        raise requests.HTTPError(f"400 Client Error: Bad Request for url: {url}")
+
+    def test_key_is_not_stored_or_served(self):
+        with mock.patch("all_roads.distance_matrix.http_client.get", side_effect=self.fake_get), \
+                self.assertLogs("all_roads.services", "WARNING") as logs:
+            summary = refresh_segments_from_google(Segment.objects.all())
+        self.assertEqual(summary["failed"], 2)
+        self.assertIn("e.g. BROKEN: HTTPError: 400 Client Error", logs.output[0])
+        self.assertNotIn(self.KEY, "\n".join(logs.output))
+        reasons = dict(Segment.objects.values_list("code", "last_error"))
+        self.assertEqual(reasons["BAD"], "ValueError: HTTP 400")
+        self.assertTrue(reasons["BROKEN"].startswith("HTTPError: 400 Client Error"))
+        self.assertNotIn(self.KEY, reasons["BROKEN"])
+
+        with override_settings(ALLOWED_HOSTS=["*"]):
+            response = self.client.get("/api/failed-segments/", secure=True)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["count"], 2)
+        self.assertNotIn(self.KEY, response.content.decode())
+
+
+class SelectionTaskSoftLimitTests(SimpleTestCase):
+    def _cut_off_after(self, processed):
+        def refresh(limit, progress, **kwargs):
+            if processed:
+                progress({"processed": processed})
+            raise SoftTimeLimitExceeded()
+        return refresh
+
+    def test_continues_with_what_is_left(self):
+        task = tasks.refresh_stale_segments_task
+        with mock.patch.object(tasks, "refresh_stale_segments", self._cut_off_after(300)), \
+                mock.patch.object(task, "replace", return_value=Ignore()) as replace:
+            with self.assertRaises(Ignore):
+                task(limit=1000, mode="async")
+        continuation = replace.call_args[0][0]
+        self.assertEqual(continuation.kwargs["limit"], 700)
+        self.assertEqual(continuation.kwargs["mode"], "async")
+
+    def test_defaults_to_the_configured_limits(self):
+        for task, name, setting in [
+            (tasks.retry_failed_segments_task, "retry_failed_segments", "REFRESH_RETRY_LIMIT"),
+            (tasks.schedule_adaptive_refresh_task, "refresh_due_segments", "REFRESH_BUDGET_PER_HOUR"),
+        ]:
+            with self.subTest(task=task.name), override_settings(**{setting: 3600}), \
+                    mock.patch.object(tasks, name, self._cut_off_after(100)), \
+                    mock.patch.object(task, "replace", return_value=Ignore()) as replace:
+                with self.assertRaises(Ignore):
+                    task()
+                self.assertGreater(replace.call_args[0][0].kwargs["limit"], 0)
+
+    def test_run_without_progress_gives_up(self):
+        with mock.patch.object(tasks, "refresh_stale_segments", self._cut_off_after(0)):
+            with self.assertRaises(SoftTimeLimitExceeded):
+                tasks.refresh_stale_segments_task(limit=1000)
+
+
+class RefreshCheckpointTests(FakeApiMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        _make_segments(["S1", "S2", "S3"])
+
+    def test_rerunning_a_finished_code_set_refreshes_every_segment(self):
+        for _ in range(2):
+            Segment.objects.update(last_refreshed_at=None)
+            summary = tasks.refresh_segments_task(codes=["S1", "S2", "S3"])
+            self.assertEqual((summary["total"], summary["updated"]), (3, 3))
+            self.assertFalse(Segment.objects.filter(last_refreshed_at=None).exists())
+        self.assertFalse(RefreshCheckpoint.objects.exists())
+
+    def test_finished_shard_deletes_its_checkpoint(self):
+        for _ in range(2):
+            summary = tasks.refresh_shard_task("S1", "S3")
+            self.assertEqual(summary["updated"], 3)
+        self.assertFalse(RefreshCheckpoint.objects.exists())
+
+    def test_abandoned_checkpoints_are_cleared(self):
+        RefreshCheckpoint.objects.create(key="shard:A:B", last_pk=10)
+        RefreshCheckpoint.objects.update(updated_at=timezone.now() - timedelta(days=1))
+        get_checkpoint("shard:S1:S3")
+        self.assertEqual(list(RefreshCheckpoint.objects.values_list("key", flat=True)), ["shard:S1:S3"])
+
+
+class QueueRoutingTests(SimpleTestCase):
+    def route(self, name, **kwargs):
+        return queues.route_task(name, (), kwargs, {})["queue"]
+
+    @override_settings(REFRESH_INTERACTIVE_QUEUE="interactive", REFRESH_BULK_QUEUE="bulk",
+                       REFRESH_INTERACTIVE_MAX_CODES=2)
+    def test_small_first_attempts_are_interactive(self):
+        refresh = "all_roads.tasks.refresh_segments_task"
+        self.assertEqual(self.route(refresh, codes=["A", "B"]), "interactive")
+        self.assertEqual(self.route(refresh, codes=["A", "B", "C"]), "bulk")
+        self.assertEqual(self.route(refresh, codes=["A"], requeue_attempt=1), "bulk")
+        self.assertEqual(self.route(refresh), "bulk")
+        self.assertEqual(self.route("all_roads.tasks.refresh_network_task"), "bulk")
+        self.assertIsNone(queues.route_task("other.task", (), {}, {}))
+
+
+class QueueDepthTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(queues, "_depths", None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        connection = mock.patch.object(queues.current_app, "connection_for_read")
+        self.connection = connection.start()
+        self.addCleanup(connection.stop)
+        channel = self.connection.return_value.__enter__.return_value.channel.return_value.__enter__.return_value
+        channel.queue_declare.return_value.message_count = 7
+
+    @override_settings(REFRESH_QUEUE_DEPTH_CACHE=60)
+    def test_depth_is_cached(self):
+        self.assertEqual([queues.queue_depth("bulk") for _ in range(3)], [7, 7, 7])
+        self.assertEqual(self.connection.call_count, 1)
+
+    @override_settings(REFRESH_QUEUE_DEPTH_CACHE=0)
+    def test_zero_disables_the_cache(self):
+        queues.queue_depth("bulk")
+        queues.queue_depth("bulk")
+        self.assertEqual(self.connection.call_count, 2)
+
+
+class FakeDistanceMatrixTests(SimpleTestCase):
+    def test_answers_every_pair_deterministically(self):
+        query = {"origins": ["6.5,3.3|6.6,3.4"], "destinations": ["7.0,3.5"]}
+        status, payload = FakeDistanceMatrix().respond(query)
+        self.assertEqual((status, payload["status"]), (200, "OK"))
+        self.assertEqual([len(row["elements"]) for row in payload["rows"]], [1, 1])
+        self.assertEqual(FakeDistanceMatrix().respond(query)[1], payload)
+
+    def test_qps_ceiling_throttles(self):
+        fake = FakeDistanceMatrix(qps=1)
+        query = {"origins": ["1,1"], "destinations": ["2,2"]}
+        self.assertEqual([fake.respond(query)[0] for _ in range(2)], [200, 429])
+        self.assertEqual(fake.stats["throttled"], 1)
+
+    def test_bad_query_is_invalid_request(self):
+        self.assertEqual(FakeDistanceMatrix().respond({})[1]["status"], "INVALID_REQUEST")
+
+
+class BenchmarkRefreshCommandTests(TestCase):
+    def setUp(self):
+        self.enterContext(mock.patch("all_roads.services.config", return_value="test-key"))
+
+    def _run(self, **options):
+        out = StringIO()
+        call_command(
+            "benchmark_refresh", segments=30, latency=0, jitter=0, rate_limit=0,
+            use_configured_db=True, json=True, stdout=out, **options,
+        )
+        return json.loads(out.getvalue())
+
+    def test_every_mode_refreshes_every_segment(self):
+        results = self._run()
+        self.assertEqual([r["mode"] for r in results], ["serial", "async"])
+        for r in results:
+            self.assertEqual((r["segments"], r["updated"], r["failed"]), (30, 30, 0))
+            self.assertGreater(r["api_calls_per_segment"], 0)
+            self.assertLessEqual(r["api_calls_per_segment"], 1)
+        self.assertFalse(benchmark.benchmark_segments().exists())  # cleaned up
+
+    def test_element_errors_show_as_failures(self):
+        with self.assertLogs("all_roads.services", "WARNING"):
+            [result] = self._run(modes="serial", error_rate=1.0)
+        self.assertEqual((result["updated"], result["failed"]), (0, 30))
+
+
+class ResponseCacheTests(SimpleTestCase):
+    result = {
+        "distance": Decimal("1.25"), "travel_time": 90, "avg_speed": Decimal("50.0"),
+        "status": "FF9966", "origin_address": "a", "destination_address": "b",
+    }
+
+    def setUp(self):
+        patcher = mock.patch("all_roads.distance_matrix.get_redis", return_value=None)
+        self.get_redis = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_key_ignores_coordinate_formatting(self):
+        self.assertEqual(
+            coord_key(_segment(1, ("6.5", "3.30"), (Decimal("6.60000"), 3.4))),
+            coord_key(_segment(2, (6.5, 3.3), ("6.6", "3.4"))),
+        )
+
+    def test_entries_expire_after_ttl(self):
+        cache, segment = ResponseCache(ttl=60), _segment(1, (1, 1), (2, 2))
+        cache.set(segment, self.result)
+        self.assertEqual(cache.get(_segment(2, (1, 1), (2, 2))), self.result)
+        with mock.patch("all_roads.caching.time.monotonic", return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.get(segment))
+
+    def test_zero_ttl_disables_it(self):
+        cache, segment = ResponseCache(ttl=0), _segment(1, (1, 1), (2, 2))
+        cache.set(segment, self.result)
+        self.assertIsNone(cache.get(segment))
+
+    def test_shared_through_redis(self):
+        self.get_redis.return_value = _DictRedis()
+        segment = _segment(1, (1, 1), (2, 2))
+        ResponseCache(ttl=60).set(segment, self.result)
+        self.assertEqual(ResponseCache(ttl=60).get(segment), self.result)  # another process
+
+
+class ResponseCacheRefreshTests(FakeApiMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.enterContext(override_settings(RESPONSE_CACHE_TTL=300))
+        self.enterContext(mock.patch.object(benchmark.distance_matrix, "_response_cache", None))
+        route = _make_segments(["S1"])[0].route
+        # Same coordinates as S1.
+        Segment.objects.create(route=route, code="TWIN", start_lat=0, start_lon=0, end_lat=0.1, end_lon=0)
+
+    def test_repeated_pairs_skip_the_api(self):
+        first = refresh_segments_from_google(Segment.objects.order_by("pk"))
+        self.assertEqual((first["updated"], first["cache_hits"]), (2, 0))
+        requests_sent = self.fake.stats["requests"]
+
+        second = refresh_segments_from_google(Segment.objects.order_by("pk"))
+        self.assertEqual((second["updated"], second["cache_hits"]), (2, 2))
+        self.assertEqual(self.fake.stats["requests"], requests_sent)
+
+
+class TrafficHistoryTests(TestCase):
+    def setUp(self):
+        self.segment = _make_segments(["S1"])[0]
+        # Two complete days back, so both days and all their hours are finished
+        self.day = history._bucket_start(history.DAY, timezone.now() - timedelta(days=2))
+
+    def _observe(self, hour, minute, travel_time, speed):
+        SegmentObservation.objects.create(
+            segment=self.segment, observed_at=self.day + timedelta(hours=hour, minutes=minute),
+            travel_time=travel_time, avg_speed_tenths=speed * 10, status="FF9966",
+        )
+
+    def _close_day(self):
+        # A day is only rolled up once an hour after it has been
+        self._observe(25, 0, 500, 50)
+
+    def test_records_one_row_per_segment(self):
+        refreshed = SimpleNamespace(
+            pk=self.segment.pk, last_refreshed_at=timezone.now(),
+            travel_time=120, avg_speed=Decimal("42.37"), status="FF9966",
+        )
+        self.assertEqual(history.record_observations([refreshed]), 1)
+        self.assertEqual(SegmentObservation.objects.get().avg_speed_tenths, 423)
+        with override_settings(REFRESH_RECORD_OBSERVATIONS=False):
+            self.assertEqual(history.record_observations([refreshed]), 0)
+
+    def test_rollups_aggregate_hours_then_days(self):
+        self._observe(8, 0, 100, 40)
+        self._observe(8, 30, 200, 20)
+        self._observe(9, 0, 300, 10)
+        self._close_day()
+        history.rollup_observations()
+
+        hours = SegmentTrafficRollup.objects.filter(
+            period=history.HOUR, bucket_start__lt=self.day + timedelta(days=1),
+        ).order_by("bucket_start")
+        self.assertEqual(
+            [(h.samples, h.avg_travel_time, h.max_travel_time, h.avg_speed) for h in hours],
+            [(2, 150, 200, Decimal("30.0")), (1, 300, 300, Decimal("10.0"))],
+        )
+        day = SegmentTrafficRollup.objects.get(period=history.DAY)
+        self.assertEqual((day.samples, day.avg_travel_time, day.min_speed), (3, 200, Decimal("10.0")))
+
+    def test_rollup_rerun_writes_nothing_new(self):
+        self._observe(8, 0, 100, 40)
+        self._close_day()
+        history.rollup_observations()
+        self.assertEqual(history.rollup_observations(), {
+            "hourly": {"period": history.HOUR, "rows": 0}, "daily": {"period": history.DAY, "rows": 0},
+        })
+        self.assertEqual(SegmentTrafficRollup.objects.count(), 3)
+
+    @override_settings(OBSERVATION_RETENTION_DAYS=0)
+    def test_prune_keeps_observations_until_rolled_up(self):
+        self._observe(8, 0, 100, 40)
+        self._close_day()
+        self.assertEqual(history.prune_history()["observations"], 0)
+
+        history.rollup_observations()
+        self.assertEqual(history.prune_history(), {"observations": 2, "hourly": 0, "daily": 0})
+        self.assertEqual(SegmentTrafficRollup.objects.count(), 3)
+
+
+THREE_COLORS = [[30, "FF0000"], [60, "FFFFCC"], [None, "00CC00"]]
+
+
+class StatusColorTests(SimpleTestCase):
+    def test_default_thresholds(self):
+        self.assertEqual(
+            [get_status_color(v) for v in (0, 1, 39.9, 40, 89.9, 90, 250)],
+            ["666699", "FF0000", "FF0000", "FF5050", "339933", "006600", "006600"],
+        )
+
+    def test_configured_thresholds(self):
+        with override_settings(SPEED_STATUS_THRESHOLDS=THREE_COLORS):
+            self.assertEqual(
+                [get_status_color(v) for v in (0, 29.9, 30, 59.9, 60, 250)],
+                ["FF0000", "FF0000", "FFFFCC", "FFFFCC", "00CC00", "00CC00"],
+            )
+        self.assertEqual(get_status_color(30), "FF0000")  # back to the defaults
+
+    def test_without_open_bound_top_speeds_get_no_response(self):
+        with override_settings(SPEED_STATUS_THRESHOLDS=[[50, "FF0000"]]):
+            self.assertEqual(get_status_color(50), "666699")
+
+
+class RecolorSegmentsTests(TestCase):
+    speeds = [Decimal(v) for v in ("0.0", "29.9", "30.0", "45.5", "60.0", "99.9")]
+
+    def setUp(self):
+        segments = _make_segments([f"S{i}" for i in range(len(self.speeds))])
+        for segment, speed in zip(segments, self.speeds):
+            segment.avg_speed, segment.status = speed, get_status_color(speed)
+        Segment.objects.bulk_update(segments, ["avg_speed", "status"])
+
+    def _statuses(self):
+        return list(Segment.objects.order_by("avg_speed").values_list("status", flat=True))
+
+    def test_matches_get_status_color(self):
+        before = self._statuses()
+        with override_settings(SPEED_STATUS_THRESHOLDS=THREE_COLORS):
+            self.assertEqual(recolor_segments(dry_run=True), 5)
+            self.assertEqual(self._statuses(), before)
+
+            self.assertEqual(recolor_segments(), 5)
+            self.assertEqual(self._statuses(), [get_status_color(v) for v in self.speeds])
+            self.assertEqual(recolor_segments(), 0)
+
+    def test_command(self):
+        out = StringIO()
+        with override_settings(SPEED_STATUS_THRESHOLDS=THREE_COLORS):
+            call_command("recolor_segments", "--dry-run", stdout=out)
+        self.assertIn("5 segment(s) would change.", out.getvalue())
+        self.assertEqual(self._statuses(), [get_status_color(v) for v in self.speeds])
@@ -0,0 +1,224 @@
+# all_roads/throttle.py
+"""
+Rate limiting shared by the serial and asyncio refresh engines.
+
+TokenBucket limits one refresh run. SharedTokenBucket keeps the limit and
+the AIMD-adjusted rate in Redis, so every run on the same API key (e.g. the
+shards of a sweep) shares REFRESH_RATE_LIMIT instead of each getting its own.
+"""
+import asyncio
+import logging
+import math
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Token bucket configured in requests/sec, with an optional minimum gap
+    between consecutive requests (used to honour `sleep_between`).
+
+    Callers *reserve* a slot and then sleep for the returned delay, so the
+    same bucket works from plain threads and from any asyncio loop.
+    """
+
+    def __init__(self, rate, burst=None, min_interval=0.0):
+        self.rate = float(rate) if rate else 0.0  # 0 -> unlimited
+        self.capacity = float(burst if burst is not None else max(1.0, self.rate))
+        self.min_interval = max(0.0, float(min_interval or 0.0))
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._next_allowed = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take one token; return how many seconds the caller must wait."""
+        with self._lock:
+            now = time.monotonic()
+            at = now
+            if self.rate > 0:
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                self._tokens -= 1.0
+                if self._tokens < 0:
+                    at = now + (-self._tokens / self.rate)
+            at = max(at, self._next_allowed)
+            self._next_allowed = at + self.min_interval
+            return at - now
+
+    def set_rate(self, rate):
+        with self._lock:
+            now = time.monotonic()
+            if self.rate > 0:
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self.rate = float(rate)
+
+    def acquire_sync(self):
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire(self):
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class SharedTokenBucket(TokenBucket):
+    """
+    TokenBucket whose budget lives in Redis: requests are counted per time
+    window (one second, or 1/rate seconds below 1 req/s) under
+    `<key>:<window>`, and a caller whose window is full takes a place in the
+    next one with room. set_rate() stores the rate under `<key>:rate` for all
+    processes; each re-reads it at most every `refresh` seconds.
+
+    min_interval stays per instance. If Redis fails, the instance falls
+    back to limiting itself locally.
+    """
+
+    RATE_TTL = 600     # a lowered rate is forgotten this long after the last change
+    MAX_WINDOWS = 600  # how far ahead reserve() looks for a window with room
+
+    def __init__(self, client, rate, min_interval=0.0, key="refresh:rate_limit", refresh=1.0):
+        super().__init__(rate, min_interval=min_interval)
+        self.client = client
+        self.key = key
+        self.limit = self.rate
+        self.refresh = refresh
+        self._rate_read_at = None
+
+    def _shared_rate(self):
+        now = time.monotonic()
+        if self._rate_read_at is None or now - self._rate_read_at >= self.refresh:
+            self._rate_read_at = now
+            value = self.client.get(f"{self.key}:rate")
+            self.rate = float(value) if value is not None else self.limit
+        return self.rate
+
+    def reserve(self):
+        try:
+            rate = self._shared_rate()
+            if rate <= 0:
+                return super().reserve()
+            window = max(1.0, 1.0 / rate)
+            allowance = max(1, int(rate * window))
+            now = time.time()
+            slot = int(now // window)
+            for ahead in range(self.MAX_WINDOWS):
+                key = f"{self.key}:{slot + ahead}"
+                count = self.client.incr(key)
+                if count == 1:
+                    self.client.expire(key, math.ceil(window * (ahead + 2)))
+                if count <= allowance:
+                    break
+            at = max(now, (slot + ahead) * window)
+        except Exception as e:
+            logger.warning("Shared rate limit unavailable, limiting locally: %s", e)
+            return super().reserve()
+        with self._lock:
+            wall_offset = time.monotonic() - now
+            at = max(at + wall_offset, self._next_allowed)
+            self._next_allowed = at + self.min_interval
+            return at - time.monotonic()
+
+    def set_rate(self, rate):
+        super().set_rate(rate)
+        try:
+            self.client.set(f"{self.key}:rate", repr(float(rate)), ex=self.RATE_TTL)
+            self._rate_read_at = time.monotonic()
+        except Exception as e:
+            logger.warning("Shared rate update failed: %s", e)
+
+
+class AdaptiveRateController:
+    """
+    AIMD rate control plus a circuit breaker around a TokenBucket.
+
+    Every clean batch adds `increase` req/s (up to the configured ceiling);
+    every throttled batch multiplies the rate by `decrease` (down to
+    `min_rate`). After `threshold` throttled batches in a row the circuit
+    opens for `cooldown` seconds, during which allow() is False; then a
+    single probe is let through and its outcome closes or re-opens it.
+
+    wait_for_slot() pauses callers while the circuit is open, up to
+    `max_wait` seconds in total per controller; after that it returns False
+    so the caller can defer the work instead of stalling the whole run.
+
+    With a SharedTokenBucket the rate itself is shared, so a throttled batch
+    in one run slows every run; the circuit breaker stays per controller.
+    """
+
+    def __init__(self, bucket, min_rate=0.5, increase=0.5, decrease=0.5, threshold=5,
+                 cooldown=60.0, max_wait=120.0):
+        self.bucket = bucket
+        self.max_rate = getattr(bucket, "limit", bucket.rate)
+        self.min_rate = min(min_rate, self.max_rate) if self.max_rate else min_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_until = None
+        self.max_wait = max_wait
+        self.waited = 0.0
+        self.trips = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    def allow(self):
+        with self._lock:
+            if self.opened_until is None:
+                return True
+            if time.monotonic() < self.opened_until or self._probing:
+                return False
+            self._probing = True  # half-open: one request decides
+            return True
+
+    def _pause(self):
+        """Seconds to sleep before asking again, or None once max_wait is spent."""
+        with self._lock:
+            if self.waited >= self.max_wait:
+                return None
+            remaining = (self.opened_until or 0) - time.monotonic()
+            pause = min(max(remaining, 0.05), 0.5, self.max_wait - self.waited)
+            self.waited += pause
+            return pause
+
+    def wait_for_slot_sync(self):
+        while not self.allow():
+            pause = self._pause()
+            if pause is None:
+                return False
+            time.sleep(pause)
+        return True
+
+    async def wait_for_slot(self):
+        while not self.allow():
+            pause = self._pause()
+            if pause is None:
+                return False
+            await asyncio.sleep(pause)
+        return True
+
+    def record(self, throttled):
+        with self._lock:
+            self._probing = False
+            if throttled:
+                self.consecutive_failures += 1
+                if self.bucket.rate > 0:
+                    self.bucket.set_rate(max(self.min_rate, self.bucket.rate * self.decrease))
+                if self.consecutive_failures >= self.threshold:
+                    self.opened_until = time.monotonic() + self.cooldown
+                    self.trips += 1
+            else:
+                self.consecutive_failures = 0
+                self.opened_until = None
+                if self.bucket.rate > 0 and self.max_rate:
+                    self.bucket.set_rate(min(self.max_rate, self.bucket.rate + self.increase))
@@ -1,4 +1,11 @@
 # Keep in one place so services, api, tasks can import without circulars
+import hashlib
+from bisect import bisect_right
+from decimal import Decimal, ROUND_HALF_UP
+from django.conf import settings
+
+# Default (upper speed bound in km/h, color) pairs, ascending; a speed gets the
+# color of the first bound it is below. Override with SPEED_STATUS_THRESHOLDS.
 SPEED_COLOR_CODES = [
     (1, '666699'),   # No response / very slow
     (40, 'FF0000'),  # Werser
@@ -9,9 +16,56 @@ SPEED_COLOR_CODES = [
     (90, '339933'),  # Good
     (float('inf'), '006600'),  # Better
 ]
+NO_RESPONSE = '666699'
+
+_table = (None, (), ())  # (source, bounds, colors)
+
+def status_thresholds():
+    """
+    Active (bound, color) pairs: settings.SPEED_STATUS_THRESHOLDS when set
+    (a None bound means "no upper bound"), else SPEED_COLOR_CODES.
+    """
+    configured = getattr(settings, "SPEED_STATUS_THRESHOLDS", None)
+    if not configured:
+        return SPEED_COLOR_CODES
+    return [(float('inf') if bound is None else float(bound), color) for bound, color in configured]
+
+def _lookup_table():
+    global _table
+    source = getattr(settings, "SPEED_STATUS_THRESHOLDS", None)
+    if _table[0] is not source or not _table[1]:
+        pairs = sorted(status_thresholds(), key=lambda p: p[0])
+        _table = (source, tuple(b for b, _ in pairs), tuple(c for _, c in pairs))
+    return _table[1], _table[2]
 
 def get_status_color(speed: float) -> str:
-    for threshold, color in SPEED_COLOR_CODES:
-        if speed < threshold:
-            return color
-    return '666699'
+    bounds, colors = _lookup_table()
+    i = bisect_right(bounds, float(speed))
+    return colors[i] if i < len(colors) else NO_RESPONSE
+
+
+def chunked(iterable, size):
+    """Yield lists of up to `size` items from any iterable."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+_COORD = Decimal("0.00001")  # Segment coordinates keep 5 decimal places
+
+def segment_fingerprint(route, name, state, start_lat, start_lon, end_lat, end_lon):
+    """
+    Hash of the uploaded content of a segment (route code, name, state and
+    coordinates as stored), so an import can tell when a row changed.
+    """
+    coords = [
+        str(Decimal(str(c)).quantize(_COORD, rounding=ROUND_HALF_UP))
+        for c in (start_lat, start_lon, end_lat, end_lon)
+    ]
+    raw = "\x1f".join([route, name, state, *coords])
+    return hashlib.blake2b(raw.encode(), digest_size=16).hexdigest()
@@ -1,6 +1,12 @@
+from django.http import HttpResponse
 from django.shortcuts import render
 from all_roads.models import Segment
+from all_roads.metrics import render_prometheus
 
 def segment_list(request):
     segments = Segment.objects.all()
     return render(request, 'all_roads/segment_list.html', {'segments': segments})
+
+def metrics_view(request):
+    """Prometheus scrape endpoint for the refresh pipeline histograms."""
+    return HttpResponse(render_prometheus(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -13,4 +13,16 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'roads.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after Django is set up
+from all_roads.api.sse import TASK_EVENTS_PATH, task_events  # noqa: E402
+
+
+async def application(scope, receive, send):
+    """Serve task progress streams directly; everything else goes to Django."""
+    if scope["type"] == "http" and scope["method"] == "GET":
+        match = TASK_EVENTS_PATH.match(scope["path"])
+        if match:
+            return await task_events(scope, receive, send, match["task_id"])
+    return await django_application(scope, receive, send)
@@ -6,3 +6,19 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "roads.settings")
 app = Celery("roads")
 app.config_from_object("django.conf:settings", namespace="CELERY")
 app.autodiscover_tasks()  # finds tasks.py in your apps
+
+# Refresh work can be split over queues (all_roads/queues.py). By default
+# REFRESH_INTERACTIVE_QUEUE and REFRESH_BULK_QUEUE are both the default
+# queue, so the usual single worker keeps consuming everything:
+#
+#   celery -A roads worker
+#
+# To keep sweeps from holding the slots interactive refreshes need, set
+# REFRESH_INTERACTIVE_QUEUE=interactive and REFRESH_BULK_QUEUE=bulk (for the
+# web process and the workers alike) and give each queue its own pool:
+#
+#   celery -A roads worker -n interactive@%h -Q interactive -c ${CELERY_INTERACTIVE_CONCURRENCY:-4}
+#   celery -A roads worker -n bulk@%h -Q bulk,default -c ${CELERY_BULK_CONCURRENCY:-2}
+#
+# Start those workers before switching the settings, or queued refreshes
+# wait for a consumer.
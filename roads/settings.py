@@ -1,4 +1,5 @@
 from pathlib import Path
+import json
 import os
 from decouple import config
 
@@ -157,6 +158,17 @@ STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / "media"
 
+# Segment uploads (website/readers.py) stream rows, so the size cap is about
+# upload time rather than memory; rows are imported UPLOAD_BATCH_SIZE at a time.
+UPLOAD_MAX_FILE_MB = int(os.getenv("UPLOAD_MAX_FILE_MB", "200"))
+UPLOAD_BATCH_SIZE = int(os.getenv("UPLOAD_BATCH_SIZE", "1000"))
+# An import job keeps (and reports) only this many row error messages
+UPLOAD_MAX_ERRORS = int(os.getenv("UPLOAD_MAX_ERRORS", "100"))
+# The import task runs far past CELERY_TASK_TIME_LIMIT on a file near the cap
+# (a 200 MB CSV is a few million rows), so it gets its own limits
+UPLOAD_TASK_SOFT_TIME_LIMIT = int(os.getenv("UPLOAD_TASK_SOFT_TIME_LIMIT", str(60 * 60)))
+UPLOAD_TASK_TIME_LIMIT = int(os.getenv("UPLOAD_TASK_TIME_LIMIT", str(60 * 65)))
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.0/ref/settings/#default-auto-field
 
@@ -172,10 +184,127 @@ CELERY_TASK_TIME_LIMIT = 60 * 5   # hard limit per task (seconds)
 CELERY_TASK_SOFT_TIME_LIMIT = 60 * 4
 CELERY_WORKER_CONCURRENCY = int(os.getenv("CELERY_WORKER_CONCURRENCY", "2"))
 CELERY_TASK_DEFAULT_QUEUE = "default"
+# Long sweeps shouldn't sit on prefetched interactive work
+CELERY_WORKER_PREFETCH_MULTIPLIER = int(os.getenv("CELERY_WORKER_PREFETCH_MULTIPLIER", "1"))
+
+# Priority queues (all_roads/queues.py): code-list refreshes of up to
+# INTERACTIVE_MAX_CODES segments go to the interactive queue, every sweep to
+# the bulk queue. Both default to the default queue, so a plain
+# `celery -A roads worker` still consumes everything; set them (e.g.
+# "interactive" / "bulk") and run separate workers per queue (see
+# roads/celery.py) to keep sweeps from delaying interactive refreshes.
+REFRESH_INTERACTIVE_QUEUE = os.getenv("REFRESH_INTERACTIVE_QUEUE", CELERY_TASK_DEFAULT_QUEUE)
+REFRESH_BULK_QUEUE = os.getenv("REFRESH_BULK_QUEUE", CELERY_TASK_DEFAULT_QUEUE)
+# task_status / SSE ask the broker for a queue's depth at most this often (seconds)
+REFRESH_QUEUE_DEPTH_CACHE = float(os.getenv("REFRESH_QUEUE_DEPTH_CACHE", "5"))
+REFRESH_INTERACTIVE_MAX_CODES = int(os.getenv("REFRESH_INTERACTIVE_MAX_CODES", "50"))
+CELERY_TASK_ROUTES = ("all_roads.queues.route_task",)
 
 CELERY_TASK_TRACK_STARTED = True
 CELERY_RESULT_EXPIRES = 60 * 60 * 6       # 6 hours
 
+# Full sweeps fan out as one task per shard of this many segments; keep a
+# shard well inside CELERY_TASK_SOFT_TIME_LIMIT at REFRESH_RATE_LIMIT.
+REFRESH_SHARD_SIZE = int(os.getenv("REFRESH_SHARD_SIZE", "500"))
+# An unfinished sweep checkpoint older than this is discarded instead of resumed
+REFRESH_CHECKPOINT_MAX_AGE = int(os.getenv("REFRESH_CHECKPOINT_MAX_AGE", str(60 * 60 * 6)))
+# Incremental refresh: segments older than this (seconds), at most LIMIT per run
+REFRESH_STALE_AFTER = int(os.getenv("REFRESH_STALE_AFTER", "3600"))
+REFRESH_STALE_LIMIT = int(os.getenv("REFRESH_STALE_LIMIT", "2000"))
+
+# Adaptive scheduler (celery beat): per-segment intervals between MIN and MAX
+# seconds, halved when status or speed (km/h) moves, within an hourly budget
+# of segment lookups shared across the network.
+REFRESH_SCHEDULER_TICK = int(os.getenv("REFRESH_SCHEDULER_TICK", "300"))
+REFRESH_BUDGET_PER_HOUR = int(os.getenv("REFRESH_BUDGET_PER_HOUR", "6000"))
+REFRESH_INTERVAL_MIN = int(os.getenv("REFRESH_INTERVAL_MIN", str(15 * 60)))
+REFRESH_INTERVAL_MAX = int(os.getenv("REFRESH_INTERVAL_MAX", str(24 * 3600)))
+REFRESH_VOLATILITY_SPEED_DELTA = float(os.getenv("REFRESH_VOLATILITY_SPEED_DELTA", "5"))
+
+# Failed segment retries: backoff BASE * 2^(attempts-1) seconds up to MAX_DELAY,
+# given up after MAX_ATTEMPTS, at most LIMIT segments per run.
+REFRESH_RETRY_TICK = int(os.getenv("REFRESH_RETRY_TICK", "300"))
+REFRESH_RETRY_BASE_DELAY = int(os.getenv("REFRESH_RETRY_BASE_DELAY", "300"))
+REFRESH_RETRY_MAX_DELAY = int(os.getenv("REFRESH_RETRY_MAX_DELAY", str(6 * 3600)))
+REFRESH_RETRY_MAX_ATTEMPTS = int(os.getenv("REFRESH_RETRY_MAX_ATTEMPTS", "6"))
+REFRESH_RETRY_LIMIT = int(os.getenv("REFRESH_RETRY_LIMIT", "500"))
+
+# Traffic history (all_roads/history.py): every refresh appends an observation;
+# hourly/daily rollups are built by beat and each level is kept this many days.
+REFRESH_RECORD_OBSERVATIONS = os.getenv("REFRESH_RECORD_OBSERVATIONS", "1") == "1"
+OBSERVATION_RETENTION_DAYS = int(os.getenv("OBSERVATION_RETENTION_DAYS", "14"))
+OBSERVATION_HOURLY_RETENTION_DAYS = int(os.getenv("OBSERVATION_HOURLY_RETENTION_DAYS", "90"))
+OBSERVATION_DAILY_RETENTION_DAYS = int(os.getenv("OBSERVATION_DAILY_RETENTION_DAYS", "730"))
+
+CELERY_BEAT_SCHEDULE = {
+    "adaptive-segment-refresh": {
+        "task": "all_roads.tasks.schedule_adaptive_refresh_task",
+        "schedule": REFRESH_SCHEDULER_TICK,
+    },
+    "retry-failed-segments": {
+        "task": "all_roads.tasks.retry_failed_segments_task",
+        "schedule": REFRESH_RETRY_TICK,
+    },
+    "rollup-traffic-history": {
+        "task": "all_roads.tasks.rollup_observations_task",
+        "schedule": 3600,
+    },
+    "prune-traffic-history": {
+        "task": "all_roads.tasks.prune_history_task",
+        "schedule": 24 * 3600,
+    },
+}
+
+# Server-sent task progress (roads/asgi.py): result backend poll interval
+TASK_EVENTS_POLL_INTERVAL = float(os.getenv("TASK_EVENTS_POLL_INTERVAL", "1.0"))
+
+# Traffic status colors: JSON list of [upper speed bound km/h | null, color],
+# e.g. [[1,"666699"],[40,"FF0000"],...,[null,"006600"]]. Unset = the defaults
+# in all_roads/utils.py. Apply a change with `manage.py recolor_segments`.
+SPEED_STATUS_THRESHOLDS = json.loads(os.getenv("SPEED_STATUS_THRESHOLDS", "null"))
+
+# --- Google Distance Matrix ---
+# Empty = Google; set to a fake_distance_matrix server for offline runs
+DISTANCE_MATRIX_URL = os.getenv("DISTANCE_MATRIX_URL", "")
+# Max segments per request (one shared origin or destination, so one billed
+# element each); Google caps elements per request at 100.
+DISTANCE_MATRIX_MAX_ELEMENTS = int(os.getenv("DISTANCE_MATRIX_MAX_ELEMENTS", "100"))
+# requests/sec, 0 = unlimited. With a shared REFRESH_INFLIGHT_REDIS_URL this
+# budget (and its AIMD rate) is shared by all runs, so a sweep's shards split it.
+REFRESH_RATE_LIMIT = float(os.getenv("REFRESH_RATE_LIMIT", "10"))
+REFRESH_CONCURRENCY = int(os.getenv("REFRESH_CONCURRENCY", "8"))    # in-flight requests (async mode)
+# Throttling control: AIMD between REFRESH_RATE_MIN and REFRESH_RATE_LIMIT,
+# circuit opens after THRESHOLD throttled requests in a row for COOLDOWN s;
+# deferred segments are re-queued up to REQUEUE_MAX times.
+REFRESH_RATE_MIN = float(os.getenv("REFRESH_RATE_MIN", "0.5"))
+REFRESH_RATE_INCREASE = float(os.getenv("REFRESH_RATE_INCREASE", "0.5"))
+REFRESH_RATE_DECREASE = float(os.getenv("REFRESH_RATE_DECREASE", "0.5"))
+REFRESH_CIRCUIT_THRESHOLD = int(os.getenv("REFRESH_CIRCUIT_THRESHOLD", "5"))
+REFRESH_CIRCUIT_COOLDOWN = int(os.getenv("REFRESH_CIRCUIT_COOLDOWN", "60"))
+REFRESH_CIRCUIT_MAX_WAIT = int(os.getenv("REFRESH_CIRCUIT_MAX_WAIT", "120"))  # per run, then defer
+REFRESH_REQUEUE_MAX = int(os.getenv("REFRESH_REQUEUE_MAX", "5"))
+
+# Pooled HTTP client (all_roads/http_client.py); keep pool >= REFRESH_CONCURRENCY
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+HTTP_BACKOFF_FACTOR = float(os.getenv("HTTP_BACKOFF_FACTOR", "0.5"))
+
+# Refresh caches: in-process LRU, shared through Redis when this URL is set
+REFRESH_CACHE_REDIS_URL = os.getenv("REFRESH_CACHE_REDIS_URL", "")
+# In-flight registry (all_roads/inflight.py): coalesces duplicate refresh
+# requests and locks segments while a run writes them. Defaults to the broker's
+# Redis, which web and workers already share; empty = per-process, which turns
+# coalescing and queue wait timing off.
+REFRESH_INFLIGHT_REDIS_URL = os.getenv("REFRESH_INFLIGHT_REDIS_URL", CELERY_BROKER_URL)
+REFRESH_INFLIGHT_TTL = int(os.getenv("REFRESH_INFLIGHT_TTL", "3600"))
+REFRESH_SEGMENT_LOCK_TTL = int(os.getenv("REFRESH_SEGMENT_LOCK_TTL", "600"))
+# Refresh stage histograms (all_roads/metrics.py): workers push them here so
+# /metrics on the web process covers every worker. Empty = per-process only.
+METRICS_REDIS_URL = os.getenv("METRICS_REDIS_URL", os.getenv("REDIS_URL", ""))
+ADDRESS_CACHE_SIZE = int(os.getenv("ADDRESS_CACHE_SIZE", "20000"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "300"))    # seconds, 0 disables
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "20000"))
+
 
 import logging
 
@@ -188,6 +317,9 @@ LOGGING = {
             'class': 'logging.FileHandler',
             'filename': BASE_DIR / 'django-error.log',
         },
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
     },
     'loggers': {
         'django': {
@@ -195,5 +327,11 @@ LOGGING = {
             'level': 'ERROR',
             'propagate': True,
         },
+        # Refresh pipeline: failed segments, cache/registry/metrics fallbacks
+        'all_roads': {
+            'handlers': ['console', 'file'],
+            'level': os.getenv("ALL_ROADS_LOG_LEVEL", "WARNING"),
+            'propagate': False,
+        },
     },
 }
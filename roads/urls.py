@@ -9,4 +9,5 @@ urlpatterns = [
 
     path("", include("website.urls")),
     path("api/", include("all_roads.api.urls")),
+    path("metrics", views.metrics_view, name="metrics"),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
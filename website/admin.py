@@ -1,3 +1,9 @@
 from django.contrib import admin
+from .models import ImportJob
 
-# Register your models here.
+
+@admin.register(ImportJob)
+class ImportJobAdmin(admin.ModelAdmin):
+    list_display = ("original_name", "status", "processed", "created", "updated", "unchanged", "skipped", "error_count", "created_at")
+    list_filter = ("status",)
+    readonly_fields = ("task_id", "started_at", "finished_at")
@@ -1,4 +1,5 @@
 from django import forms
+from django.conf import settings
 
 ALLOWED_EXTS = {".csv", ".xlsx", ".xls"}
 
@@ -15,6 +16,7 @@ class UploadSegmentsForm(forms.Form):
         name = (f.name or "").lower()
         if not any(name.endswith(ext) for ext in ALLOWED_EXTS):
             raise forms.ValidationError("File must be .csv, .xlsx, or .xls")
-        if f.size and f.size > 10 * 1024 * 1024:
-            raise forms.ValidationError("File too large (max 10 MB).")
+        max_mb = getattr(settings, "UPLOAD_MAX_FILE_MB", 200)
+        if f.size and f.size > max_mb * 1024 * 1024:
+            raise forms.ValidationError(f"File too large (max {max_mb} MB).")
         return f
@@ -0,0 +1,299 @@
+# website/importer.py
+"""
+Batched segment import. Rows from website.readers.read_rows are validated
+and written a batch at a time with a fixed number of queries per batch,
+however many rows it holds:
+
+- Road and Route maps are loaded once per import; missing roads/routes are
+  bulk-created (and routes pointing at the wrong road fixed in one UPDATE
+  per road) only when a batch mentions them
+- the batch's segment codes are looked up in one SELECT, then new codes go
+  through bulk_create and existing ones through bulk_update
+
+Each row's content is fingerprinted (all_roads.utils.segment_fingerprint)
+and compared with the fingerprint stored on its Segment; rows that match
+are counted as unchanged and not written at all, so re-uploading the same
+sheet leaves the table (and error_processing) alone.
+
+Rows repeating a code within the file behave as they did with per-row
+update_or_create: the first creates it, later ones count as updates (or
+unchanged, if identical) and the last one wins.
+
+Auto-index reads Max(position) only for the routes a batch adds segments
+to, while holding their Route rows locked, so two uploads running at once
+never hand out the same position.
+"""
+from decimal import Decimal, InvalidOperation
+
+from django.db import IntegrityError, transaction
+from django.db.models import Max
+
+from all_roads.models import Road, Route, Segment
+from all_roads.utils import chunked, segment_fingerprint
+
+UPDATE_FIELDS = [
+    "route", "name", "state", "start_lat", "start_lon", "end_lat", "end_lon",
+    "error_processing", "fingerprint",
+]
+
+
+def _in_lat_range(val):
+    return Decimal("-90") <= val <= Decimal("90")
+
+
+def _in_lon_range(val):
+    return Decimal("-180") <= val <= Decimal("180")
+
+
+def _road_code_from_route(route_code: str) -> str:
+    s = (route_code or "").strip().upper()
+    if not s:
+        return "F"  # or return None and treat as error upstream
+    if s[0] == "F":
+        return "F"
+    if s[0] in ("A", "E"):
+        return "A"
+    return "F"  # fallback; change to raising an error if you want to be strict
+
+
+def _to_decimal(s, field_name, rownum, errors):
+    try:
+        if s is None or s == "":
+            return Decimal("0")
+        # Accept strings/numbers, strip spaces
+        return Decimal(str(s).strip())
+    except (InvalidOperation, ValueError):
+        errors.append(f"Row {rownum}: invalid decimal for {field_name} = {s!r}")
+        return Decimal("0")
+
+
+def _lock_route_positions(route_ids):
+    """
+    {route_id: highest Segment.position} for the given routes, computed in
+    SQL from the (route, position) index. The routes' rows are locked
+    (SELECT ... FOR UPDATE, in id order) until the caller's transaction
+    ends, so concurrent uploads allocate positions on a route one at a time.
+    """
+    list(Route.objects.select_for_update().filter(id__in=route_ids).order_by("id").values_list("id", flat=True))
+    return dict(
+        Segment.objects.filter(route_id__in=route_ids)
+        .values("route_id").annotate(top=Max("position"))
+        .values_list("route_id", "top")
+    )
+
+
+def _clean_row(row, errors):
+    """Validated field values for one row dict, or None if it must be skipped."""
+    route_code = str(row["ROUTE"] or "").strip().upper()
+    seg_code   = str(row["SEGMENT CODE"] or "").strip().upper()
+    rnum       = row.get("_rownum", "?")
+
+    if not route_code or not seg_code:
+        errors.append(f"Row {rnum}: missing ROUTE or SEGMENT CODE.")
+        return None
+
+    # Convert to Decimal
+    start_lat = _to_decimal(row["START_LAT"], "START_LAT", rnum, errors)
+    start_lon = _to_decimal(row["START_LON"], "START_LON", rnum, errors)
+    end_lat   = _to_decimal(row["END_LAT"], "END_LAT", rnum, errors)
+    end_lon   = _to_decimal(row["END_LON"], "END_LON", rnum, errors)
+
+    # Enforce coordinate ranges
+    coord_bad = False
+    if not _in_lat_range(start_lat):
+        errors.append(f"Row {rnum}: START_LAT out of range [-90, 90].")
+        coord_bad = True
+    if not _in_lon_range(start_lon):
+        errors.append(f"Row {rnum}: START_LON out of range [-180, 180].")
+        coord_bad = True
+    if not _in_lat_range(end_lat):
+        errors.append(f"Row {rnum}: END_LAT out of range [-90, 90].")
+        coord_bad = True
+    if not _in_lon_range(end_lon):
+        errors.append(f"Row {rnum}: END_LON out of range [-180, 180].")
+        coord_bad = True
+    if coord_bad:
+        return None
+
+    return {
+        "route": route_code,
+        "code": seg_code,
+        "name": str(row["SEGMENT NAME"] or "").strip(),
+        "state": str(row["STATE"] or "").strip(),
+        "start_lat": start_lat,
+        "start_lon": start_lon,
+        "end_lat": end_lat,
+        "end_lon": end_lon,
+    }
+
+
+class SegmentImporter:
+    """
+    Imports row batches, accumulating counts ({"created", "updated",
+    "unchanged", "skipped"}) and errors across them. With auto_index, new
+    segments get the next position on their route, and an index showing it
+    (existing ones keep theirs).
+    """
+
+    def __init__(self, auto_index=False, max_errors=100):
+        self.auto_index = auto_index
+        self.counts = {"created": 0, "updated": 0, "unchanged": 0, "skipped": 0}
+        self.errors = []  # the first max_errors messages; error_count has them all
+        self.error_count = 0
+        self.max_errors = max_errors
+        self.road_ids = dict(Road.objects.values_list("road", "id"))
+        # route code -> [route_id, road_id]
+        self.routes = {
+            code: [pk, road_id]
+            for code, pk, road_id in Route.objects.values_list("route", "id", "road_id")
+        }
+
+    def result(self):
+        return {**self.counts, "errors": self.errors, "error_count": self.error_count}
+
+    def _add_errors(self, errors):
+        self.error_count += len(errors)
+        self.errors.extend(errors[:max(self.max_errors - len(self.errors), 0)])
+
+    def import_rows(self, rows):
+        """Clean and write one batch of row dicts from read_rows."""
+        cleaned = []
+        for row in rows:
+            row_errors = []
+            values = _clean_row(row, row_errors)
+            self._add_errors(row_errors)
+            if values is None:
+                self.counts["skipped"] += 1
+            else:
+                cleaned.append(values)
+        if not cleaned:
+            return
+
+        self._ensure_routes({v["route"] for v in cleaned})
+        try:
+            self._write_segments(cleaned)
+        except IntegrityError:
+            # Another upload created some of these codes since we looked; they
+            # are updates now, so redo the batch against a fresh lookup
+            self._write_segments(cleaned)
+
+    # --- roads and routes ---------------------------------------------------
+
+    def _ensure_roads(self, road_codes):
+        missing = [code for code in road_codes if code not in self.road_ids]
+        if not missing:
+            return
+        Road.objects.bulk_create([Road(road=code) for code in missing], ignore_conflicts=True)
+        self.road_ids.update(Road.objects.filter(road__in=missing).values_list("road", "id"))
+
+    def _ensure_routes(self, route_codes):
+        """
+        Make sure every route exists and belongs to the road its code implies
+        (F* -> Road 'F'; A*/E* -> Road 'A').
+        """
+        wanted = {code: _road_code_from_route(code) for code in route_codes}
+        self._ensure_roads(set(wanted.values()))
+
+        missing = [code for code in wanted if code not in self.routes]
+        if missing:
+            Route.objects.bulk_create(
+                [Route(route=code, road_id=self.road_ids[wanted[code]], index="") for code in missing],
+                ignore_conflicts=True,
+            )
+            for code, pk, road_id in Route.objects.filter(route__in=missing).values_list("route", "id", "road_id"):
+                self.routes[code] = [pk, road_id]
+
+        # If a route already existed but points to a different Road, fix it
+        moves = {}
+        for code, road_code in wanted.items():
+            road_id = self.road_ids[road_code]
+            if self.routes[code][1] != road_id:
+                moves.setdefault(road_id, []).append(code)
+                self.routes[code][1] = road_id
+        for road_id, codes in moves.items():
+            Route.objects.filter(route__in=codes).update(road_id=road_id)
+
+    # --- segments -----------------------------------------------------------
+
+    def _assign_positions(self, segments):
+        """Number new segments after the last position on their route, in file order."""
+        top = _lock_route_positions({seg.route_id for seg in segments})
+        for seg in segments:
+            seg.position = top[seg.route_id] = (top.get(seg.route_id) or 0) + 1
+            # zero-padded like the hand-entered indexes (01, 02, … 99, 100)
+            seg.index = str(seg.position).zfill(2)
+
+    def _write_segments(self, cleaned):
+        # code -> (id, stored fingerprint)
+        existing = {
+            code: (pk, fp)
+            for code, pk, fp in Segment.objects.filter(
+                code__in={v["code"] for v in cleaned}
+            ).values_list("code", "id", "fingerprint")
+        }
+        to_create, to_update = {}, {}
+        created = updated = unchanged = 0
+        for v in cleaned:
+            fingerprint = segment_fingerprint(
+                v["route"], v["name"], v["state"],
+                v["start_lat"], v["start_lon"], v["end_lat"], v["end_lon"],
+            )
+            fields = {
+                "route_id": self.routes[v["route"]][0],
+                "name": v["name"],
+                "state": v["state"],
+                "start_lat": v["start_lat"],
+                "start_lon": v["start_lon"],
+                "end_lat": v["end_lat"],
+                "end_lon": v["end_lon"],
+                "error_processing": False,
+                "fingerprint": fingerprint,
+            }
+            code = v["code"]
+            pending = to_create.get(code) or to_update.get(code)
+            if pending is not None:
+                # Repeated within the batch: the last row wins
+                if pending.fingerprint == fingerprint:
+                    unchanged += 1
+                    continue
+                for name, value in fields.items():
+                    setattr(pending, name, value)
+                updated += 1
+            elif code in existing:
+                pk, stored = existing[code]
+                if stored == fingerprint:
+                    unchanged += 1
+                    continue
+                to_update[code] = Segment(id=pk, code=code, **fields)
+                updated += 1
+            else:
+                to_create[code] = Segment(code=code, **fields)
+                created += 1
+
+        with transaction.atomic():
+            if self.auto_index and to_create:
+                self._assign_positions(to_create.values())
+            Segment.objects.bulk_create(to_create.values(), batch_size=1000)
+            Segment.objects.bulk_update(to_update.values(), UPDATE_FIELDS, batch_size=1000)
+        self.counts["created"] += created
+        self.counts["updated"] += updated
+        self.counts["unchanged"] += unchanged
+
+
+def import_segments(rows, auto_index=False, batch_size=1000, progress=None, max_errors=100):
+    """
+    Import every row from a read_rows iterator, one transaction per batch;
+    returns the upload result dict, whose "errors" holds the first
+    `max_errors` messages and "error_count" the total. progress(importer,
+    rows_read), if given, runs inside each batch's transaction, so whatever
+    it records commits together with the batch.
+    """
+    importer = SegmentImporter(auto_index=auto_index, max_errors=max_errors)
+    rows_read = 0
+    for batch in chunked(rows, batch_size):
+        with transaction.atomic():
+            importer.import_rows(batch)
+            rows_read += len(batch)
+            if progress:
+                progress(importer, rows_read)
+    return importer.result()
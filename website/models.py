@@ -0,0 +1,71 @@
+from django.db import models
+
+
+class ImportJob(models.Model):
+    """
+    A segment upload handed to website.tasks.import_segments_task. The file
+    is kept under MEDIA_ROOT (which web and worker must share) until the job
+    ends; counters are committed with every batch, so they show how far the
+    import got.
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    file = models.FileField(upload_to="imports/%Y/%m/")
+    original_name = models.CharField(max_length=255)
+    auto_index = models.BooleanField(default=False)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED)
+    task_id = models.CharField(max_length=64, blank=True)
+    processed = models.PositiveIntegerField(default=0)  # data rows read so far
+    created = models.PositiveIntegerField(default=0)
+    updated = models.PositiveIntegerField(default=0)
+    unchanged = models.PositiveIntegerField(default=0)
+    skipped = models.PositiveIntegerField(default=0)
+    error_count = models.PositiveIntegerField(default=0)
+    errors = models.JSONField(default=list, blank=True)  # first UPLOAD_MAX_ERRORS, written when the job ends
+    message = models.TextField(blank=True)               # why a job failed
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["-created_at"]
+
+    def __str__(self):
+        return f"{self.original_name} ({self.status})"
+
+    @property
+    def finished(self):
+        return self.status in (self.DONE, self.FAILED)
+
+    def discard_file(self):
+        """Delete the uploaded file (the caller saves the cleared field)."""
+        if self.file:
+            self.file.delete(save=False)
+
+    def as_dict(self):
+        return {
+            "id": self.pk,
+            "file": self.original_name,
+            "status": self.status,
+            "finished": self.finished,
+            "processed": self.processed,
+            "created": self.created,
+            "updated": self.updated,
+            "unchanged": self.unchanged,
+            "skipped": self.skipped,
+            "error_count": self.error_count,
+            "errors": self.errors if self.finished else [],
+            "message": self.message,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
@@ -0,0 +1,149 @@
+# website/readers.py
+"""
+Streaming readers for segment upload files. Headers are checked up front;
+data rows are then produced lazily, one dict at a time, so memory stays
+flat however large the file is:
+
+- CSV:  decoded line by line from the upload (Django spools big uploads
+        to a temp file, so nothing is read into memory in one piece)
+- XLSX: openpyxl read-only mode, which streams the sheet XML
+- XLS:  xlrd with on_demand sheet loading, memory-mapped from the temp file
+        when there is one (the format itself caps out at 65,536 rows)
+"""
+import codecs
+import csv
+
+try:
+    import openpyxl   # for .xlsx
+except Exception:
+    openpyxl = None
+
+try:
+    import xlrd       # for .xls
+except Exception:
+    xlrd = None
+
+REQUIRED_HEADERS = [
+    "ROUTE", "SEGMENT CODE", "STATE", "SEGMENT NAME",
+    "START_LAT", "START_LON", "END_LAT", "END_LON"
+]
+
+
+def _normalize_headers(headers):
+    """
+    Make header matching robust:
+    - strip spaces
+    - upper-case
+    - allow underscores vs spaces interchangeably
+    """
+    norm = []
+    for h in headers:
+        h = (str(h) if h is not None else "").strip().upper().replace("_", " ")
+        norm.append(h)
+    return norm
+
+
+def _is_blank_row(cells):
+    """
+    Return True if a row is effectively empty: all cells are None/''/whitespace.
+    Accepts a list/tuple of cell values from CSV/XLSX/XLS.
+    """
+    if not cells:
+        return True
+    for c in cells:
+        if c is None:
+            continue
+        # numbers (0.0) count as content; only whitespace is blank
+        if isinstance(c, (int, float)):
+            return False
+        if str(c).strip() != "":
+            return False
+    return True
+
+
+def _header_index(header_row):
+    """({canonical header: column}, errors) for the sheet's header row."""
+    headers = _normalize_headers(header_row)  # sheet headers → upper + spaces
+    required_norm = _normalize_headers(REQUIRED_HEADERS)  # required list → same normalisation
+    # map back from normalised name to the original canonical key we'll use later
+    norm_to_canon = dict(zip(required_norm, REQUIRED_HEADERS))
+
+    idx = {norm_to_canon[h]: headers.index(h) for h in required_norm if h in headers}
+    missing = [norm_to_canon[h] for h in required_norm if h not in headers]
+    if missing:
+        return None, [f"Missing headers: {', '.join(missing)}"]
+    return idx, []
+
+
+def _dict_rows(numbered_rows, idx):
+    """Turn (rownum, cells) pairs into row dicts, skipping blank rows."""
+    for rownum, r in numbered_rows:
+        if _is_blank_row(r):
+            continue  # silently ignore empty/trailing rows
+        row = {h: (r[j] if j < len(r) else "") for h, j in idx.items()}
+        row["_rownum"] = rownum
+        yield row
+
+
+def _csv_rows(fileobj):
+    # utf-8-sig: Excel's "CSV UTF-8" starts with a BOM that would hide ROUTE
+    lines = codecs.iterdecode(fileobj, "utf-8-sig", errors="ignore")
+    return enumerate(csv.reader(lines), start=1), None
+
+
+def _xlsx_rows(fileobj):
+    wb = openpyxl.load_workbook(fileobj, read_only=True, data_only=True)
+    rows = enumerate(wb.active.iter_rows(values_only=True), start=1)
+    return rows, wb.close
+
+
+def _xls_rows(fileobj):
+    if hasattr(fileobj, "temporary_file_path"):
+        book = xlrd.open_workbook(fileobj.temporary_file_path(), on_demand=True)
+    else:
+        book = xlrd.open_workbook(file_contents=fileobj.read(), on_demand=True)
+    sheet = book.sheet_by_index(0)
+    rows = ((i + 1, sheet.row_values(i)) for i in range(sheet.nrows))
+    return rows, book.release_resources
+
+
+def read_rows(fileobj, filename):
+    """
+    Open an upload and check its header row. Returns (rows, errors): rows
+    is a lazy iterator of dicts keyed by REQUIRED_HEADERS plus "_rownum"
+    (1-based sheet row), or None when errors says why the file can't be read.
+    """
+    name = filename.lower()
+    if name.endswith(".csv"):
+        opener, label = _csv_rows, "CSV"
+    elif name.endswith(".xlsx"):
+        if openpyxl is None:
+            return None, ["openpyxl not installed (required for .xlsx)"]
+        opener, label = _xlsx_rows, "XLSX"
+    elif name.endswith(".xls"):
+        if xlrd is None:
+            return None, ["xlrd not installed (required for .xls)"]
+        opener, label = _xls_rows, "XLS"
+    else:
+        return None, [f"Unsupported file type: {filename}"]
+
+    numbered, close = opener(fileobj)
+    first = next(numbered, None)
+    if first is None:
+        if close:
+            close()
+        return None, [f"Empty {label}"]
+    idx, errors = _header_index(first[1])
+    if errors:
+        if close:
+            close()
+        return None, errors
+    return _closing(_dict_rows(numbered, idx), close), []
+
+
+def _closing(rows, close):
+    try:
+        yield from rows
+    finally:
+        if close:
+            close()
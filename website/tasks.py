@@ -0,0 +1,91 @@
+# website/tasks.py
+import logging
+
+from celery import shared_task
+from celery.exceptions import SoftTimeLimitExceeded
+from django.conf import settings
+from django.utils import timezone
+
+from .importer import import_segments
+from .models import ImportJob
+from .readers import read_rows
+
+logger = logging.getLogger(__name__)
+
+
+def _finish(job, status, result=None, message=""):
+    job.status = status
+    job.message = message
+    job.finished_at = timezone.now()
+    job.discard_file()
+    fields = ["status", "message", "finished_at", "file"]
+    if result is not None:
+        job.errors = result["errors"]
+        job.error_count = result.get("error_count", len(result["errors"]))
+        fields += ["errors", "error_count"]
+    job.save(update_fields=fields)
+
+
+@shared_task(
+    bind=True,
+    name="website.tasks.import_segments_task",
+    soft_time_limit=getattr(settings, "UPLOAD_TASK_SOFT_TIME_LIMIT", 60 * 60),
+    time_limit=getattr(settings, "UPLOAD_TASK_TIME_LIMIT", 60 * 65),
+)
+def import_segments_task(self, job_id):
+    """
+    Import an uploaded segment file, committing every UPLOAD_BATCH_SIZE rows
+    and recording the running counts on its ImportJob as it goes. Runs under
+    UPLOAD_TASK_*_TIME_LIMIT rather than the global task limits. The file
+    is deleted when the job ends, whatever the outcome.
+    """
+    job = ImportJob.objects.get(pk=job_id)
+    if job.finished:
+        return job.as_dict()
+    job.status = ImportJob.RUNNING
+    job.task_id = self.request.id or job.task_id
+    job.started_at = timezone.now()
+    job.save(update_fields=["status", "task_id", "started_at"])
+
+    def progress(importer, rows_read):
+        counts = importer.counts
+        ImportJob.objects.filter(pk=job.pk).update(
+            processed=rows_read,
+            created=counts["created"],
+            updated=counts["updated"],
+            unchanged=counts["unchanged"],
+            skipped=counts["skipped"],
+            error_count=importer.error_count,
+        )
+
+    try:
+        with job.file.open("rb") as f:
+            rows, header_errors = read_rows(f, job.original_name)
+            if not header_errors:
+                result = import_segments(
+                    rows,
+                    auto_index=job.auto_index,
+                    batch_size=getattr(settings, "UPLOAD_BATCH_SIZE", 1000),
+                    progress=progress,
+                    max_errors=getattr(settings, "UPLOAD_MAX_ERRORS", 100),
+                )
+    except SoftTimeLimitExceeded:
+        logger.error("Import job %s hit UPLOAD_TASK_SOFT_TIME_LIMIT", job.pk)
+        job.refresh_from_db()
+        # Committed batches stay; re-uploading skips them as unchanged
+        _finish(job, ImportJob.FAILED, message=(
+            f"Timed out after {job.processed} rows; upload the file again to import the rest."
+        ))
+        raise
+    except Exception as e:
+        logger.exception("Import job %s failed", job.pk)
+        job.refresh_from_db()
+        _finish(job, ImportJob.FAILED, message=f"{type(e).__name__}: {e}")
+        raise
+
+    if header_errors:
+        _finish(job, ImportJob.FAILED, {"errors": header_errors}, message=header_errors[0])
+        return job.as_dict()
+    job.refresh_from_db()
+    _finish(job, ImportJob.DONE, result)
+    return job.as_dict()
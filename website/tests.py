@@ -0,0 +1,194 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from all_roads.models import Address, Road, Route, Segment
+from website.importer import import_segments
+from website import readers
+from website.models import ImportJob
+from website.tasks import import_segments_task
+
+HEADER = {"ROUTE": "", "SEGMENT CODE": "", "STATE": "", "SEGMENT NAME": "",
+          "START_LAT": "", "START_LON": "", "END_LAT": "", "END_LON": ""}
+
+
+def _row(rownum, route, code, name="Seg", state="Lagos", coords=("6.5", "3.3", "6.6", "3.4")):
+    row = dict(HEADER, _rownum=rownum)
+    row.update({
+        "ROUTE": route, "SEGMENT CODE": code, "SEGMENT NAME": name, "STATE": state,
+        "START_LAT": coords[0], "START_LON": coords[1], "END_LAT": coords[2], "END_LON": coords[3],
+    })
+    return row
+
+
+class ImportSegmentsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        # Segment.start_point / end_point default to Address 1
+        Address.objects.create(id=1, address="unknown")
+
+    def _import(self, rows, **kwargs):
+        result = import_segments(rows, batch_size=kwargs.pop("batch_size", 2), **kwargs)
+        errors = result.pop("errors")
+        self.assertGreaterEqual(result.pop("error_count"), len(errors))
+        return result, errors
+
+    def test_counts_and_errors(self):
+        rows = [
+            _row(2, "F1", "S1"),
+            _row(3, "F1", "S2"),
+            _row(4, "", "S3"),
+            _row(5, "F1", "S4", coords=("100", "3", "6", "3")),
+            _row(6, "a1", "s5"),
+        ]
+        result, errors = self._import(rows)
+        self.assertEqual(result, {"created": 3, "updated": 0, "unchanged": 0, "skipped": 2})
+        self.assertEqual(errors, [
+            "Row 4: missing ROUTE or SEGMENT CODE.",
+            "Row 5: START_LAT out of range [-90, 90].",
+        ])
+        self.assertEqual(Segment.objects.get(code="S5").route.route, "A1")
+        self.assertEqual(Route.objects.get(route="A1").road.road, "A")
+
+    def test_stored_errors_are_capped(self):
+        rows = [_row(2 + i, "", f"S{i}") for i in range(5)]
+        result = import_segments(rows, max_errors=2)
+        self.assertEqual(result["errors"], ["Row 2: missing ROUTE or SEGMENT CODE.", "Row 3: missing ROUTE or SEGMENT CODE."])
+        self.assertEqual(result["error_count"], 5)
+
+    def test_reupload_skips_unchanged_rows(self):
+        rows = [_row(2, "F1", "S1"), _row(3, "F1", "S2")]
+        self._import(rows)
+        Segment.objects.filter(code="S1").update(error_processing=True)
+
+        result, _ = self._import(rows)
+        self.assertEqual(result, {"created": 0, "updated": 0, "unchanged": 2, "skipped": 0})
+        self.assertTrue(Segment.objects.get(code="S1").error_processing)
+
+        result, _ = self._import([_row(2, "F1", "S1", name="Renamed"), _row(3, "F1", "S2")])
+        self.assertEqual(result, {"created": 0, "updated": 1, "unchanged": 1, "skipped": 0})
+        self.assertEqual(Segment.objects.get(code="S1").name, "Renamed")
+
+    def test_repeated_code_in_file(self):
+        rows = [_row(2, "F1", "S1", name="First"), _row(3, "F1", "S1", name="Second"), _row(4, "F1", "S1", name="Second")]
+        result, _ = self._import(rows, batch_size=10)
+        self.assertEqual(result, {"created": 1, "updated": 1, "unchanged": 1, "skipped": 0})
+        self.assertEqual(Segment.objects.get(code="S1").name, "Second")
+
+    def test_route_moved_to_matching_road(self):
+        wrong = Road.objects.create(road="F")
+        Route.objects.create(route="E9", road=wrong)
+        self._import([_row(2, "E9", "S1")])
+        self.assertEqual(Route.objects.get(route="E9").road.road, "A")
+
+    def test_auto_index_continues_after_existing_positions(self):
+        self._import([_row(2, "F1", f"S{i}") for i in range(3)], auto_index=True)
+        self._import([_row(2, "F1", "S0")] + [_row(3 + i, "F1", f"T{i}") for i in range(100)], auto_index=True)
+        self.assertEqual(Segment.objects.get(code="S0").position, 1)  # existing ones keep theirs
+        last = Segment.objects.get(code="T99")
+        self.assertEqual((last.position, last.index), (103, "103"))
+        self.assertEqual(Segment.objects.get(code="T0").index, "04")
+
+    def test_without_auto_index_index_stays_blank(self):
+        self._import([_row(2, "F1", "S1")])
+        segment = Segment.objects.get(code="S1")
+        self.assertEqual((segment.position, segment.index), (0, ""))
+
+
+class ImportJobTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        Address.objects.create(id=1, address="unknown")
+
+    def setUp(self):
+        media = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media, ignore_errors=True)
+        self.enterContext(override_settings(MEDIA_ROOT=media, UPLOAD_MAX_ERRORS=1))
+
+    def _job(self, content):
+        upload = SimpleUploadedFile("segments.csv", content.encode())
+        return ImportJob.objects.create(file=upload, original_name="segments.csv")
+
+    def test_finished_job_deletes_its_file_and_caps_errors(self):
+        header = "ROUTE,SEGMENT CODE,STATE,SEGMENT NAME,START_LAT,START_LON,END_LAT,END_LON\n"
+        job = self._job(header + "F1,S1,Lagos,One,6.5,3.3,6.6,3.4\n,S2,,,0,0,0,0\n,S3,,,0,0,0,0\n")
+        path = job.file.path
+        result = import_segments_task(job.pk)
+
+        self.assertEqual((result["status"], result["created"], result["error_count"]), ("done", 1, 2))
+        self.assertEqual(result["errors"], ["Row 3: missing ROUTE or SEGMENT CODE."])
+        job.refresh_from_db()
+        self.assertFalse(job.file)
+        self.assertFalse(os.path.exists(path))
+
+    def test_unreadable_file_is_deleted_too(self):
+        job = self._job("NOT,A,HEADER\n")
+        path = job.file.path
+        result = import_segments_task(job.pk)
+        self.assertEqual(result["status"], "failed")
+        self.assertFalse(os.path.exists(path))
+
+
+class ReadRowsTests(SimpleTestCase):
+    def _csv(self, text):
+        return SimpleUploadedFile("roads.csv", text.encode("utf-8-sig"))
+
+    def test_csv_headers_are_normalized(self):
+        upload = self._csv(
+            " end_lat ,end_lon,start_lat,start_lon,Segment_Name,state,segment code,route\n"
+            "6.6,3.4,6.5,3.3,Seg,Lagos,S1,R1\n"
+            ",,,,,,,\n"
+            "6.7,3.5,6.6,3.4,Seg 2,Lagos,S2,R1\n"
+        )
+        rows, errors = readers.read_rows(upload, "ROADS.CSV")
+        self.assertEqual(errors, [])
+        first, second = list(rows)
+        self.assertEqual(first, dict(_row(2, "R1", "S1")))
+        self.assertEqual((second["_rownum"], second["SEGMENT CODE"]), (4, "S2"))  # blank row 3 skipped
+
+    def test_rows_are_read_lazily(self):
+        read = []
+
+        def lines():
+            for line in [",".join(readers.REQUIRED_HEADERS)] + ["R1,S1,Lagos,Seg,6.5,3.3,6.6,3.4"] * 3:
+                read.append(line)
+                yield (line + "\n").encode()
+
+        rows, _ = readers.read_rows(lines(), "roads.csv")
+        self.assertEqual(next(rows)["_rownum"], 2)
+        self.assertEqual(len(read), 2)
+        self.assertEqual(len(list(rows)), 2)
+
+    def test_missing_headers(self):
+        rows, errors = readers.read_rows(self._csv("ROUTE,SEGMENT CODE,STATE\nR1,S1,Lagos\n"), "roads.csv")
+        self.assertIsNone(rows)
+        self.assertEqual(errors, [
+            "Missing headers: SEGMENT NAME, START_LAT, START_LON, END_LAT, END_LON",
+        ])
+
+    def test_empty_file(self):
+        self.assertEqual(readers.read_rows(self._csv(""), "roads.csv"), (None, ["Empty CSV"]))
+
+    def test_unsupported_type(self):
+        upload = SimpleUploadedFile("roads.json", b"[]")
+        self.assertEqual(
+            readers.read_rows(upload, "roads.json"), (None, ["Unsupported file type: roads.json"]),
+        )
+
+    @unittest.skipIf(readers.openpyxl is None, "openpyxl not installed")
+    def test_xlsx(self):
+        wb = readers.openpyxl.Workbook()
+        wb.active.append(readers.REQUIRED_HEADERS)
+        wb.active.append([])
+        wb.active.append(["R1", "S1", "Lagos", "Seg", 6.5, 3.3, 6.6, 3.4])
+        data = io.BytesIO()
+        wb.save(data)
+        rows, errors = readers.read_rows(SimpleUploadedFile("roads.xlsx", data.getvalue()), "roads.xlsx")
+        self.assertEqual(errors, [])
+        [row] = list(rows)
+        self.assertEqual((row["_rownum"], row["SEGMENT CODE"], row["END_LON"]), (3, "S1", 3.4))
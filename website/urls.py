@@ -5,4 +5,6 @@ urlpatterns = [
     path("", views.landing, name="landing"),
     path("road-analysis/", views.road_analysis, name="road_analysis"),
     path("uploads/", views.uploads, name="uploads"),
+    path("uploads/jobs/<int:job_id>/", views.upload_job, name="upload_job"),
+    path("uploads/jobs/<int:job_id>/status/", views.upload_job_status, name="upload_job_status"),
 ]